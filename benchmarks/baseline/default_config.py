@@ -25,10 +25,12 @@ def get_default_config():
     cfg.data.combineall = False # combine train, query and gallery for training
     cfg.data.transforms = ['random_flip'] # data augmentation
     cfg.data.k_tfm = 1 # number of times to apply augmentation to an image independently
+    cfg.data.batch_transforms = False # apply data augmentation to whole batches on the training device
     cfg.data.norm_mean = [0.485, 0.456, 0.406] # default is imagenet mean
     cfg.data.norm_std = [0.229, 0.224, 0.225] # default is imagenet std
     cfg.data.save_dir = 'log' # path to save log
     cfg.data.load_train_targets = False # load training set from target dataset
+    cfg.data.test_image_cache_dir = '' # directory to cache decoded and resized test images, disabled if empty
 
     # specific datasets
     cfg.market1501 = CN()
@@ -74,6 +76,14 @@ def get_default_config():
     cfg.train.gamma = 0.1 # learning rate decay multiplier
     cfg.train.print_freq = 20 # print frequency
     cfg.train.seed = 1 # random seed
+    cfg.train.amp = False # automatic mixed precision, float16 on gpu and bfloat16 on cpu
+    cfg.train.channels_last = False # channels_last memory format for models and images
+    cfg.train.accumulation_steps = 1 # micro-batches per batch, with gradient accumulation
+    cfg.train.deferred_metrics = False # sync training metrics with the host only when logged
+    cfg.train.tensorboard_freq = 0 # frequency (iterations) of training scalars in tensorboard, 0 means print_freq with deferred_metrics and 1 otherwise
+    cfg.train.dist_backend = '' # backend when launched with torchrun, nccl (gpu) or gloo (cpu) if empty
+    cfg.train.async_checkpoint = False # write checkpoints on a background thread
+    cfg.train.max_checkpoints = 0 # number of most recent checkpoints kept, 0 keeps all
 
     # optimizer
     cfg.sgd = CN()
@@ -93,6 +103,8 @@ def get_default_config():
     cfg.loss.softmax.label_smooth = True # use label smoothing regularizer
     cfg.loss.triplet = CN()
     cfg.loss.triplet.margin = 0.3 # distance margin
+    cfg.loss.triplet.mining = 'batch_hard' # triplet mining, batch_hard or batch_all
+    cfg.loss.triplet.soft_margin = False # use soft-margin instead of hinge with margin
     cfg.loss.triplet.weight_t = 1. # weight to balance hard triplet loss
     cfg.loss.triplet.weight_x = 0. # weight to balance cross entropy loss
 
@@ -106,10 +118,16 @@ def get_default_config():
     cfg.test.eval_freq = -1 # evaluation frequency (-1 means to only test after training)
     cfg.test.start_eval = 0 # start to evaluate after a specific epoch
     cfg.test.rerank = False # use person re-ranking
+    cfg.test.rerank_method = 'k_reciprocal' # re-ranking method, k_reciprocal or gnn
     cfg.test.visrank = False # visualize ranked results (only available when cfg.test.evaluate=True)
     cfg.test.visrank_topk = 10 # top-k ranks to visualize
     cfg.test.export_ranking_results = False # export query to gallery ranking results to JSON file in 'data.save_dir' for each
                                     # target dataset. To be used for external evaluation and submission on EvalAI
+    cfg.test.action_blocked_dist = False # only compute query to gallery distances within each action (soccernetv3)
+    cfg.test.dist_max_memory = 0 # compute distance matrix by blocks of at most this size (MB), 0 means all at once
+    cfg.test.dist_topk = 0 # if positive, stream the gallery and only retrieve the top-k gallery samples of each query
+    cfg.test.feature_cache_dir = '' # directory of the persistent query/gallery feature cache, empty means no cache
+    cfg.test.rerank_workers = 0 # number of processes for per-action re-ranking (rerank and action_blocked_dist)
 
     return cfg
 
@@ -123,6 +141,7 @@ def imagedata_kwargs(cfg):
         'width': cfg.data.width,
         'transforms': cfg.data.transforms,
         'k_tfm': cfg.data.k_tfm,
+        'batch_transforms': cfg.data.batch_transforms,
         'norm_mean': cfg.data.norm_mean,
         'norm_std': cfg.data.norm_std,
         'use_gpu': cfg.use_gpu,
@@ -142,6 +161,7 @@ def imagedata_kwargs(cfg):
         'cuhk03_classic_split': cfg.cuhk03.classic_split,
         'market1501_500k': cfg.market1501.use_500k_distractors,
         'soccernetv3_training_subset': cfg.soccernetv3.training_subset,
+        'test_image_cache_dir': cfg.data.test_image_cache_dir,
     }
 
 
@@ -204,6 +224,11 @@ def engine_run_kwargs(cfg):
         'start_epoch': cfg.train.start_epoch,
         'fixbase_epoch': cfg.train.fixbase_epoch,
         'open_layers': cfg.train.open_layers,
+        'accumulation_steps': cfg.train.accumulation_steps,
+        'deferred_metrics': cfg.train.deferred_metrics,
+        'tensorboard_freq': cfg.train.tensorboard_freq,
+        'async_checkpoint': cfg.train.async_checkpoint,
+        'max_checkpoints': cfg.train.max_checkpoints,
         'start_eval': cfg.test.start_eval,
         'eval_freq': cfg.test.eval_freq,
         'test_only': cfg.test.evaluate,
@@ -216,4 +241,10 @@ def engine_run_kwargs(cfg):
         'ranks': cfg.test.ranks,
         'rerank': cfg.test.rerank,
         'export_ranking_results': cfg.test.export_ranking_results,
+        'action_blocked_dist': cfg.test.action_blocked_dist,
+        'dist_max_memory': cfg.test.dist_max_memory,
+        'dist_topk': cfg.test.dist_topk,
+        'feature_cache_dir': cfg.test.feature_cache_dir,
+        'rerank_workers': cfg.test.rerank_workers,
+        'rerank_method': cfg.test.rerank_method,
     }
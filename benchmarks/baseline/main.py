@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 import os.path as osp
@@ -7,8 +8,9 @@ import torch.nn as nn
 
 import torchreid
 from torchreid.utils import (
-    Logger, check_isfile, set_random_seed, collect_env_info,
-    resume_from_checkpoint, load_pretrained_weights, compute_model_complexity
+    Logger, check_isfile, set_random_seed, collect_env_info, init_distributed,
+    is_main_process, resume_from_checkpoint, load_pretrained_weights,
+    compute_model_complexity
 )
 
 from default_config import (
@@ -17,10 +19,14 @@ from default_config import (
 )
 
 
-def build_datamanager(cfg):
+def build_datamanager(cfg, distributed=False):
     if cfg.data.type == 'image':
-        return torchreid.data.ImageDataManager(**imagedata_kwargs(cfg))
+        return torchreid.data.ImageDataManager(
+            distributed=distributed, **imagedata_kwargs(cfg)
+        )
     else:
+        if distributed:
+            raise ValueError('Distributed training only supports image-reid')
         return torchreid.data.VideoDataManager(**videodata_kwargs(cfg))
 
 
@@ -33,7 +39,9 @@ def build_engine(cfg, datamanager, model, optimizer, scheduler):
                 optimizer=optimizer,
                 scheduler=scheduler,
                 use_gpu=cfg.use_gpu,
-                label_smooth=cfg.loss.softmax.label_smooth
+                label_smooth=cfg.loss.softmax.label_smooth,
+                amp=cfg.train.amp,
+                channels_last=cfg.train.channels_last
             )
 
         else:
@@ -42,11 +50,15 @@ def build_engine(cfg, datamanager, model, optimizer, scheduler):
                 model,
                 optimizer=optimizer,
                 margin=cfg.loss.triplet.margin,
+                mining=cfg.loss.triplet.mining,
+                soft_margin=cfg.loss.triplet.soft_margin,
                 weight_t=cfg.loss.triplet.weight_t,
                 weight_x=cfg.loss.triplet.weight_x,
                 scheduler=scheduler,
                 use_gpu=cfg.use_gpu,
-                label_smooth=cfg.loss.softmax.label_smooth
+                label_smooth=cfg.loss.softmax.label_smooth,
+                amp=cfg.train.amp,
+                channels_last=cfg.train.channels_last
             )
 
     else:
@@ -58,7 +70,9 @@ def build_engine(cfg, datamanager, model, optimizer, scheduler):
                 scheduler=scheduler,
                 use_gpu=cfg.use_gpu,
                 label_smooth=cfg.loss.softmax.label_smooth,
-                pooling_method=cfg.video.pooling_method
+                pooling_method=cfg.video.pooling_method,
+                amp=cfg.train.amp,
+                channels_last=cfg.train.channels_last
             )
 
         else:
@@ -67,11 +81,15 @@ def build_engine(cfg, datamanager, model, optimizer, scheduler):
                 model,
                 optimizer=optimizer,
                 margin=cfg.loss.triplet.margin,
+                mining=cfg.loss.triplet.mining,
+                soft_margin=cfg.loss.triplet.soft_margin,
                 weight_t=cfg.loss.triplet.weight_t,
                 weight_x=cfg.loss.triplet.weight_x,
                 scheduler=scheduler,
                 use_gpu=cfg.use_gpu,
-                label_smooth=cfg.loss.softmax.label_smooth
+                label_smooth=cfg.loss.softmax.label_smooth,
+                amp=cfg.train.amp,
+                channels_last=cfg.train.channels_last
             )
 
     return engine
@@ -138,9 +156,15 @@ def main():
     set_random_seed(cfg.train.seed)
     check_cfg(cfg)
 
-    log_name = 'test.log' if cfg.test.evaluate else 'train.log'
-    log_name += time.strftime('-%Y-%m-%d-%H-%M-%S')
-    sys.stdout = Logger(osp.join(cfg.data.save_dir, log_name))
+    # launched with torchrun, one process per gpu (or several on cpu with gloo)
+    distributed = init_distributed(cfg.train.dist_backend)
+
+    if is_main_process():
+        log_name = 'test.log' if cfg.test.evaluate else 'train.log'
+        log_name += time.strftime('-%Y-%m-%d-%H-%M-%S')
+        sys.stdout = Logger(osp.join(cfg.data.save_dir, log_name))
+    else:
+        sys.stdout = open(os.devnull, 'w')
 
     print('Show configuration\n{}\n'.format(cfg))
     print('Collecting env info ...')
@@ -149,7 +173,7 @@ def main():
     if cfg.use_gpu:
         torch.backends.cudnn.benchmark = True
 
-    datamanager = build_datamanager(cfg)
+    datamanager = build_datamanager(cfg, distributed)
 
     print('Building model: {}'.format(cfg.model.name))
     model = torchreid.models.build_model(
@@ -167,7 +191,26 @@ def main():
     if cfg.model.load_weights and check_isfile(cfg.model.load_weights):
         load_pretrained_weights(model, cfg.model.load_weights)
 
-    if cfg.use_gpu:
+    if cfg.train.channels_last:
+        # before wrapping, as DDP gradient buckets follow the parameter strides
+        model = model.to(memory_format=torch.channels_last)
+
+    if distributed:
+        # parameters out of the graph: frozen base layers or unused classifier
+        find_unused_parameters = cfg.train.fixbase_epoch > 0 or (
+            cfg.loss.name == 'triplet' and cfg.loss.triplet.weight_x == 0
+        )
+        if cfg.use_gpu:
+            model = nn.parallel.DistributedDataParallel(
+                model.cuda(),
+                device_ids=[torch.cuda.current_device()],
+                find_unused_parameters=find_unused_parameters
+            )
+        else:
+            model = nn.parallel.DistributedDataParallel(
+                model, find_unused_parameters=find_unused_parameters
+            )
+    elif cfg.use_gpu:
         model = nn.DataParallel(model).cuda()
 
     optimizer = torchreid.optim.build_optimizer(model, **optimizer_kwargs(cfg))
@@ -175,17 +218,25 @@ def main():
         optimizer, **lr_scheduler_kwargs(cfg)
     )
 
-    if cfg.model.resume and check_isfile(cfg.model.resume):
-        cfg.train.start_epoch = resume_from_checkpoint(
-            cfg.model.resume, model, optimizer=optimizer, scheduler=scheduler
-        )
-
     print(
         'Building {}-engine for {}-reid'.format(cfg.loss.name, cfg.data.type)
     )
     engine = build_engine(cfg, datamanager, model, optimizer, scheduler)
+
+    if cfg.model.resume and check_isfile(cfg.model.resume):
+        cfg.train.start_epoch = resume_from_checkpoint(
+            cfg.model.resume,
+            model,
+            optimizer=optimizer,
+            scheduler=scheduler,
+            scaler=engine.scaler
+        )
+
     engine.run(**engine_run_kwargs(cfg))
 
+    if distributed:
+        torch.distributed.destroy_process_group()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,61 @@
+"""
+Pack the images of the SoccerNet-v3 ReID splits into a few large shard files.
+
+Usage:
+$ python tools/pack_soccernetv3.py DATASET_ROOT [--splits train valid test challenge]
+
+Each image directory, e.g. DATASET_ROOT/soccernetv3/reid/valid/query, is packed
+into DATASET_ROOT/soccernetv3/reid/valid/query.pack, which holds the shard files
+and an index with the offset of each image and the annotations parsed from its
+filename. The datasets then read the images from the shards, and the image
+directories can be deleted.
+"""
+import argparse
+import os.path as osp
+
+from torchreid.data.datasets.image.soccernetv3 import Soccernetv3
+
+SPLIT_DIRS = {
+    'train': ['train'],
+    'valid': ['valid/query', 'valid/gallery'],
+    'test': ['test/query', 'test/gallery'],
+    'challenge': ['challenge/query', 'challenge/gallery'],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', type=str)
+    parser.add_argument(
+        '--splits',
+        type=str,
+        nargs='+',
+        default=['train', 'valid', 'test', 'challenge'],
+        choices=list(SPLIT_DIRS)
+    )
+    parser.add_argument(
+        '--shard-size',
+        type=int,
+        default=1024,
+        help='maximum size of a shard, in MB'
+    )
+    args = parser.parse_args()
+
+    reid_dataset_dir = osp.join(
+        osp.abspath(osp.expanduser(args.root)), Soccernetv3.dataset_dir, 'reid'
+    )
+    for split in args.splits:
+        pattern = '*.png' if split == 'challenge' else '*/*/*/*/*.png'
+        for split_dir in SPLIT_DIRS[split]:
+            main_path = osp.join(reid_dataset_dir, split_dir)
+            if not osp.isdir(main_path):
+                print("Skipping missing directory '{}'".format(main_path))
+                continue
+            Soccernetv3.pack_dir(
+                main_path, pattern, shard_size=args.shard_size * 1024**2
+            )
+    print('Done')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
 from __future__ import division, print_function, absolute_import
 import torch
 
-from torchreid.data.sampler import build_train_sampler
+from torchreid.data.sampler import (
+    DistributedShardSampler, build_train_sampler
+)
 from torchreid.data.datasets import init_image_dataset, init_video_dataset
-from torchreid.data.transforms import build_transforms
+from torchreid.data.transforms import build_transforms, build_batch_transforms
+from torchreid.data.image_cache import DecodedImageCache, strip_resize
 
 
 class DataManager(object):
@@ -20,6 +23,10 @@ class DataManager(object):
         norm_mean (list or None, optional): data mean. Default is None (use imagenet mean).
         norm_std (list or None, optional): data std. Default is None (use imagenet std).
         use_gpu (bool, optional): use gpu. Default is True.
+        batch_transforms (bool, optional): apply the training augmentations to whole
+            batches on the training device (see ``build_batch_transforms``), in which
+            case the train loader yields uint8 images to be transformed by
+            ``batch_transform_tr``. Default is False.
     """
 
     def __init__(
@@ -31,7 +38,8 @@ class DataManager(object):
         transforms='random_flip',
         norm_mean=None,
         norm_std=None,
-        use_gpu=False
+        use_gpu=False,
+        batch_transforms=False
     ):
         self.sources = sources
         self.targets = targets
@@ -58,6 +66,16 @@ class DataManager(object):
             norm_std=norm_std
         )
 
+        self.batch_transform_tr = None
+        if batch_transforms:
+            self.transform_tr, self.batch_transform_tr = build_batch_transforms(
+                self.height,
+                self.width,
+                transforms=transforms,
+                norm_mean=norm_mean,
+                norm_std=norm_std
+            )
+
         self.use_gpu = (torch.cuda.is_available() and use_gpu)
 
     @property
@@ -129,6 +147,17 @@ class ImageDataManager(DataManager):
             set in market1501. Default is False.
         soccernetv3_training_subset (float, optional): Use 'training_subset'% of total number of training set actions
             at training stage. Use this option for faster training. Set to 1.0 to use full training set.
+        test_image_cache_dir (str, optional): directory where query and gallery images are
+            cached once decoded and resized (see ``DecodedImageCache``). Default is ''
+            (images are decoded at every evaluation).
+        batch_transforms (bool, optional): apply the training augmentations to whole
+            batches on the training device instead of in the data loading workers.
+            Default is False.
+        distributed (bool, optional): build the loaders of the current process of
+            distributed training (see ``torchreid.utils.init_distributed``): the
+            training batches are sampled for this process, ``batch_size_train``
+            being the batch size of a process, and the test loaders only load a
+            contiguous shard of the query and gallery sets. Default is False.
 
     Examples::
 
@@ -179,6 +208,9 @@ class ImageDataManager(DataManager):
         cuhk03_classic_split=False,
         market1501_500k=False,
         soccernetv3_training_subset=1.0,
+        test_image_cache_dir='',
+        batch_transforms=False,
+        distributed=False,
     ):
 
         super(ImageDataManager, self).__init__(
@@ -189,7 +221,8 @@ class ImageDataManager(DataManager):
             transforms=transforms,
             norm_mean=norm_mean,
             norm_std=norm_std,
-            use_gpu=use_gpu
+            use_gpu=use_gpu,
+            batch_transforms=batch_transforms
         )
 
         print('=> Loading train (source) dataset')
@@ -222,7 +255,8 @@ class ImageDataManager(DataManager):
                 batch_size=batch_size_train,
                 num_instances=num_instances,
                 num_cams=num_cams,
-                num_datasets=num_datasets
+                num_datasets=num_datasets,
+                distributed=distributed
             ),
             batch_size=batch_size_train,
             shuffle=False,
@@ -264,7 +298,8 @@ class ImageDataManager(DataManager):
                     batch_size=batch_size_train,
                     num_instances=num_instances,
                     num_cams=num_cams,
-                    num_datasets=num_datasets
+                    num_datasets=num_datasets,
+                    distributed=distributed
                 ),
                 batch_size=batch_size_train,
                 shuffle=False,
@@ -305,6 +340,8 @@ class ImageDataManager(DataManager):
             )
             self.test_loader[name]['query'] = torch.utils.data.DataLoader(
                 queryset,
+                sampler=DistributedShardSampler(queryset)
+                if distributed else None,
                 batch_size=batch_size_test,
                 shuffle=False,
                 num_workers=workers,
@@ -328,6 +365,8 @@ class ImageDataManager(DataManager):
             )
             self.test_loader[name]['gallery'] = torch.utils.data.DataLoader(
                 galleryset,
+                sampler=DistributedShardSampler(galleryset)
+                if distributed else None,
                 batch_size=batch_size_test,
                 shuffle=False,
                 num_workers=workers,
@@ -335,6 +374,19 @@ class ImageDataManager(DataManager):
                 drop_last=False
             )
 
+            if test_image_cache_dir:
+                for dataset in (queryset, galleryset):
+                    dataset.image_cache = DecodedImageCache(
+                        test_image_cache_dir,
+                        '{}_{}'.format(name, dataset.mode),
+                        [item[0] for item in dataset.data],
+                        height,
+                        width,
+                        workers=workers,
+                        image_reader=dataset.image_reader
+                    )
+                    dataset.transform = strip_resize(dataset.transform)
+
             self.test_dataset[name]['query'] = queryset.query
             self.test_dataset[name]['gallery'] = galleryset.gallery
 
@@ -7,6 +7,7 @@ import zipfile
 import torch
 
 from torchreid.utils import read_image, download_url, mkdir_if_missing
+from torchreid.data.shards import PackedImageReader
 
 
 class Dataset(object):
@@ -39,6 +40,10 @@ class Dataset(object):
     # In this case, "combineall=True" is not used for them
     _train_only = False
 
+    # Reader of the images stored in packs (see torchreid.data.shards), if any.
+    # Images whose path is not in a pack are read from disk.
+    image_reader = None
+
     # Set to True for datasets with test sets having hidden/private identity labels.
     # Resulting query to gallery ranking result should be exported for external evaluation with private identity labels.
     hidden_labels = False
@@ -120,7 +125,7 @@ class Dataset(object):
         #    create new IDs that should have already been included
         ###################################
         if isinstance(train[0][0], str):
-            return ImageDataset(
+            dataset = ImageDataset(
                 train,
                 self.query,
                 self.gallery,
@@ -129,6 +134,12 @@ class Dataset(object):
                 combineall=False,
                 verbose=False
             )
+            if self.image_reader is not None or other.image_reader is not None:
+                dataset.image_reader = (
+                    PackedImageReader() + self.image_reader +
+                    other.image_reader
+                )
+            return dataset
         else:
             return VideoDataset(
                 train,
@@ -320,14 +331,25 @@ class ImageDataset(Dataset):
     It will return ``img``, ``pid``, ``camid`` and ``img_path``
     where ``img`` has shape (channel, height, width). As a result,
     data in each batch has shape (batch_size, channel, height, width).
+
+    When ``image_cache`` is set to a ``torchreid.data.image_cache.DecodedImageCache``
+    built from ``data``, images are read from it as already resized uint8 arrays
+    instead of being decoded from disk.
     """
 
+    image_cache = None
+
     def __init__(self, train, query, gallery, **kwargs):
         super(ImageDataset, self).__init__(train, query, gallery, **kwargs)
 
     def __getitem__(self, index):
         img_path, pid, camid, dsetid = self.data[index]
-        img = read_image(img_path)
+        if self.image_cache is not None:
+            img = self.image_cache[index]
+        elif self.image_reader is not None and img_path in self.image_reader:
+            img = self.image_reader(img_path)
+        else:
+            img = read_image(img_path)
         if self.transform is not None:
             img = self._transform_image(self.transform, self.k_tfm, img)
         item = {
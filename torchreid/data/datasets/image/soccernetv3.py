@@ -1,8 +1,14 @@
 from __future__ import division, print_function, absolute_import
 import glob
 import os
+import hashlib
+import warnings
 import os.path as osp
+import tempfile
+import numpy as np
+from torchreid.utils import barrier, is_main_process
 from ..dataset import ImageDataset
+from ...shards import PackedImageReader, load_pack_index, pack_images
 from SoccerNet.Downloader import SoccerNetDownloader as SNdl
 import zipfile
 
@@ -13,6 +19,9 @@ class Soccernetv3(ImageDataset):
     evaluation.
     """
     dataset_dir = 'soccernetv3'
+    index_version = 1
+    # index of each directory, shared by all the instances of the process
+    _index_cache = {}
 
     def __init__(self, root='', soccernetv3_training_subset=1.0, **kwargs):
         assert 1.0 >= soccernetv3_training_subset > 0.0
@@ -40,19 +49,16 @@ class Soccernetv3(ImageDataset):
 
     def process_dir(self, main_path, pid2label, ids_counter=0, relabel=False, soccernetv3_training_subset=1.):
         data = []
-        img_paths = glob.glob(osp.join(main_path, '*/*/*/*/*.png'))
-        # sort images list such that each sample position in the list match its filename index
-        img_paths.sort(key=lambda img_path: self.get_bbox_index(img_path))
+        # image paths are sorted such that each sample position in the list match its filename index
+        index = self.load_index(main_path, '*/*/*/*/*.png')
+        self.add_pack(index)
+        img_paths = index["img_path"]
 
         # if soccernetv3_training_subset is set, use samples from action '0' to action 'end_action'
-        action_num = self.extract_sample_info(os.path.basename(img_paths[-1]))["action_idx"] + 1
+        action_num = int(index["action_idx"][-1]) + 1
         end_action = action_num * soccernetv3_training_subset
 
-        for img_path in img_paths:
-            filename = os.path.basename(img_path)
-            info = self.extract_sample_info(filename)
-            pid = info["person_uid"]
-            action_idx = info["action_idx"]
+        for img_path, pid, action_idx in zip(img_paths, index["person_uid"].tolist(), index["action_idx"].tolist()):
             if action_idx >= end_action:
                 break
             if relabel:
@@ -64,17 +70,166 @@ class Soccernetv3(ImageDataset):
 
         return data, pid2label, ids_counter
 
+    def load_index(self, main_path, pattern):
+        """Returns the image paths of a directory, sorted by bbox index, along with the annotations parsed from
+        their filenames (see ``extract_sample_info``), as a dict of arrays.
+
+        The index is saved next to the directory as '<dirname>.index.npz' and is only rebuilt when the mtime of the
+        directory or of one of its sub-directories changes, so that the image files are neither listed nor parsed
+        again. It is also kept in memory, since the train, query and gallery datasets are instantiated separately.
+
+        If the directory was packed (see ``pack_dir``), the index of the pack is used instead, along with the
+        location of each image in the shards, unless the directory changed since it was packed. The directory can
+        then be deleted.
+        """
+        main_path = osp.normpath(main_path)
+        if main_path in self._index_cache:
+            return self._index_cache[main_path]
+
+        index = self.load_pack(main_path, pattern)
+        if index is not None:
+            self._index_cache[main_path] = index
+            return index
+
+        signature = self.get_dir_signature(main_path, depth=pattern.count('/'))
+        index_path = main_path + '.index.npz'
+        # in distributed training, the index is built by the main process and read by the others
+        if is_main_process():
+            index = self.read_index(index_path, signature)
+            if index is None:
+                print("Building index of '{}' ...".format(main_path))
+                index = self.build_index(main_path, pattern)
+                self.save_index(index_path, index, signature)
+        barrier()
+        if index is None:
+            index = self.read_index(index_path, signature)
+        if index is None:
+            # the main process could not save the index
+            index = self.build_index(main_path, pattern)
+
+        index["img_path"] = [osp.join(main_path, rel_path) for rel_path in index["rel_path"].tolist()]
+        self._index_cache[main_path] = index
+        return index
+
+    def load_pack(self, main_path, pattern):
+        """Returns the index of the pack '<dirname>.pack' of a directory, or None if it is missing or stale."""
+        pack_dir = main_path + '.pack'
+        pack_index = load_pack_index(pack_dir)
+        if pack_index is None:
+            return None
+        if osp.isdir(main_path) and \
+                str(pack_index["signature"]) != self.get_dir_signature(main_path, depth=pattern.count('/')):
+            warnings.warn("Ignoring pack '{}', which is older than the content of '{}'".format(pack_dir, main_path))
+            return None
+        index = {key: value for key, value in pack_index.items() if key not in ["signature", "version", "num_shards"]}
+        index["img_path"] = [osp.join(main_path, rel_path) for rel_path in index["rel_path"].tolist()]
+        index["pack_dir"] = pack_dir
+        return index
+
+    def add_pack(self, index):
+        """Reads the images of an index loaded from a pack from its shards."""
+        if "pack_dir" not in index:
+            return
+        if self.image_reader is None:
+            self.image_reader = PackedImageReader()
+        self.image_reader.add_pack(index["pack_dir"], index["img_path"], index)
+
+    @classmethod
+    def pack_dir(cls, main_path, pattern='*/*/*/*/*.png', shard_size=1024**3):
+        """Packs the images of a directory into shard files (see ``torchreid.data.shards.pack_images``), in the
+        '<dirname>.pack' directory, along with the annotations parsed from their filenames.
+
+        Args:
+            main_path (str): directory, e.g. 'soccernetv3/reid/valid/query'.
+            pattern (str, optional): glob pattern of the images in the directory. Default is '*/*/*/*/*.png',
+                use '*.png' for the challenge set.
+            shard_size (int, optional): maximum number of bytes of a shard. Default is 1GB.
+        """
+        main_path = osp.normpath(main_path)
+        signature = cls.get_dir_signature(main_path, depth=pattern.count('/'))
+        index = cls.build_index(main_path, pattern)
+        img_paths = [osp.join(main_path, rel_path) for rel_path in index["rel_path"].tolist()]
+        print("Packing {} images of '{}' ...".format(len(img_paths), main_path))
+        pack_images(img_paths, main_path + '.pack', metadata=index, signature=signature, shard_size=shard_size)
+
+    @classmethod
+    def build_index(cls, main_path, pattern):
+        img_paths = glob.glob(osp.join(main_path, pattern))
+        img_paths.sort(key=lambda img_path: cls.get_bbox_index(img_path))
+        infos = [cls.extract_sample_info(os.path.basename(img_path)) for img_path in img_paths]
+
+        index = {"rel_path": np.asarray([osp.relpath(img_path, main_path) for img_path in img_paths], dtype=str)}
+        for key in infos[0] if infos else []:
+            if key == "shape":
+                index["shape"] = np.asarray([info["shape"] for info in infos], dtype=np.int32)
+            elif isinstance(infos[0][key], int):
+                index[key] = np.asarray([info[key] for info in infos], dtype=np.int64)
+            else:
+                index[key] = np.asarray([info[key] for info in infos], dtype=str)
+        return index
+
+    def read_index(self, index_path, signature):
+        """Returns the index saved at 'index_path', or None if it is missing or stale."""
+        if not osp.isfile(index_path):
+            return None
+        with np.load(index_path) as f:
+            if str(f["signature"]) != signature or int(f["version"]) != self.index_version:
+                return None
+            return {key: f[key] for key in f.files if key not in ["signature", "version"]}
+
+    def save_index(self, index_path, index, signature):
+        # written to a temporary file first so that concurrent runs never read a partial index
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=osp.dirname(index_path), suffix='.npz')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, signature=signature, version=self.index_version, **index)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            warnings.warn("Could not save dataset index '{}': {}".format(index_path, e))
+
+    def check_before_run(self, required_files):
+        # packed directories (see pack_dir) may have been deleted
+        required_files = [
+            fpath + '.pack' if not osp.exists(fpath) and osp.isdir(fpath + '.pack') else fpath
+            for fpath in required_files
+        ]
+        super(Soccernetv3, self).check_before_run(required_files)
+
+    @staticmethod
+    def get_dir_signature(main_path, depth):
+        """Hashes the mtimes of a directory and of its sub-directories down to the given depth, which change whenever
+        files are added, removed or renamed in them."""
+        h = hashlib.sha1()
+        dirs = [main_path]
+        for level in range(depth + 1):
+            sub_dirs = []
+            for dir_path in dirs:
+                h.update("{}:{}\n".format(osp.relpath(dir_path, main_path), os.stat(dir_path).st_mtime_ns).encode())
+                if level < depth:
+                    sub_dirs.extend(sorted(entry.path for entry in os.scandir(dir_path) if entry.is_dir()))
+            dirs = sub_dirs
+        return h.hexdigest()
+
     @staticmethod
     def download_soccernet_dataset(dataset_dir, split):
         task = "reid"
         reid_dataset_dir = osp.join(dataset_dir, task)
 
+        # in distributed training, the main process downloads while the others wait
+        if is_main_process():
+            Soccernetv3._download_splits(dataset_dir, reid_dataset_dir, task, split)
+        barrier()
+
+        return reid_dataset_dir
+
+    @staticmethod
+    def _download_splits(dataset_dir, reid_dataset_dir, task, split):
         mySNdl = SNdl(LocalDirectory=dataset_dir)
 
         for set_type in split:
             # download SoccerNet dataset subsets specified by 'set_type' (train/valid/test/challenge)
             path_to_set = osp.join(reid_dataset_dir, set_type)
-            if osp.exists(path_to_set):
+            if osp.exists(path_to_set) or osp.exists(path_to_set + '.pack'):
                 print("SoccerNet {} set was already downloaded and unzipped at {}.".format(set_type, path_to_set))
                 continue
 
@@ -92,8 +247,6 @@ class Soccernetv3(ImageDataset):
 
             print('SoccerNet {} set is ready.'.format(set_type))
 
-        return reid_dataset_dir
-
     @staticmethod
     def extract_sample_info(filename):
         """ Extract sample annotations from its filename
@@ -183,14 +336,9 @@ class Soccernetv3Challenge(Soccernetv3):
         super(Soccernetv3, self).__init__(train, query, gallery, **kwargs)
 
     def process_dir(self, main_path, pid2label, ids_counter=0, relabel=False, soccernetv3_training_subset=1.):
-        data = []
-        img_paths = glob.glob(osp.join(main_path, '*.png'))
-        # sort images list such that each sample position in the list match its filename index
-        img_paths.sort(key=lambda img_path: self.get_bbox_index(img_path))
-
-        for img_path in img_paths:
-            filename = os.path.basename(img_path)
-            info = self.extract_sample_info(filename)
-            data.append((img_path, (info["bbox_idx"]), info["action_idx"]))
+        # image paths are sorted such that each sample position in the list match its filename index
+        index = self.load_index(main_path, '*.png')
+        self.add_pack(index)
+        data = list(zip(index["img_path"], index["bbox_idx"].tolist(), index["action_idx"].tolist()))
 
         return data, pid2label, ids_counter
@@ -0,0 +1,178 @@
+from __future__ import division, print_function, absolute_import
+import os
+import json
+import time
+import hashlib
+import os.path as osp
+import numpy as np
+import torch
+from torchvision.transforms import Resize, Compose
+
+from torchreid.utils import (
+    barrier, read_image, is_main_process, mkdir_if_missing
+)
+
+__all__ = ['DecodedImageCache', 'strip_resize']
+
+
+def strip_resize(transform):
+    """Returns ``transform`` without its ``Resize`` steps, i.e. the transform
+    to apply to images already resized by a ``DecodedImageCache``."""
+    if isinstance(transform, Compose):
+        return Compose(
+            [t for t in transform.transforms if not isinstance(t, Resize)]
+        )
+    return transform
+
+
+class _DecodeDataset(object):
+    """Decodes and resizes images, used to fill the cache with the workers
+    of a DataLoader."""
+
+    def __init__(self, img_paths, height, width, image_reader=None):
+        self.img_paths = img_paths
+        self.resize = Resize((height, width))
+        self.image_reader = image_reader
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, index):
+        img_path = self.img_paths[index]
+        if self.image_reader is not None and img_path in self.image_reader:
+            img = self.image_reader(img_path)
+        else:
+            img = read_image(img_path)
+        img = self.resize(img)
+        return torch.from_numpy(np.asarray(img, dtype=np.uint8).copy())
+
+
+class DecodedImageCache(object):
+    """Store of decoded images, resized once to (height, width).
+
+    Images are kept in a single uint8 array of shape (num_images, height,
+    width, 3) saved as ``.npy`` and memory-mapped when read, next to an index
+    listing the image paths. Reading an image is then a slice of the array, so
+    that repeated evaluations skip the decoding and resizing of the images and
+    only convert and normalize them (see ``strip_resize``). The cache is
+    rebuilt when the image paths or the size change. In distributed training,
+    the cache is built by the main process while the others wait.
+
+    Args:
+        cache_dir (str): directory where caches are stored.
+        name (str): cache name, e.g. "soccernetv3_query".
+        img_paths (list): image paths, in dataset order.
+        height (int): image height.
+        width (int): image width.
+        workers (int, optional): number of workers used to decode the images
+            when building the cache. Default is 0.
+        image_reader (PackedImageReader, optional): reader of the packed images
+            (see ``Dataset.image_reader``), the other images being read from
+            disk. Default is None.
+
+    Examples::
+        >>> cache = DecodedImageCache('log/image_cache', 'market1501_query',
+        >>>                           [item[0] for item in queryset.query], 256, 128)
+        >>> queryset.image_cache = cache
+        >>> queryset.transform = strip_resize(queryset.transform)
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        name,
+        img_paths,
+        height,
+        width,
+        workers=0,
+        image_reader=None
+    ):
+        self.img_paths = list(img_paths)
+        self.shape = (len(self.img_paths), height, width, 3)
+        h = hashlib.sha1()
+        h.update(str(self.shape).encode('utf-8'))
+        for path in self.img_paths:
+            h.update(path.encode('utf-8'))
+            h.update(b'\0')
+        self.digest = h.hexdigest()
+        self.fpath = osp.join(
+            cache_dir, '{}_{}x{}.npy'.format(name, height, width)
+        )
+        self.index_fpath = osp.splitext(self.fpath)[0] + '.json'
+        self._images = None
+
+        if is_main_process():
+            mkdir_if_missing(cache_dir)
+            if not self._is_valid():
+                self._build(workers, image_reader)
+        barrier()
+        if not self._is_valid():
+            raise RuntimeError(
+                'Decoded image cache "{}" was not built'.format(self.fpath)
+            )
+
+    def _is_valid(self):
+        if not (osp.isfile(self.fpath) and osp.isfile(self.index_fpath)):
+            return False
+        with open(self.index_fpath, 'r') as f:
+            index = json.load(f)
+        return index.get('digest') == self.digest
+
+    def _build(self, workers, image_reader):
+        print(
+            '=> Building decoded image cache "{}" ({} images)'.format(
+                self.fpath, self.shape[0]
+            )
+        )
+        start = time.time()
+        tmp_fpath = self.fpath + '.tmp.npy'
+        images = np.lib.format.open_memmap(
+            tmp_fpath, mode='w+', dtype=np.uint8, shape=self.shape
+        )
+        loader = torch.utils.data.DataLoader(
+            _DecodeDataset(
+                self.img_paths, *self.shape[1:3], image_reader=image_reader
+            ),
+            batch_size=64,
+            shuffle=False,
+            num_workers=workers
+        )
+        i = 0
+        for batch in loader:
+            images[i:i + batch.size(0)] = batch.numpy()
+            i += batch.size(0)
+        images.flush()
+        del images
+        os.replace(tmp_fpath, self.fpath)
+
+        # the index is written last, a missing index means an incomplete cache
+        tmp_index_fpath = self.index_fpath + '.tmp'
+        with open(tmp_index_fpath, 'w') as f:
+            json.dump(
+                {
+                    'digest': self.digest,
+                    'shape': list(self.shape),
+                    'img_paths': self.img_paths
+                }, f
+            )
+        os.replace(tmp_index_fpath, self.index_fpath)
+        print('Done. Time elapsed: {:.2f}s'.format(time.time() - start))
+
+    @property
+    def images(self):
+        # opened lazily so that each DataLoader worker maps the file itself
+        if self._images is None:
+            self._images = np.load(self.fpath, mmap_mode='r')
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """Returns the image as a (height, width, 3) uint8 numpy.ndarray."""
+        return np.array(self.images[index])
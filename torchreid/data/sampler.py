@@ -1,26 +1,105 @@
 from __future__ import division, absolute_import
-import copy
 import numpy as np
-import random
-from collections import defaultdict
 from torch.utils.data.sampler import Sampler, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
+
+from torchreid.utils.distributed import (
+    get_rank, get_world_size, broadcast_object
+)
 
 AVAI_SAMPLERS = [
     'RandomIdentitySampler', 'SequentialSampler', 'RandomSampler',
-    'RandomDomainSampler', 'RandomDatasetSampler'
+    'RandomDomainSampler', 'RandomDatasetSampler',
+    'RandomActionIdentitySampler'
+]
+DISTRIBUTED_SAMPLERS = [
+    'RandomIdentitySampler', 'SequentialSampler', 'RandomSampler'
 ]
 
 
+def _make_rng(seed):
+    # without a seed, the generator is seeded from the global numpy RNG so that
+    # torchreid.utils.set_random_seed still makes runs reproducible
+    if seed is None:
+        seed = np.random.randint(2**31)
+    return np.random.default_rng(seed)
+
+
+def _layout_batches(rng, chunk_pids, ranks, pid_keys, B, N):
+    """Lays out chunks of K images into B batches of N chunks of different pids.
+
+    The chunks (at most B per pid) are sequenced by pids ordered by their random
+    keys, then the sequence is split into N rounds of B chunks, the chunks of each
+    round going to the B batches in a random order. The chunks of a pid are
+    consecutive and no more than B, so that they end up in different batches,
+    provided that a pid spanning two rounds is sent to batches of the second
+    round which it did not get in the first one.
+
+    Args:
+        rng (numpy.random.Generator): random generator.
+        chunk_pids (numpy.ndarray): pid index of each chunk.
+        ranks (numpy.ndarray): rank of each chunk among the chunks of its pid.
+        pid_keys (numpy.ndarray): random key of each pid index.
+        B (int): number of batches, such that sum(min(num_chunks, B)) >= N * B.
+        N (int): number of pids per batch.
+
+    Returns:
+        numpy.ndarray: (B, N) array of chunk positions.
+    """
+    keep = np.flatnonzero(ranks < B)
+    seq = keep[np.argsort(pid_keys[chunk_pids[keep]], kind='stable')[:B * N]]
+    seq_pids = chunk_pids[seq]
+
+    layout = np.empty((B, N), dtype=np.int64)
+    prev_perm = None
+    for j in range(N):
+        perm = rng.permutation(B)
+        start = j * B
+        if j > 0 and seq_pids[start - 1] == seq_pids[start]:
+            pid = seq_pids[start]
+            a = int((seq_pids[start - B:start] == pid).sum())
+            b = int((seq_pids[start:start + B] == pid).sum())
+            free = perm[~np.isin(perm, prev_perm[B - a:])]
+            perm = np.concatenate([free[:b], perm[~np.isin(perm, free[:b])]])
+        layout[perm, j] = seq[start:start + B]
+        prev_perm = perm
+    return layout
+
+
+def _max_num_batches(num_chunks, num_pids_per_batch):
+    """Returns the largest number of batches B of num_pids_per_batch different
+    pids, i.e. the largest B such that
+    sum(min(num_chunks, B)) >= num_pids_per_batch * B."""
+    low, high = 0, int(num_chunks.sum()) // num_pids_per_batch
+    while low < high:
+        mid = (low+high+1) // 2
+        if np.minimum(num_chunks, mid).sum() >= num_pids_per_batch * mid:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
 class RandomIdentitySampler(Sampler):
     """Randomly samples N identities each with K instances.
 
+    The images of each identity are shuffled and split into chunks of K images
+    (identities with less than K images are sampled with replacement), then the
+    chunks of an epoch are laid out into batches of N different identities. The
+    layout wraps the chunks of randomly ordered identities around the batches
+    (see ``_layout_batches``), which yields the largest possible number of batches, i.e.
+    the largest B such that sum over identities of min(num_chunks, B) >= N * B.
+    The length of an epoch is therefore exact and all the steps are vectorized.
+
     Args:
         data_source (list): contains tuples of (img_path(s), pid, camid, dsetid).
         batch_size (int): batch size.
         num_instances (int): number of instances per identity in a batch.
+        seed (int, optional): seed of the random generator. Default is None
+            (seeded from the global numpy random generator).
     """
 
-    def __init__(self, data_source, batch_size, num_instances):
+    def __init__(self, data_source, batch_size, num_instances, seed=None):
         if batch_size < num_instances:
             raise ValueError(
                 'batch_size={} must be no less '
@@ -31,175 +110,402 @@ class RandomIdentitySampler(Sampler):
         self.batch_size = batch_size
         self.num_instances = num_instances
         self.num_pids_per_batch = self.batch_size // self.num_instances
-        self.index_dic = defaultdict(list)
-        for index, items in enumerate(data_source):
-            pid = items[1]
-            self.index_dic[pid].append(index)
-        self.pids = list(self.index_dic.keys())
+
+        # image indices grouped by pid
+        pids = np.asarray([items[1] for items in data_source])
+        self.pids, self.pid_idxs, self.counts = np.unique(
+            pids, return_inverse=True, return_counts=True
+        )
+        self.order = np.argsort(self.pid_idxs, kind='stable')
+        self.starts = np.cumsum(self.counts) - self.counts
         assert len(self.pids) >= self.num_pids_per_batch
 
-        # estimate number of examples in an epoch
-        # TODO: improve precision
-        self.length = 0
-        for pid in self.pids:
-            idxs = self.index_dic[pid]
-            num = len(idxs)
-            if num < self.num_instances:
-                num = self.num_instances
-            self.length += num - num % self.num_instances
+        self.num_chunks = np.maximum(
+            self.counts, self.num_instances
+        ) // self.num_instances
+        self.num_batches = _max_num_batches(
+            self.num_chunks, self.num_pids_per_batch
+        )
+        self.length = self.num_batches * self.batch_size
+        self.rng = _make_rng(seed)
+
+    def _sample_chunks(self):
+        """Returns the (num_chunks, K) image indices of the chunks of an epoch,
+        along with the pid index and the rank of each chunk within its pid."""
+        rng = self.rng
+        K = self.num_instances
+
+        # shuffle the images of each pid
+        group = self.pid_idxs[self.order]
+        perm = np.lexsort((rng.random(len(self.order)), group))
+        idxs = self.order[perm]
+        pos = np.arange(len(idxs)) - self.starts[group]
+
+        # pids with at least K images: drop the last (num_images % K) images
+        keep = pos < self.num_chunks[group] * K
+        keep &= self.counts[group] >= K
+        chunks = idxs[keep].reshape(-1, K)
+        chunk_pids = group[keep][::K]
+
+        # pids with less than K images: sample K images with replacement
+        small = np.flatnonzero(self.counts < K)
+        offsets = (rng.random((len(small), K)) *
+                   self.counts[small, None]).astype(np.int64)
+        chunks = np.concatenate(
+            [chunks, self.order[self.starts[small, None] + offsets]]
+        )
+        chunk_pids = np.concatenate([chunk_pids, small])
+
+        order = np.argsort(chunk_pids, kind='stable')
+        chunks, chunk_pids = chunks[order], chunk_pids[order]
+        first = np.cumsum(self.num_chunks) - self.num_chunks
+        ranks = np.arange(len(chunk_pids)) - first[chunk_pids]
+        return chunks, chunk_pids, ranks
+
+    def _sample_batches(self):
+        """Returns the (num_batches, batch_size) image indices of an epoch."""
+        chunks, chunk_pids, ranks = self._sample_chunks()
+        pid_keys = self.rng.random(len(self.pids))
+        layout = _layout_batches(
+            self.rng, chunk_pids, ranks, pid_keys, self.num_batches,
+            self.num_pids_per_batch
+        )
+        return chunks[layout].reshape(
+            self.num_batches, self.num_pids_per_batch * self.num_instances
+        )
 
     def __iter__(self):
-        batch_idxs_dict = defaultdict(list)
-
-        for pid in self.pids:
-            idxs = copy.deepcopy(self.index_dic[pid])
-            if len(idxs) < self.num_instances:
-                idxs = np.random.choice(
-                    idxs, size=self.num_instances, replace=True
-                )
-            random.shuffle(idxs)
-            batch_idxs = []
-            for idx in idxs:
-                batch_idxs.append(idx)
-                if len(batch_idxs) == self.num_instances:
-                    batch_idxs_dict[pid].append(batch_idxs)
-                    batch_idxs = []
-
-        avai_pids = copy.deepcopy(self.pids)
-        final_idxs = []
-
-        while len(avai_pids) >= self.num_pids_per_batch:
-            selected_pids = random.sample(avai_pids, self.num_pids_per_batch)
-            for pid in selected_pids:
-                batch_idxs = batch_idxs_dict[pid].pop(0)
-                final_idxs.extend(batch_idxs)
-                if len(batch_idxs_dict[pid]) == 0:
-                    avai_pids.remove(pid)
-
-        return iter(final_idxs)
+        return iter(self._sample_batches().ravel().tolist())
 
     def __len__(self):
         return self.length
 
 
-class RandomDomainSampler(Sampler):
-    """Random domain sampler.
-
-    We consider each camera as a visual domain.
+class DistributedRandomIdentitySampler(RandomIdentitySampler):
+    """Randomly samples N identities each with K instances, for each process of
+    distributed training.
 
-    How does the sampling work:
-    1. Randomly sample N cameras (based on the "camid" label).
-    2. From each camera, randomly sample K images.
+    All the processes lay out the same batches of N x num_replicas different
+    identities, as ``RandomIdentitySampler`` does, and each process takes its
+    slice of N whole groups of K images. A step of distributed training thus
+    sees N x num_replicas different identities, without repetition across
+    processes.
 
     Args:
         data_source (list): contains tuples of (img_path(s), pid, camid, dsetid).
-        batch_size (int): batch size.
-        n_domain (int): number of cameras to sample in a batch.
+        batch_size (int): batch size of a process.
+        num_instances (int): number of instances per identity in a batch.
+        num_replicas (int, optional): number of processes. Default is None
+            (the world size of the default process group).
+        rank (int, optional): rank of the current process. Default is None (the
+            rank in the default process group).
+        seed (int, optional): seed of the random generator, which must be the
+            same in all the processes. Default is None (seeded from the global
+            numpy random generator of the main process).
     """
 
-    def __init__(self, data_source, batch_size, n_domain):
-        self.data_source = data_source
-
-        # Keep track of image indices for each domain
-        self.domain_dict = defaultdict(list)
-        for i, items in enumerate(data_source):
-            camid = items[2]
-            self.domain_dict[camid].append(i)
-        self.domains = list(self.domain_dict.keys())
-
-        # Make sure each domain can be assigned an equal number of images
-        if n_domain is None or n_domain <= 0:
-            n_domain = len(self.domains)
-        assert batch_size % n_domain == 0
-        self.n_img_per_domain = batch_size // n_domain
-
-        self.batch_size = batch_size
-        self.n_domain = n_domain
-        self.length = len(list(self.__iter__()))
+    def __init__(
+        self,
+        data_source,
+        batch_size,
+        num_instances,
+        num_replicas=None,
+        rank=None,
+        seed=None
+    ):
+        if batch_size % num_instances != 0:
+            raise ValueError(
+                'batch_size={} must be a multiple of num_instances={}'.format(
+                    batch_size, num_instances
+                )
+            )
+        if num_replicas is None:
+            num_replicas = get_world_size()
+        if rank is None:
+            rank = get_rank()
+        if seed is None:
+            seed = broadcast_object(int(np.random.randint(2**31)))
+        super(DistributedRandomIdentitySampler, self).__init__(
+            data_source, batch_size * num_replicas, num_instances, seed=seed
+        )
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.local_batch_size = batch_size
+        self.length = self.num_batches * batch_size
 
     def __iter__(self):
-        domain_dict = copy.deepcopy(self.domain_dict)
-        final_idxs = []
-        stop_sampling = False
+        batches = self._sample_batches().reshape(
+            self.num_batches, self.num_replicas, self.local_batch_size
+        )
+        return iter(batches[:, self.rank].ravel().tolist())
 
-        while not stop_sampling:
-            selected_domains = random.sample(self.domains, self.n_domain)
 
-            for domain in selected_domains:
-                idxs = domain_dict[domain]
-                selected_idxs = random.sample(idxs, self.n_img_per_domain)
-                final_idxs.extend(selected_idxs)
+class DistributedShardSampler(Sampler):
+    """Samples a contiguous shard of the dataset for each process, in order, e.g.
+    to extract the features of a test set in parallel. Concatenating the shards
+    in rank order gives back the whole dataset, in order.
 
-                for idx in selected_idxs:
-                    domain_dict[domain].remove(idx)
+    Args:
+        data_source (Dataset): dataset.
+        num_replicas (int, optional): number of processes. Default is None
+            (the world size of the default process group).
+        rank (int, optional): rank of the current process. Default is None (the
+            rank in the default process group).
+    """
 
-                remaining = len(domain_dict[domain])
-                if remaining < self.n_img_per_domain:
-                    stop_sampling = True
+    def __init__(self, data_source, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = get_world_size()
+        if rank is None:
+            rank = get_rank()
+        n = len(data_source)
+        self.start = rank * n // num_replicas
+        self.end = (rank+1) * n // num_replicas
 
-        return iter(final_idxs)
+    def __iter__(self):
+        return iter(range(self.start, self.end))
 
     def __len__(self):
-        return self.length
+        return self.end - self.start
 
 
-class RandomDatasetSampler(Sampler):
-    """Random dataset sampler.
+class RandomActionIdentitySampler(RandomIdentitySampler):
+    """Randomly samples N identities of the same action each with K instances.
 
-    How does the sampling work:
-    1. Randomly sample N datasets (based on the "dsetid" label).
-    2. From each dataset, randomly sample K images.
+    SoccerNet identities are local to an action (whose index is stored in the
+    camid slot), so that the negatives of a batch built by
+    ``RandomIdentitySampler`` almost never come from the same action. This
+    sampler builds the batches of each action from its own identities instead.
+    Consecutive actions with less than N identities are grouped into blocks of
+    at least N identities, the batches of a block being laid out as in
+    ``RandomIdentitySampler``. The batches of all the blocks are then shuffled.
 
     Args:
         data_source (list): contains tuples of (img_path(s), pid, camid, dsetid).
         batch_size (int): batch size.
-        n_dataset (int): number of datasets to sample in a batch.
+        num_instances (int): number of instances per identity in a batch.
+        seed (int, optional): seed of the random generator. Default is None
+            (seeded from the global numpy random generator).
     """
 
-    def __init__(self, data_source, batch_size, n_dataset):
+    def __init__(self, data_source, batch_size, num_instances, seed=None):
+        super(RandomActionIdentitySampler, self).__init__(
+            data_source, batch_size, num_instances, seed=seed
+        )
+        N = self.num_pids_per_batch
+
+        # action -> pids index, pids -> image indices being self.order/self.starts
+        actions = np.asarray([items[2] for items in data_source])
+        pid_actions = actions[self.order[self.starts]]
+        if (actions[self.order] != np.repeat(pid_actions, self.counts)).any():
+            raise ValueError(
+                'RandomActionIdentitySampler requires each identity to belong '
+                'to a single action (camid)'
+            )
+        self.actions, pid_action_idxs, pids_per_action = np.unique(
+            pid_actions, return_inverse=True, return_counts=True
+        )
+        self.action_pids = np.argsort(pid_action_idxs, kind='stable')
+        self.action_starts = np.cumsum(pids_per_action) - pids_per_action
+
+        # blocks of consecutive actions with at least N identities, the last
+        # one being merged with the previous block if it has less
+        action_blocks = np.empty(len(self.actions), dtype=np.int64)
+        block, num = 0, 0
+        for a, num_pids in enumerate(pids_per_action):
+            action_blocks[a] = block
+            num += num_pids
+            if num >= N:
+                block, num = block + 1, 0
+        if num > 0 and block > 0:
+            action_blocks[action_blocks == block] = block - 1
+        self.pid_blocks = action_blocks[pid_action_idxs]
+        num_blocks = int(action_blocks.max()) + 1 if len(action_blocks) else 0
+
+        pids_by_block = np.argsort(self.pid_blocks, kind='stable')
+        block_sizes = np.bincount(self.pid_blocks, minlength=num_blocks)
+        self.block_num_batches = np.array(
+            [
+                _max_num_batches(self.num_chunks[pids], N)
+                for pids in np.split(pids_by_block, np.cumsum(block_sizes)[:-1])
+            ],
+            dtype=np.int64
+        )
+        self.num_batches = int(self.block_num_batches.sum())
+        self.length = self.num_batches * self.batch_size
+
+    def _sample_batches(self):
+        rng = self.rng
+        chunks, chunk_pids, ranks = self._sample_chunks()
+        pid_keys = rng.random(len(self.pids))
+
+        chunk_blocks = self.pid_blocks[chunk_pids]
+        by_block = np.argsort(chunk_blocks, kind='stable')
+        block_ends = np.cumsum(
+            np.bincount(chunk_blocks, minlength=len(self.block_num_batches))
+        )
+        block_starts = np.concatenate([[0], block_ends[:-1]])
+
+        batches = [np.empty((0, self.num_pids_per_batch), dtype=np.int64)]
+        for block in np.flatnonzero(self.block_num_batches):
+            sel = by_block[block_starts[block]:block_ends[block]]
+            layout = _layout_batches(
+                rng, chunk_pids[sel], ranks[sel], pid_keys,
+                self.block_num_batches[block], self.num_pids_per_batch
+            )
+            batches.append(sel[layout])
+        batches = np.concatenate(batches)
+        batches = batches[rng.permutation(len(batches))]
+        return chunks[batches].reshape(
+            self.num_batches, self.num_pids_per_batch * self.num_instances
+        )
+
+
+def _sample_distinct(rng, num_rows, num_values, k):
+    """Returns a (num_rows, k) array whose rows are k distinct values uniformly
+    sampled in [0, num_values)."""
+    if num_rows * num_values <= 2**24:
+        keys = rng.random((num_rows, num_values))
+        return np.argsort(keys, axis=1)[:, :k]
+    # rejection sampling, efficient when k is much smaller than num_values
+    rows = rng.integers(0, num_values, size=(num_rows, k))
+    while True:
+        sorted_rows = np.sort(rows, axis=1)
+        redo = (sorted_rows[:, 1:] == sorted_rows[:, :-1]).any(axis=1)
+        if not redo.any():
+            return rows
+        rows[redo] = rng.integers(0, num_values, size=(int(redo.sum()), k))
+
+
+class _RandomGroupSampler(Sampler):
+    """Base class of samplers that draw N groups (e.g. cameras or datasets) per
+    batch and K images from each group.
+
+    The images of each group are shuffled once per epoch and consumed in order,
+    by chunks of K images. A group whose chunks are all used is shuffled again
+    and reused, so that the number of batches of an epoch is set analytically to
+    the total number of chunks divided by N.
+    """
+
+    def __init__(self, data_source, batch_size, n_group, label_pos, seed=None):
         self.data_source = data_source
 
-        # Keep track of image indices for each dataset
-        self.dataset_dict = defaultdict(list)
-        for i, items in enumerate(data_source):
-            dsetid = items[3]
-            self.dataset_dict[dsetid].append(i)
-        self.datasets = list(self.dataset_dict.keys())
+        labels = np.asarray([items[label_pos] for items in data_source])
+        self.groups, group_idxs, self.counts = np.unique(
+            labels, return_inverse=True, return_counts=True
+        )
+        self.order = np.argsort(group_idxs, kind='stable')
+        self.starts = np.cumsum(self.counts) - self.counts
 
-        # Make sure each dataset can be assigned an equal number of images
-        if n_dataset is None or n_dataset <= 0:
-            n_dataset = len(self.datasets)
-        assert batch_size % n_dataset == 0
-        self.n_img_per_dset = batch_size // n_dataset
+        # Make sure each group can be assigned an equal number of images
+        if n_group is None or n_group <= 0:
+            n_group = len(self.groups)
+        assert batch_size % n_group == 0
+        assert n_group <= len(self.groups)
+        self.n_img_per_group = batch_size // n_group
 
         self.batch_size = batch_size
-        self.n_dataset = n_dataset
-        self.length = len(list(self.__iter__()))
+        self.n_group = n_group
+        self.num_batches = int(
+            (self.counts // self.n_img_per_group).sum()
+        ) // self.n_group
+        self.length = self.num_batches * self.batch_size
+        self.rng = _make_rng(seed)
 
     def __iter__(self):
-        dataset_dict = copy.deepcopy(self.dataset_dict)
-        final_idxs = []
-        stop_sampling = False
+        rng = self.rng
+        k = self.n_img_per_group
+        selected = _sample_distinct(
+            rng, self.num_batches, len(self.groups), self.n_group
+        ).ravel()
+
+        # rank of each selection among the selections of its group
+        by_group = np.argsort(selected, kind='stable')
+        num_selected = np.bincount(selected, minlength=len(self.groups))
+        ranks = np.empty_like(selected)
+        ranks[by_group] = np.arange(len(selected)) - np.repeat(
+            np.cumsum(num_selected) - num_selected, num_selected
+        )
+
+        # each round of a group is a shuffle of its images cut into chunks of K
+        # images (sampled with replacement if the group has less than K images)
+        chunks_per_round = np.maximum(self.counts // k, 1)
+        num_rounds = -(-num_selected // chunks_per_round)
+        stream_lengths = num_rounds * chunks_per_round * k
+        firsts = np.cumsum(stream_lengths) - stream_lengths
+        streams = [np.empty(0, dtype=np.int64)]
+        for g in np.flatnonzero(num_rounds):
+            idxs = self.order[self.starts[g]:self.starts[g] + self.counts[g]]
+            for _ in range(num_rounds[g]):
+                if len(idxs) < k:
+                    streams.append(rng.choice(idxs, size=k))
+                else:
+                    streams.append(
+                        rng.permutation(idxs)[:chunks_per_round[g] * k]
+                    )
+        streams = np.concatenate(streams)
+
+        positions = firsts[selected, None] + ranks[:, None] * k + np.arange(k)
+        return iter(streams[positions].ravel().tolist())
 
-        while not stop_sampling:
-            selected_datasets = random.sample(self.datasets, self.n_dataset)
+    def __len__(self):
+        return self.length
 
-            for dset in selected_datasets:
-                idxs = dataset_dict[dset]
-                selected_idxs = random.sample(idxs, self.n_img_per_dset)
-                final_idxs.extend(selected_idxs)
 
-                for idx in selected_idxs:
-                    dataset_dict[dset].remove(idx)
+class RandomDomainSampler(_RandomGroupSampler):
+    """Random domain sampler.
 
-                remaining = len(dataset_dict[dset])
-                if remaining < self.n_img_per_dset:
-                    stop_sampling = True
+    We consider each camera as a visual domain.
 
-        return iter(final_idxs)
+    How does the sampling work:
+    1. Randomly sample N cameras (based on the "camid" label).
+    2. From each camera, randomly sample K images.
 
-    def __len__(self):
-        return self.length
+    The images of each camera are shuffled once per epoch and consumed in order,
+    and are reshuffled when they are all used (see ``_RandomGroupSampler``).
+
+    Args:
+        data_source (list): contains tuples of (img_path(s), pid, camid, dsetid).
+        batch_size (int): batch size.
+        n_domain (int): number of cameras to sample in a batch.
+        seed (int, optional): seed of the random generator. Default is None
+            (seeded from the global numpy random generator).
+    """
+
+    def __init__(self, data_source, batch_size, n_domain, seed=None):
+        super(RandomDomainSampler, self).__init__(
+            data_source, batch_size, n_domain, label_pos=2, seed=seed
+        )
+        self.domains = self.groups
+        self.n_domain = self.n_group
+        self.n_img_per_domain = self.n_img_per_group
+
+
+class RandomDatasetSampler(_RandomGroupSampler):
+    """Random dataset sampler.
+
+    How does the sampling work:
+    1. Randomly sample N datasets (based on the "dsetid" label).
+    2. From each dataset, randomly sample K images.
+
+    The images of each dataset are shuffled once per epoch and consumed in order,
+    and are reshuffled when they are all used (see ``_RandomGroupSampler``).
+
+    Args:
+        data_source (list): contains tuples of (img_path(s), pid, camid, dsetid).
+        batch_size (int): batch size.
+        n_dataset (int): number of datasets to sample in a batch.
+        seed (int, optional): seed of the random generator. Default is None
+            (seeded from the global numpy random generator).
+    """
+
+    def __init__(self, data_source, batch_size, n_dataset, seed=None):
+        super(RandomDatasetSampler, self).__init__(
+            data_source, batch_size, n_dataset, label_pos=3, seed=seed
+        )
+        self.datasets = self.groups
+        self.n_dataset = self.n_group
+        self.n_img_per_dset = self.n_img_per_group
 
 
 def build_train_sampler(
@@ -209,6 +515,8 @@ def build_train_sampler(
     num_instances=4,
     num_cams=1,
     num_datasets=1,
+    seed=None,
+    distributed=False,
     **kwargs
 ):
     """Builds a training sampler.
@@ -218,23 +526,61 @@ def build_train_sampler(
         train_sampler (str): sampler name (default: ``RandomSampler``).
         batch_size (int, optional): batch size. Default is 32.
         num_instances (int, optional): number of instances per identity in a
-            batch (when using ``RandomIdentitySampler``). Default is 4.
+            batch (when using ``RandomIdentitySampler`` or
+            ``RandomActionIdentitySampler``). Default is 4.
         num_cams (int, optional): number of cameras to sample in a batch (when using
             ``RandomDomainSampler``). Default is 1.
         num_datasets (int, optional): number of datasets to sample in a batch (when
             using ``RandomDatasetSampler``). Default is 1.
+        seed (int, optional): seed of the random generator of ``RandomIdentitySampler``,
+            ``RandomActionIdentitySampler``, ``RandomDomainSampler`` and ``RandomDatasetSampler``. Default is None (seeded
+            from the global numpy random generator).
+        distributed (bool, optional): builds the sampler of the current process of distributed training,
+            ``batch_size`` being the batch size of a process. Only ``RandomIdentitySampler``
+            (see ``DistributedRandomIdentitySampler``), ``RandomSampler`` and ``SequentialSampler`` are
+            supported. Default is False.
     """
     assert train_sampler in AVAI_SAMPLERS, \
         'train_sampler must be one of {}, but got {}'.format(AVAI_SAMPLERS, train_sampler)
 
+    if distributed:
+        if train_sampler not in DISTRIBUTED_SAMPLERS:
+            raise ValueError(
+                'Distributed training supports train_sampler in {}, '
+                'but got {}'.format(DISTRIBUTED_SAMPLERS, train_sampler)
+            )
+        if train_sampler == 'RandomIdentitySampler':
+            return DistributedRandomIdentitySampler(
+                data_source, batch_size, num_instances, seed=seed
+            )
+        if seed is None:
+            seed = broadcast_object(int(np.random.randint(2**31)))
+        # the order is drawn again at each epoch by Engine.train, see set_epoch
+        return DistributedSampler(
+            data_source,
+            shuffle=(train_sampler == 'RandomSampler'),
+            seed=seed
+        )
+
     if train_sampler == 'RandomIdentitySampler':
-        sampler = RandomIdentitySampler(data_source, batch_size, num_instances)
+        sampler = RandomIdentitySampler(
+            data_source, batch_size, num_instances, seed=seed
+        )
+
+    elif train_sampler == 'RandomActionIdentitySampler':
+        sampler = RandomActionIdentitySampler(
+            data_source, batch_size, num_instances, seed=seed
+        )
 
     elif train_sampler == 'RandomDomainSampler':
-        sampler = RandomDomainSampler(data_source, batch_size, num_cams)
+        sampler = RandomDomainSampler(
+            data_source, batch_size, num_cams, seed=seed
+        )
 
     elif train_sampler == 'RandomDatasetSampler':
-        sampler = RandomDatasetSampler(data_source, batch_size, num_datasets)
+        sampler = RandomDatasetSampler(
+            data_source, batch_size, num_datasets, seed=seed
+        )
 
     elif train_sampler == 'SequentialSampler':
         sampler = SequentialSampler(data_source)
@@ -0,0 +1,184 @@
+from __future__ import division, print_function, absolute_import
+import io
+import os
+import mmap
+import shutil
+import os.path as osp
+import tempfile
+import numpy as np
+from PIL import Image
+
+__all__ = ['pack_images', 'load_pack_index', 'PackedImageReader']
+
+PACK_VERSION = 1
+
+
+def pack_images(
+    img_paths, pack_dir, metadata=None, signature='', shard_size=1024**3
+):
+    """Packs image files into a few large shard files.
+
+    The encoded bytes of the images are concatenated, in order, into shard
+    files "shard-<index>.bin" of about ``shard_size`` bytes, and an "index.npz"
+    file holds the shard, offset and length of each image along with the given
+    metadata arrays. The pack is written to a temporary directory which is then
+    renamed, so that an interrupted run never leaves a partial pack behind.
+
+    Args:
+        img_paths (list): paths of the image files.
+        pack_dir (str): output directory, replaced if it exists.
+        metadata (dict, optional): 1-D arrays of length ``len(img_paths)``
+            stored in the index, e.g. relative paths and annotations.
+        signature (str, optional): signature of the source files, stored in
+            the index to detect stale packs.
+        shard_size (int, optional): maximum number of bytes of a shard, unless
+            a single image is larger. Default is 1GB.
+    """
+    pack_dir = osp.normpath(pack_dir)
+    num_images = len(img_paths)
+    shard = np.zeros(num_images, dtype=np.int32)
+    offset = np.zeros(num_images, dtype=np.int64)
+    length = np.zeros(num_images, dtype=np.int64)
+
+    tmp_dir = tempfile.mkdtemp(
+        dir=osp.dirname(pack_dir), prefix='.tmp_' + osp.basename(pack_dir)
+    )
+    try:
+        f, shard_idx, pos = None, -1, 0
+        for i, img_path in enumerate(img_paths):
+            with open(img_path, 'rb') as img_file:
+                data = img_file.read()
+            if f is None or (pos > 0 and pos + len(data) > shard_size):
+                if f is not None:
+                    f.close()
+                shard_idx += 1
+                pos = 0
+                f = open(
+                    osp.join(tmp_dir, 'shard-{:05d}.bin'.format(shard_idx)),
+                    'wb'
+                )
+            f.write(data)
+            shard[i], offset[i], length[i] = shard_idx, pos, len(data)
+            pos += len(data)
+        if f is not None:
+            f.close()
+
+        np.savez(
+            osp.join(tmp_dir, 'index.npz'),
+            shard=shard,
+            offset=offset,
+            length=length,
+            num_shards=shard_idx + 1,
+            signature=signature,
+            version=PACK_VERSION,
+            **(metadata or {})
+        )
+        if osp.isdir(pack_dir):
+            shutil.rmtree(pack_dir)
+        os.rename(tmp_dir, pack_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def load_pack_index(pack_dir):
+    """Loads the index of a pack (see ``pack_images``).
+
+    Returns:
+        dict: arrays of the index, or None if the pack is missing or was written
+        by another version.
+    """
+    index_path = osp.join(pack_dir, 'index.npz')
+    if not osp.isfile(index_path):
+        return None
+    with np.load(index_path) as f:
+        if int(f['version']) != PACK_VERSION:
+            return None
+        return {key: f[key] for key in f.files}
+
+
+class PackedImageReader(object):
+    """Reads images from packs (see ``pack_images``) by memory-mapping their
+    shard files.
+
+    Images are looked up by path, so that datasets keep their usual
+    (img_path, pid, camid, dsetid) samples. Shard files are mapped lazily in each
+    process, e.g. in each DataLoader worker.
+
+    Examples::
+        >>> reader = PackedImageReader()
+        >>> reader.add_pack('reid/train.pack', img_paths)
+        >>> img = reader(img_paths[0])
+    """
+
+    def __init__(self):
+        self.packs = []
+        self.locations = {}
+        self._shards = {}
+
+    def add_pack(self, pack_dir, img_paths, index=None):
+        """Registers the images of a pack.
+
+        Args:
+            pack_dir (str): pack directory.
+            img_paths (list): paths under which the images of the pack are read,
+                in pack order.
+            index (dict, optional): pack index, loaded if not given.
+        """
+        if index is None:
+            index = load_pack_index(pack_dir)
+        assert len(img_paths) == len(index['offset'])
+        pack_idx = len(self.packs)
+        self.packs.append(pack_dir)
+        locations = zip(
+            index['shard'].tolist(), index['offset'].tolist(),
+            index['length'].tolist()
+        )
+        for img_path, (shard, offset, length) in zip(img_paths, locations):
+            self.locations[img_path] = (pack_idx, shard, offset, length)
+
+    def __add__(self, other):
+        reader = PackedImageReader()
+        for src in (self, other):
+            if src is None:
+                continue
+            for img_path, (pack_idx, shard, offset, length) in \
+                    src.locations.items():
+                reader.locations[img_path] = (
+                    pack_idx + len(reader.packs), shard, offset, length
+                )
+            reader.packs += src.packs
+        return reader
+
+    def __contains__(self, img_path):
+        return img_path in self.locations
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def _get_shard(self, pack_idx, shard):
+        key = (pack_idx, shard)
+        if key not in self._shards:
+            fpath = osp.join(
+                self.packs[pack_idx], 'shard-{:05d}.bin'.format(shard)
+            )
+            with open(fpath, 'rb') as f:
+                self._shards[key] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                )
+        return self._shards[key]
+
+    def read_bytes(self, img_path):
+        """Returns the encoded bytes of an image."""
+        pack_idx, shard, offset, length = self.locations[img_path]
+        return self._get_shard(pack_idx, shard)[offset:offset + length]
+
+    def __call__(self, img_path):
+        """Reads an image, as ``torchreid.utils.read_image`` does.
+
+        Returns:
+            PIL image
+        """
+        return Image.open(io.BytesIO(self.read_bytes(img_path))).convert('RGB')
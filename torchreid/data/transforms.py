@@ -4,8 +4,10 @@ import random
 from collections import deque
 import torch
 from PIL import Image
+from torch.nn import functional as F
 from torchvision.transforms import (
-    Resize, Compose, ToTensor, Normalize, ColorJitter, RandomHorizontalFlip
+    Resize, Compose, ToTensor, Normalize, PILToTensor, ColorJitter,
+    ConvertImageDtype, RandomHorizontalFlip
 )
 
 
@@ -230,6 +232,403 @@ class RandomPatch(object):
         return img
 
 
+class BatchToFloat(object):
+    """Converts a batch of uint8 images of shape (B, C, H, W) to float
+    images of range [0, 1]."""
+
+    def __call__(self, imgs):
+        return imgs.float().div_(255)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+
+class BatchRandomHorizontalFlip(object):
+    """Horizontally flips each image of a batch with a probability.
+
+    Args:
+        p (float, optional): probability that an image is flipped.
+            Default is 0.5.
+    """
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgs):
+        flip = torch.rand(imgs.size(0), device=imgs.device) < self.p
+        return torch.where(flip.view(-1, 1, 1, 1), imgs.flip(3), imgs)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(p={})'.format(self.p)
+
+
+class BatchRandom2DTranslation(object):
+    """Randomly translates each image of a batch with a probability, as
+    ``Random2DTranslation`` does: the selected images are resized with a factor
+    of 1.125, then randomly cropped back to (height, width).
+
+    Args:
+        height (int): image height.
+        width (int): image width.
+        p (float, optional): probability that an image is translated.
+            Default is 0.5.
+    """
+
+    def __init__(self, height, width, p=0.5):
+        self.height = height
+        self.width = width
+        self.p = p
+
+    def __call__(self, imgs):
+        device = imgs.device
+        idx = (torch.rand(imgs.size(0), device=device) <
+               self.p).nonzero().squeeze(1)
+        if idx.numel() == 0:
+            return imgs
+
+        new_height = int(round(self.height * 1.125))
+        new_width = int(round(self.width * 1.125))
+        resized = F.interpolate(
+            imgs[idx],
+            size=(new_height, new_width),
+            mode='bilinear',
+            align_corners=False
+        )
+        n = idx.numel()
+        y1 = (torch.rand(n, device=device) *
+              (new_height - self.height)).round().long()
+        x1 = (torch.rand(n, device=device) *
+              (new_width - self.width)).round().long()
+        rows = y1.unsqueeze(1) + torch.arange(self.height, device=device)
+        cols = x1.unsqueeze(1) + torch.arange(self.width, device=device)
+        # crops of shape (n, height, width, C)
+        crops = resized[torch.arange(n, device=device).view(-1, 1, 1), :,
+                        rows.unsqueeze(2),
+                        cols.unsqueeze(1)]
+        return imgs.index_copy(0, idx, crops.permute(0, 3, 1, 2))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(size=({}, {}), p={})'.format(
+            self.height, self.width, self.p
+        )
+
+
+class BatchColorJitter(object):
+    """Randomly changes the brightness and contrast of each image of a batch
+    of float images of range [0, 1], as ``torchvision.transforms.ColorJitter``
+    does (with a fixed order).
+
+    Args:
+        brightness (float, optional): brightness factors are uniformly chosen in
+            [1 - brightness, 1 + brightness]. Default is 0.
+        contrast (float, optional): contrast factors are uniformly chosen in
+            [1 - contrast, 1 + contrast]. Default is 0.
+    """
+
+    def __init__(self, brightness=0, contrast=0):
+        self.brightness = brightness
+        self.contrast = contrast
+
+    def _factors(self, imgs, value):
+        factors = torch.empty(imgs.size(0), 1, 1, 1, device=imgs.device)
+        return factors.uniform_(max(0, 1 - value), 1 + value)
+
+    def __call__(self, imgs):
+        if self.brightness > 0:
+            imgs = (imgs * self._factors(imgs, self.brightness)).clamp_(0, 1)
+        if self.contrast > 0:
+            gray = 0.299 * imgs[:, 0] + 0.587 * imgs[:, 1] + 0.114 * imgs[:, 2]
+            mean = gray.mean(dim=(1, 2)).view(-1, 1, 1, 1)
+            factors = self._factors(imgs, self.contrast)
+            imgs = (factors*imgs + (1-factors) * mean).clamp_(0, 1)
+        return imgs
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(brightness={}, contrast={})'.format(
+            self.brightness, self.contrast
+        )
+
+
+class BatchNormalize(object):
+    """Normalizes a batch of images of shape (B, C, H, W) with channel-wise
+    mean and standard deviation.
+
+    Args:
+        mean (list): channel means.
+        std (list): channel standard deviations.
+    """
+
+    def __init__(self, mean, std):
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, imgs):
+        mean = torch.as_tensor(self.mean, device=imgs.device).view(1, -1, 1, 1)
+        std = torch.as_tensor(self.std, device=imgs.device).view(1, -1, 1, 1)
+        return (imgs-mean) / std
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(mean={}, std={})'.format(
+            self.mean, self.std
+        )
+
+
+def _sample_boxes(
+    n, height, width, min_area, max_area, min_ratio, max_ratio, device,
+    attempts=100
+):
+    """Samples a random box in each of n images of size (height, width), as
+    ``RandomErasing`` and ``RandomPatch`` do: for each image, the first of
+    ``attempts`` random (area, aspect ratio) candidates which fits in the image
+    is kept, then its position is uniformly chosen.
+
+    Returns:
+        tuple: (found, y1, x1, h, w), 1-D tensors of length n. Boxes of images
+        without a fitting candidate (found is False) are empty.
+    """
+    area = torch.empty(n, attempts, device=device)
+    area.uniform_(min_area, max_area).mul_(height * width)
+    ratio = torch.empty(n, attempts, device=device).uniform_(min_ratio, max_ratio)
+    h = (area * ratio).sqrt_().round_().long()
+    w = (area / ratio).sqrt_().round_().long()
+    valid = (h < height) & (w < width)
+    found = valid.any(dim=1)
+    first = valid.int().argmax(dim=1, keepdim=True)
+    h = h.gather(1, first).squeeze(1) * found
+    w = w.gather(1, first).squeeze(1) * found
+    y1 = (torch.rand(n, device=device) * (height-h+1)).long()
+    x1 = (torch.rand(n, device=device) * (width-w+1)).long()
+    return found, y1, x1, h, w
+
+
+def _box_masks(y1, x1, h, w, height, width):
+    """Returns the (n, height, width) boolean masks of n boxes."""
+    rows = torch.arange(height, device=y1.device)
+    cols = torch.arange(width, device=y1.device)
+    in_rows = (rows >= y1.unsqueeze(1)) & (rows < (y1 + h).unsqueeze(1))
+    in_cols = (cols >= x1.unsqueeze(1)) & (cols < (x1 + w).unsqueeze(1))
+    return in_rows.unsqueeze(2) & in_cols.unsqueeze(1)
+
+
+class BatchRandomErasing(object):
+    """Randomly erases a patch of each image of a batch, as ``RandomErasing``
+    does.
+
+    The erased boxes of all the images are sampled at once and written with a
+    single masked write. Accepts a batch of shape (B, C, H, W) or a single image
+    of shape (C, H, W).
+
+    Args:
+        probability (float, optional): probability that an image is erased.
+            Default is 0.5.
+        sl (float, optional): min erasing area.
+        sh (float, optional): max erasing area.
+        r1 (float, optional): min aspect ratio.
+        mean (list, optional): erasing value.
+    """
+
+    def __init__(
+        self,
+        probability=0.5,
+        sl=0.02,
+        sh=0.4,
+        r1=0.3,
+        mean=[0.4914, 0.4822, 0.4465]
+    ):
+        self.probability = probability
+        self.mean = mean
+        self.sl = sl
+        self.sh = sh
+        self.r1 = r1
+
+    def __call__(self, imgs):
+        if imgs.dim() == 3:
+            return self(imgs.unsqueeze(0)).squeeze(0)
+
+        B, C, H, W = imgs.size()
+        device = imgs.device
+        found, y1, x1, h, w = _sample_boxes(
+            B, H, W, self.sl, self.sh, self.r1, 1 / self.r1, device
+        )
+        happen = found & (torch.rand(B, device=device) <= self.probability)
+        masks = _box_masks(y1, x1, h, w, H, W) & happen.view(-1, 1, 1)
+        mean = torch.as_tensor(
+            self.mean[:C], dtype=imgs.dtype, device=device
+        ).view(1, C, 1, 1)
+        return torch.where(masks.unsqueeze(1), mean, imgs)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(probability={}, mean={})'.format(
+            self.probability, self.mean
+        )
+
+
+class BatchRandomPatch(object):
+    """Random patch data augmentation applied to a batch of images, as
+    ``RandomPatch`` does.
+
+    The patch pool is a preallocated ring buffer of shape
+    (pool_capacity, C, H, W) on the device of the images, in which each patch is
+    stored in the top-left corner of its slot. For each batch, a patch is
+    extracted from every image and stored in the pool, then randomly selected
+    patches are flipped, rotated (with nearest neighbor sampling and a black
+    fill, like ``PIL.Image.rotate``) and pasted on the images with a single
+    masked write. Accepts a batch of shape (B, C, H, W) or a single image of
+    shape (C, H, W).
+
+    Args:
+        pool_capacity (int, optional): number of patches of the pool. It is
+            smaller than for ``RandomPatch`` as every patch takes a full image
+            slot. Default is 2048.
+
+    See ``RandomPatch`` for the other arguments.
+    """
+
+    def __init__(
+        self,
+        prob_happen=0.5,
+        pool_capacity=2048,
+        min_sample_size=100,
+        patch_min_area=0.01,
+        patch_max_area=0.5,
+        patch_min_ratio=0.1,
+        prob_rotate=0.5,
+        prob_flip_leftright=0.5,
+    ):
+        self.prob_happen = prob_happen
+
+        self.patch_min_area = patch_min_area
+        self.patch_max_area = patch_max_area
+        self.patch_min_ratio = patch_min_ratio
+
+        self.prob_rotate = prob_rotate
+        self.prob_flip_leftright = prob_flip_leftright
+
+        self.pool_capacity = pool_capacity
+        self.min_sample_size = min_sample_size
+        self.pool = None
+        self.pool_h = None
+        self.pool_w = None
+        self.pool_size = 0
+        self.pool_next = 0
+
+    def _grid(self, B, H, W, device):
+        rows = torch.arange(H, device=device).view(1, H, 1).expand(B, H, W)
+        cols = torch.arange(W, device=device).view(1, 1, W).expand(B, H, W)
+        return rows, cols
+
+    def _gather(self, src, rows, cols):
+        # src[b, :, rows[b], cols[b]] as a (B, C, H, W) tensor
+        batch = torch.arange(src.size(0), device=src.device).view(-1, 1, 1)
+        return src[batch, :, rows, cols].permute(0, 3, 1, 2)
+
+    def collect(self, imgs):
+        """Extracts a random patch from each image and stores it in the pool."""
+        B, C, H, W = imgs.size()
+        device = imgs.device
+        if self.pool is None or self.pool.shape[1:] != imgs.shape[1:] or \
+                self.pool.device != device:
+            self.pool = imgs.new_zeros(self.pool_capacity, C, H, W)
+            self.pool_h = torch.zeros(
+                self.pool_capacity, dtype=torch.long, device=device
+            )
+            self.pool_w = torch.zeros_like(self.pool_h)
+            self.pool_size = 0
+            self.pool_next = 0
+
+        found, y1, x1, h, w = _sample_boxes(
+            B, H, W, self.patch_min_area, self.patch_max_area,
+            self.patch_min_ratio, 1. / self.patch_min_ratio, device
+        )
+        idx = found.nonzero().squeeze(1)[-self.pool_capacity:]
+        n = idx.numel()
+        if n == 0:
+            return
+
+        rows, cols = self._grid(n, H, W, device)
+        rows = (rows + y1[idx].view(-1, 1, 1)).clamp_(max=H - 1)
+        cols = (cols + x1[idx].view(-1, 1, 1)).clamp_(max=W - 1)
+        slots = (self.pool_next +
+                 torch.arange(n, device=device)) % self.pool_capacity
+        self.pool[slots] = self._gather(imgs[idx], rows, cols)
+        self.pool_h[slots] = h[idx]
+        self.pool_w[slots] = w[idx]
+        self.pool_next = (self.pool_next + n) % self.pool_capacity
+        self.pool_size = min(self.pool_size + n, self.pool_capacity)
+
+    def __call__(self, imgs):
+        if imgs.dim() == 3:
+            return self(imgs.unsqueeze(0)).squeeze(0)
+
+        B, C, H, W = imgs.size()
+        device = imgs.device
+
+        self.collect(imgs)
+        if self.pool_size < self.min_sample_size:
+            return imgs
+
+        happen = torch.rand(B, device=device) <= self.prob_happen
+
+        # randomly selected patches and their position
+        sel = torch.randint(0, self.pool_size, (B, ), device=device)
+        ph, pw = self.pool_h[sel], self.pool_w[sel]
+        y1 = (torch.rand(B, device=device) * (H-ph+1)).long()
+        x1 = (torch.rand(B, device=device) * (W-pw+1)).long()
+        masks = _box_masks(y1, x1, ph, pw, H, W) & happen.view(-1, 1, 1)
+
+        # coordinates in the patch of each pixel of the pasted box, sampled at
+        # pixel centers through the inverse rotation around the patch center
+        rows, cols = self._grid(B, H, W, device)
+        py = (rows - y1.view(-1, 1, 1)).float()
+        px = (cols - x1.view(-1, 1, 1)).float()
+        cy = (ph.float() / 2).view(-1, 1, 1)
+        cx = (pw.float() / 2).view(-1, 1, 1)
+        rotate = torch.rand(B, device=device) > self.prob_rotate
+        angle = torch.randint(-10, 11, (B, ), device=device).float()
+        angle = torch.deg2rad(angle * rotate).view(-1, 1, 1)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        dx, dy = px + 0.5 - cx, py + 0.5 - cy
+        src_x = torch.floor(cos*dx - sin*dy + cx).long()
+        src_y = torch.floor(sin*dx + cos*dy + cy).long()
+        valid = (src_x >= 0) & (src_x < pw.view(-1, 1, 1)) & \
+            (src_y >= 0) & (src_y < ph.view(-1, 1, 1))
+
+        # the patch is flipped before being rotated
+        flip = torch.rand(B, device=device) > self.prob_flip_leftright
+        src_x = torch.where(
+            flip.view(-1, 1, 1),
+            pw.view(-1, 1, 1) - 1 - src_x, src_x
+        )
+
+        patches = self._gather(
+            self.pool[sel], src_y.clamp(0, H - 1), src_x.clamp(0, W - 1)
+        )
+        patches = patches * valid.unsqueeze(1).to(patches.dtype)
+        return torch.where(masks.unsqueeze(1), patches, imgs)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(prob_happen={}, pool_capacity={})'.format(
+            self.prob_happen, self.pool_capacity
+        )
+
+
+def _check_transforms(transforms):
+    if transforms is None:
+        transforms = []
+
+    if isinstance(transforms, str):
+        transforms = [transforms]
+
+    if not isinstance(transforms, list):
+        raise ValueError(
+            'transforms must be a list of strings, but found to be {}'.format(
+                type(transforms)
+            )
+        )
+
+    return [t.lower() for t in transforms]
+
+
 def build_transforms(
     height,
     width,
@@ -244,26 +643,14 @@ def build_transforms(
         height (int): target image height.
         width (int): target image width.
         transforms (str or list of str, optional): transformations applied to model training.
-            Default is 'random_flip'.
+            Default is 'random_flip'. "batch_random_patch" and "batch_random_erase" are the
+            vectorized ``BatchRandomPatch`` and ``BatchRandomErasing``, applied to tensor
+            images, in place of "random_patch" and "random_erase".
         norm_mean (list or None, optional): normalization mean values. Default is ImageNet means.
         norm_std (list or None, optional): normalization standard deviation values. Default is
             ImageNet standard deviation values.
     """
-    if transforms is None:
-        transforms = []
-
-    if isinstance(transforms, str):
-        transforms = [transforms]
-
-    if not isinstance(transforms, list):
-        raise ValueError(
-            'transforms must be a list of strings, but found to be {}'.format(
-                type(transforms)
-            )
-        )
-
-    if len(transforms) > 0:
-        transforms = [t.lower() for t in transforms]
+    transforms = _check_transforms(transforms)
 
     if norm_mean is None or norm_std is None:
         norm_mean = [0.485, 0.456, 0.406] # imagenet mean
@@ -294,6 +681,11 @@ def build_transforms(
         print('+ random patch')
         transform_tr += [RandomPatch()]
 
+    if 'batch_random_patch' in transforms:
+        print('+ to uint8 torch tensor')
+        print('+ random patch (vectorized)')
+        transform_tr += [PILToTensor(), BatchRandomPatch()]
+
     if 'color_jitter' in transforms:
         print('+ color jitter')
         transform_tr += [
@@ -301,7 +693,10 @@ def build_transforms(
         ]
 
     print('+ to torch tensor of range [0, 1]')
-    transform_tr += [ToTensor()]
+    if 'batch_random_patch' in transforms:
+        transform_tr += [ConvertImageDtype(torch.float)]
+    else:
+        transform_tr += [ToTensor()]
 
     print('+ normalization (mean={}, std={})'.format(norm_mean, norm_std))
     transform_tr += [normalize]
@@ -310,6 +705,10 @@ def build_transforms(
         print('+ random erase')
         transform_tr += [RandomErasing(mean=norm_mean)]
 
+    if 'batch_random_erase' in transforms:
+        print('+ random erase (vectorized)')
+        transform_tr += [BatchRandomErasing(mean=norm_mean)]
+
     transform_tr = Compose(transform_tr)
 
     print('Building test transforms ...')
@@ -324,3 +723,90 @@ def build_transforms(
     ])
 
     return transform_tr, transform_te
+
+
+def build_batch_transforms(
+    height,
+    width,
+    transforms='random_flip',
+    norm_mean=[0.485, 0.456, 0.406],
+    norm_std=[0.229, 0.224, 0.225],
+    **kwargs
+):
+    """Builds train transform functions applied to whole batches.
+
+    Data loading workers only decode the images, resize them to (height, width)
+    and convert them to uint8 tensors. The augmentations are then applied to each
+    batch of shape (B, C, H, W) on the training device, with per-image random
+    parameters. Random patches are pasted on the uint8 images, before the other
+    augmentations. "batch_random_patch" and "batch_random_erase" are accepted
+    as aliases of "random_patch" and "random_erase".
+
+    Args:
+        height (int): target image height.
+        width (int): target image width.
+        transforms (str or list of str, optional): transformations applied to model training.
+            Default is 'random_flip'.
+        norm_mean (list or None, optional): normalization mean values. Default is ImageNet means.
+        norm_std (list or None, optional): normalization standard deviation values. Default is
+            ImageNet standard deviation values.
+
+    Returns:
+        tuple: (transform_tr, batch_transform_tr), the per-image transform of the
+        data loading workers and the batch transform.
+    """
+    transforms = _check_transforms(transforms)
+
+    if norm_mean is None or norm_std is None:
+        norm_mean = [0.485, 0.456, 0.406] # imagenet mean
+        norm_std = [0.229, 0.224, 0.225] # imagenet std
+
+    print('Building train transforms (per image) ...')
+    transform_tr = []
+
+    print('+ resize to {}x{}'.format(height, width))
+    transform_tr += [Resize((height, width))]
+
+    print('+ to uint8 torch tensor')
+    transform_tr += [PILToTensor()]
+
+    transform_tr = Compose(transform_tr)
+
+    print('Building train transforms (per batch) ...')
+    batch_transform_tr = []
+
+    if 'random_patch' in transforms or 'batch_random_patch' in transforms:
+        print('+ random patch')
+        batch_transform_tr += [BatchRandomPatch()]
+
+    print('+ to float of range [0, 1]')
+    batch_transform_tr += [BatchToFloat()]
+
+    if 'random_flip' in transforms:
+        print('+ random flip')
+        batch_transform_tr += [BatchRandomHorizontalFlip()]
+
+    if 'random_crop' in transforms:
+        print(
+            '+ random crop (enlarge to {}x{} and '
+            'crop {}x{})'.format(
+                int(round(height * 1.125)), int(round(width * 1.125)), height,
+                width
+            )
+        )
+        batch_transform_tr += [BatchRandom2DTranslation(height, width)]
+
+    if 'color_jitter' in transforms:
+        print('+ color jitter')
+        batch_transform_tr += [BatchColorJitter(brightness=0.2, contrast=0.15)]
+
+    print('+ normalization (mean={}, std={})'.format(norm_mean, norm_std))
+    batch_transform_tr += [BatchNormalize(mean=norm_mean, std=norm_std)]
+
+    if 'random_erase' in transforms or 'batch_random_erase' in transforms:
+        print('+ random erase')
+        batch_transform_tr += [BatchRandomErasing(mean=norm_mean)]
+
+    batch_transform_tr = Compose(batch_transform_tr)
+
+    return transform_tr, batch_transform_tr
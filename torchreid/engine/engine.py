@@ -1,38 +1,75 @@
 from __future__ import division, print_function, absolute_import
 import json
+import math
 import time
+import warnings
+import contextlib
+import tempfile
 import numpy as np
 import os.path as osp
 import datetime
 from collections import OrderedDict
 import torch
 from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.tensorboard import SummaryWriter
 
 from torchreid import metrics
 from torchreid.utils import (
-    MetricMeter, AverageMeter, re_ranking, open_all_layers, save_checkpoint,
-    open_specified_layers, visualize_ranked_results
+    FeatureCache, MetricMeter, AverageMeter, CheckpointWriter, re_ranking,
+    gnn_re_ranking, open_all_layers, save_checkpoint, state_dict_hash,
+    open_specified_layers, re_ranking_per_group, visualize_ranked_results,
+    barrier, is_main_process, all_gather_tensor, all_gather_object
 )
 from torchreid.losses import DeepSupervision
+from torchreid.data.sampler import DistributedShardSampler
 
 
 class Engine(object):
     r"""A generic base Engine class for both image- and video-reid.
 
+    In distributed training, i.e. with a ``DistributedDataParallel`` model and
+    a ``DataManager`` built with ``distributed=True``, only the main process
+    saves checkpoints, logs training and computes the evaluation metrics, from
+    the features extracted by all the processes.
+
     Args:
         datamanager (DataManager): an instance of ``torchreid.data.ImageDataManager``
             or ``torchreid.data.VideoDataManager``.
         use_gpu (bool, optional): use gpu. Default is True.
+        amp (bool, optional): train with automatic mixed precision, i.e. float16
+            autocast with gradient scaling on gpu and bfloat16 autocast on cpu.
+            Default is False.
+        channels_last (bool, optional): use the channels_last memory format for
+            the registered models and the input images, which speeds up
+            convolutions with mixed precision on recent gpus. Default is False.
+            A ``DistributedDataParallel`` model must be converted before being
+            wrapped, since its gradient buckets follow the parameter strides.
     """
 
-    def __init__(self, datamanager, use_gpu=True):
+    def __init__(
+        self, datamanager, use_gpu=True, amp=False, channels_last=False
+    ):
         self.datamanager = datamanager
         self.train_loader = self.datamanager.train_loader
         self.test_loader = self.datamanager.test_loader
+        self.batch_transform = getattr(
+            self.datamanager, 'batch_transform_tr', None
+        )
         self.use_gpu = (torch.cuda.is_available() and use_gpu)
+        self.amp = amp
+        self.amp_dtype = torch.float16 if self.use_gpu else torch.bfloat16
+        # bfloat16 has the range of float32, gradients only need scaling in float16
+        self.scaler = torch.amp.GradScaler(
+            'cuda', enabled=(amp and self.use_gpu)
+        )
+        self.memory_format = (
+            torch.channels_last if channels_last else torch.contiguous_format
+        )
         self.writer = None
+        self.checkpoint_writer = None
         self.epoch = 0
+        self.accumulation_steps = 1
 
         self.model = None
         self.optimizer = None
@@ -58,6 +95,20 @@ class Engine(object):
                 'Cannot assign sched before super().__init__() call'
             )
 
+        if model is not None and self.memory_format == torch.channels_last:
+            if isinstance(model, DistributedDataParallel):
+                if any(
+                    p.dim() == 4 and
+                    not p.is_contiguous(memory_format=torch.channels_last)
+                    for p in model.parameters()
+                ):
+                    raise ValueError(
+                        'The model must be converted to channels_last before '
+                        'being wrapped in DistributedDataParallel'
+                    )
+            else:
+                model.to(memory_format=self.memory_format)
+
         self._models[name] = model
         self._optims[name] = optim
         self._scheds[name] = sched
@@ -74,20 +125,28 @@ class Engine(object):
             return names_real
 
     def save_model(self, epoch, rank1, save_dir, is_best=False):
+        if not is_main_process():
+            return
         names = self.get_model_names()
 
         for name in names:
-            save_checkpoint(
-                {
-                    'state_dict': self._models[name].state_dict(),
-                    'epoch': epoch + 1,
-                    'rank1': rank1,
-                    'optimizer': self._optims[name].state_dict(),
-                    'scheduler': self._scheds[name].state_dict()
-                },
-                osp.join(save_dir, name),
-                is_best=is_best
-            )
+            state = {
+                'state_dict': self._models[name].state_dict(),
+                'epoch': epoch + 1,
+                'rank1': rank1,
+                'optimizer': self._optims[name].state_dict(),
+                'scheduler': self._scheds[name].state_dict()
+            }
+            if self.scaler.is_enabled():
+                state['scaler'] = self.scaler.state_dict()
+            if self.checkpoint_writer is not None:
+                self.checkpoint_writer.save(
+                    state, osp.join(save_dir, name), is_best=is_best
+                )
+            else:
+                save_checkpoint(
+                    state, osp.join(save_dir, name), is_best=is_best
+                )
 
     def set_model_mode(self, mode='train', names=None):
         assert mode in ['train', 'eval', 'test']
@@ -129,7 +188,18 @@ class Engine(object):
         eval_metric='default',
         ranks=[1, 5, 10, 20],
         rerank=False,
-        export_ranking_results=False
+        export_ranking_results=False,
+        action_blocked_dist=False,
+        dist_max_memory=0,
+        dist_topk=0,
+        feature_cache_dir='',
+        rerank_workers=0,
+        rerank_method='k_reciprocal',
+        accumulation_steps=1,
+        deferred_metrics=False,
+        tensorboard_freq=0,
+        async_checkpoint=False,
+        max_checkpoints=0
     ):
         r"""A unified pipeline for training and evaluating a model.
 
@@ -162,6 +232,46 @@ class Engine(object):
             rerank (bool, optional): uses person re-ranking (by Zhong et al. CVPR'17).
                 Default is False. This is only enabled when test_only=True.
             export_ranking_results: (bool, optional): export query to gallery ranking results to CSV file for each target dataset
+            action_blocked_dist (bool, optional): only computes distances between query and gallery
+                samples from the same action (stored as camid), i.e. one block per action instead of the
+                full distance matrix. Only valid with ``eval_metric='soccernetv3'`` or when labels are hidden.
+                With ``rerank``, re-ranking is also applied independently within each action. Default is False.
+            dist_max_memory (int, optional): if positive, the query to gallery distance matrix is computed block
+                by block with blocks of at most ``dist_max_memory`` MB, and is stored in a temporary memory-mapped
+                file when it is larger than that. Default is 0 (the full matrix is computed at once, in memory).
+            dist_topk (int, optional): if positive, the distance matrix is never materialized: gallery features
+                are streamed by chunks (of at most ``dist_max_memory`` MB, if positive) to retrieve the
+                ``dist_topk`` closest gallery samples from the same action as each query, which are the only
+                ones exported and visualized, while CMC and mAP are computed exactly by streaming as well.
+                Ignored when ``rerank`` is True. Default is 0.
+            feature_cache_dir (str, optional): if given, query and gallery features are stored in this directory,
+                keyed by model weights, dataset, split and test transforms, and are loaded from it instead of
+                being extracted again, e.g. when trying different ``dist_metric``, ``normalize_feature`` or
+                ``rerank`` settings with ``test_only``. It is not used by the evaluations done during
+                training, whose weights are never evaluated again, but only by the final test. Default is ''
+                (no cache).
+            rerank_workers (int, optional): number of processes used to re-rank actions in parallel when both
+                ``rerank`` and ``action_blocked_dist`` are True. Default is 0 (no process pool).
+            rerank_method (str, optional): re-ranking method used when ``rerank`` is True, "k_reciprocal"
+                (by Zhong et al. CVPR'17) or "gnn" (graph neural network re-ranking by Zhang et al.,
+                which always uses cosine similarities of L2-normalized features, whatever ``dist_metric``).
+                Default is "k_reciprocal".
+            accumulation_steps (int, optional): number of micro-batches each training batch is split into,
+                accumulating their gradients before a single optimizer step. The training batch size is
+                then the logical batch size, e.g. the P x K batch of ``RandomIdentitySampler``, while only a
+                micro-batch is forwarded at once. Default is 1.
+            deferred_metrics (bool, optional): accumulates the training losses and accuracy on the device
+                and only synchronizes with the host when they are printed or written to TensorBoard,
+                instead of after every iteration. Since writing to TensorBoard also synchronizes them,
+                ``tensorboard_freq`` then defaults to ``print_freq``. Default is False.
+            tensorboard_freq (int, optional): frequency, in iterations, at which training scalars are
+                written to TensorBoard. Default is 0 (``print_freq`` with ``deferred_metrics``, every
+                iteration otherwise).
+            async_checkpoint (bool, optional): writes checkpoints on a background thread (see
+                ``CheckpointWriter``), training being only blocked while the model and optimizer states
+                are copied to cpu. Default is False.
+            max_checkpoints (int, optional): number of the most recent checkpoints kept in ``save_dir``,
+                in addition to ``model-best.pth.tar``. Default is 0 (all the checkpoints are kept).
         """
 
         if test_only:
@@ -174,13 +284,23 @@ class Engine(object):
                 eval_metric=eval_metric,
                 ranks=ranks,
                 rerank=rerank,
-                export_ranking_results=export_ranking_results
+                export_ranking_results=export_ranking_results,
+                action_blocked_dist=action_blocked_dist,
+                dist_max_memory=dist_max_memory,
+                dist_topk=dist_topk,
+                feature_cache_dir=feature_cache_dir,
+                rerank_workers=rerank_workers,
+                rerank_method=rerank_method
             )
             return
 
-        if self.writer is None:
+        if self.writer is None and is_main_process():
             self.writer = SummaryWriter(log_dir=save_dir)
 
+        self.checkpoint_writer = CheckpointWriter(
+            max_keep=max_checkpoints, background=async_checkpoint
+        )
+
         time_start = time.time()
         self.start_epoch = start_epoch
         self.max_epoch = max_epoch
@@ -190,7 +310,10 @@ class Engine(object):
             self.train(
                 print_freq=print_freq,
                 fixbase_epoch=fixbase_epoch,
-                open_layers=open_layers
+                open_layers=open_layers,
+                accumulation_steps=accumulation_steps,
+                deferred_metrics=deferred_metrics,
+                tensorboard_freq=tensorboard_freq
             )
 
             if (self.epoch + 1) >= start_eval \
@@ -204,7 +327,12 @@ class Engine(object):
                     visrank_topk=visrank_topk,
                     save_dir=save_dir,
                     eval_metric=eval_metric,
-                    ranks=ranks
+                    ranks=ranks,
+                    action_blocked_dist=action_blocked_dist,
+                    dist_max_memory=dist_max_memory,
+                    dist_topk=dist_topk,
+                    rerank_workers=rerank_workers,
+                    rerank_method=rerank_method
                 )
                 self.save_model(self.epoch, rank1, save_dir)
 
@@ -218,18 +346,46 @@ class Engine(object):
                 save_dir=save_dir,
                 eval_metric=eval_metric,
                 ranks=ranks,
-                export_ranking_results=export_ranking_results
+                export_ranking_results=export_ranking_results,
+                action_blocked_dist=action_blocked_dist,
+                dist_max_memory=dist_max_memory,
+                dist_topk=dist_topk,
+                feature_cache_dir=feature_cache_dir,
+                rerank_workers=rerank_workers,
+                rerank_method=rerank_method
             )
             self.save_model(self.epoch, rank1, save_dir)
 
+        # waits for the checkpoints being written
+        self.checkpoint_writer.close()
+        self.checkpoint_writer = None
+
         elapsed = round(time.time() - time_start)
         elapsed = str(datetime.timedelta(seconds=elapsed))
         print('Elapsed {}'.format(elapsed))
         if self.writer is not None:
             self.writer.close()
 
-    def train(self, print_freq=10, fixbase_epoch=0, open_layers=None):
-        losses = MetricMeter()
+    def train(
+        self,
+        print_freq=10,
+        fixbase_epoch=0,
+        open_layers=None,
+        accumulation_steps=1,
+        deferred_metrics=False,
+        tensorboard_freq=0
+    ):
+        if accumulation_steps < 1:
+            raise ValueError(
+                'accumulation_steps must be positive, got {}'.format(
+                    accumulation_steps
+                )
+            )
+        self.accumulation_steps = accumulation_steps
+        if tensorboard_freq <= 0:
+            # writing scalars syncs the deferred metrics with the host
+            tensorboard_freq = print_freq if deferred_metrics else 1
+        losses = MetricMeter(deferred=deferred_metrics)
         batch_time = AverageMeter()
         data_time = AverageMeter()
 
@@ -239,6 +395,11 @@ class Engine(object):
             self.epoch, fixbase_epoch, open_layers
         )
 
+        sampler = self.train_loader.sampler
+        if hasattr(sampler, 'set_epoch'):
+            # e.g. DistributedSampler, which draws a new order at each epoch
+            sampler.set_epoch(self.epoch)
+
         self.num_batches = len(self.train_loader)
         end = time.time()
         for self.batch_idx, data in enumerate(self.train_loader):
@@ -247,7 +408,15 @@ class Engine(object):
             batch_time.update(time.time() - end)
             losses.update(loss_summary)
 
-            if (self.batch_idx + 1) % print_freq == 0:
+            do_print = (self.batch_idx + 1) % print_freq == 0 \
+                and is_main_process()
+            do_write = self.writer is not None \
+                and (self.batch_idx + 1) % tensorboard_freq == 0
+            if do_print or do_write:
+                losses.sync()
+                lr = self.get_current_lr()
+
+            if do_print:
                 nb_this_epoch = self.num_batches - (self.batch_idx + 1)
                 nb_future_epochs = (
                     self.max_epoch - (self.epoch + 1)
@@ -269,19 +438,17 @@ class Engine(object):
                         data_time=data_time,
                         eta=eta_str,
                         losses=losses,
-                        lr=self.get_current_lr()
+                        lr=lr
                     )
                 )
 
-            if self.writer is not None:
+            if do_write:
                 n_iter = self.epoch * self.num_batches + self.batch_idx
                 self.writer.add_scalar('Train/time', batch_time.avg, n_iter)
                 self.writer.add_scalar('Train/data', data_time.avg, n_iter)
                 for name, meter in losses.meters.items():
                     self.writer.add_scalar('Train/' + name, meter.avg, n_iter)
-                self.writer.add_scalar(
-                    'Train/lr', self.get_current_lr(), n_iter
-                )
+                self.writer.add_scalar('Train/lr', lr, n_iter)
 
             end = time.time()
 
@@ -300,7 +467,13 @@ class Engine(object):
         eval_metric='default',
         ranks=[1, 5, 10, 20],
         rerank=False,
-        export_ranking_results=False
+        export_ranking_results=False,
+        action_blocked_dist=False,
+        dist_max_memory=0,
+        dist_topk=0,
+        feature_cache_dir='',
+        rerank_workers=0,
+        rerank_method='k_reciprocal'
     ):
         r"""Tests model on target datasets.
 
@@ -335,7 +508,13 @@ class Engine(object):
                 eval_metric=eval_metric,
                 ranks=ranks,
                 rerank=rerank,
-                export_ranking_results=export_ranking_results
+                export_ranking_results=export_ranking_results,
+                action_blocked_dist=action_blocked_dist,
+                dist_max_memory=dist_max_memory,
+                dist_topk=dist_topk,
+                feature_cache_dir=feature_cache_dir,
+                rerank_workers=rerank_workers,
+                rerank_method=rerank_method
             )
 
             if self.writer is not None and rank1 is not None and mAP is not None:
@@ -344,6 +523,8 @@ class Engine(object):
             if rank1 is not None:
                 last_rank1 = rank1
 
+        # the other processes wait for the main one to compute the metrics
+        barrier()
         return last_rank1
 
     @torch.no_grad()
@@ -360,57 +541,256 @@ class Engine(object):
         eval_metric='default',
         ranks=[1, 5, 10, 20],
         rerank=False,
-        export_ranking_results=False
+        export_ranking_results=False,
+        action_blocked_dist=False,
+        dist_max_memory=0,
+        dist_topk=0,
+        feature_cache_dir='',
+        rerank_workers=0,
+        rerank_method='k_reciprocal'
     ):
         batch_time = AverageMeter()
+        data_time = AverageMeter()
+        copy_time = AverageMeter()
+        copy_stream = torch.cuda.Stream() if self.use_gpu else None
+
+        def _load_batch(data_iter):
+            # fetches a batch and issues its (non-blocking) host to device copy
+            end = time.time()
+            data = next(data_iter, None)
+            if data is None:
+                return None
+            imgs, pids, camids = self.parse_data_for_eval(data)
+            if self.use_gpu:
+                with torch.cuda.stream(copy_stream):
+                    imgs = imgs.cuda(non_blocking=True)
+            data_time.update(time.time() - end)
+            return imgs, pids, camids
+
+        def _concatenate(arrays):
+            # empty shards are float arrays, which would change the dtype
+            return np.concatenate([a for a in arrays if a.size] or arrays)
 
         def _feature_extraction(data_loader):
-            f_, pids_, camids_ = [], [], []
-            for batch_idx, data in enumerate(data_loader):
-                imgs, pids, camids = self.parse_data_for_eval(data)
-                if self.use_gpu:
-                    imgs = imgs.cuda()
+            f_, pids_, camids_ = None, [], []
+            events = []
+            data_iter = iter(data_loader)
+            batch = _load_batch(data_iter)
+            num_done = 0
+            while batch is not None:
+                imgs, pids, camids = batch
                 end = time.time()
+                if self.use_gpu:
+                    torch.cuda.current_stream().wait_stream(copy_stream)
+                    imgs.record_stream(torch.cuda.current_stream())
+                    batch_events = [
+                        torch.cuda.Event(enable_timing=True) for _ in range(3)
+                    ]
+                    batch_events[0].record()
                 features = self.extract_features(imgs)
-                batch_time.update(time.time() - end)
-                features = features.cpu().clone()
-                f_.append(features)
+                if self.use_gpu:
+                    batch_events[1].record()
+                else:
+                    batch_time.update(time.time() - end)
+
+                # the next batch is loaded and copied while the forward pass runs
+                batch = _load_batch(data_iter)
+
+                if f_ is None:
+                    f_ = torch.empty(
+                        (len(data_loader.dataset), ) + features.shape[1:],
+                        dtype=features.dtype,
+                        pin_memory=self.use_gpu
+                    )
+                end = time.time()
+                f_[num_done:num_done + features.size(0)].copy_(
+                    features, non_blocking=True
+                )
+                if self.use_gpu:
+                    batch_events[2].record()
+                    events.append(batch_events)
+                else:
+                    copy_time.update(time.time() - end)
+                num_done += features.size(0)
                 pids_.extend(pids)
                 camids_.extend(camids)
-            f_ = torch.cat(f_, 0)
+
+            if self.use_gpu:
+                # wait for the last device to host copies, then read the timings
+                torch.cuda.synchronize()
+                for start, forward_end, copy_end in events:
+                    batch_time.update(start.elapsed_time(forward_end) / 1000)
+                    copy_time.update(forward_end.elapsed_time(copy_end) / 1000)
             pids_ = np.asarray(pids_)
             camids_ = np.asarray(camids_)
+            if isinstance(data_loader.sampler, DistributedShardSampler):
+                # a process with an empty shard, e.g. when the dataset is smaller
+                # than the world size, takes the feature shape from the others
+                specs = all_gather_object(
+                    None if f_ is None else (tuple(f_.shape[1:]), f_.dtype)
+                )
+                specs = [spec for spec in specs if spec is not None]
+                if f_ is None and specs:
+                    f_ = torch.empty((0, ) + specs[0][0], dtype=specs[0][1])
+            if f_ is None:
+                # empty loader, the feature dimension is unknown
+                f_ = torch.empty(0, 0)
+            f_ = f_[:num_done]
+            if isinstance(data_loader.sampler, DistributedShardSampler):
+                # shards of the processes, concatenated in dataset order
+                f_ = all_gather_tensor(f_)
+                pids_ = _concatenate(all_gather_object(pids_))
+                camids_ = _concatenate(all_gather_object(camids_))
             return f_, pids_, camids_
 
+        feature_cache = None
+        if feature_cache_dir:
+            feature_cache = FeatureCache(feature_cache_dir)
+            model_hash = state_dict_hash(self.model)
+
+        def _cached_feature_extraction(data_loader, split):
+            if feature_cache is None:
+                return _feature_extraction(data_loader)
+            key = feature_cache.make_key(
+                model_hash, dataset_name, split, data_loader.dataset.transform
+            )
+            cached = feature_cache.load(key)
+            if cached is not None and len(cached[1]) == len(data_loader.dataset):
+                print('Loaded features from cache entry "{}"'.format(key))
+                return cached
+            features, pids, camids = _feature_extraction(data_loader)
+            if is_main_process():
+                feature_cache.save(key, features, pids, camids)
+            return features, pids, camids
+
         print('Extracting features from query set ...')
-        qf, q_pids, q_camids = _feature_extraction(query_loader)
+        qf, q_pids, q_camids = _cached_feature_extraction(query_loader, 'query')
         print('Done, obtained {}-by-{} matrix'.format(qf.size(0), qf.size(1)))
 
         print('Extracting features from gallery set ...')
-        gf, g_pids, g_camids = _feature_extraction(gallery_loader)
+        gf, g_pids, g_camids = _cached_feature_extraction(
+            gallery_loader, 'gallery'
+        )
         print('Done, obtained {}-by-{} matrix'.format(gf.size(0), gf.size(1)))
 
+        if not is_main_process():
+            return None, None
+
         print('Speed: {:.4f} sec/batch'.format(batch_time.avg))
+        print(
+            'Time per batch: data {:.4f} sec, forward {:.4f} sec, '
+            'device to host {:.4f} sec'.format(
+                data_time.avg, batch_time.avg, copy_time.avg
+            )
+        )
 
         if normalize_feature:
             print('Normalzing features with L2 norm ...')
             qf = F.normalize(qf, p=2, dim=1)
             gf = F.normalize(gf, p=2, dim=1)
 
-        print(
-            'Computing distance matrix with metric={} ...'.format(dist_metric)
-        )
-        distmat = metrics.compute_distance_matrix(qf, gf, dist_metric)
-        distmat = distmat.numpy()
+        if rerank and rerank_method == 'gnn' and dist_metric != 'cosine':
+            warnings.warn(
+                'GNN re-ranking uses cosine similarities, '
+                'dist_metric="{}" is ignored'.format(dist_metric)
+            )
+
+        # gallery samples are ranked once and the ranking is shared by the export and the
+        # visualization. Only samples from the same action (camid) as the query are ranked.
+        distmat, indices = None, None
+        if dist_topk > 0 and not rerank:
+            max_memory = int(dist_max_memory * 1024**2) if dist_max_memory > 0 \
+                else 256 * 1024**2
+            if export_ranking_results or visrank:
+                k = max(dist_topk, visrank_topk) if visrank else dist_topk
+                print(
+                    'Retrieving top-{} gallery samples with metric={} within each action ...'.
+                    format(k, dist_metric)
+                )
+                _, topk_indices = metrics.topk_retrieval(
+                    qf,
+                    gf,
+                    k,
+                    dist_metric,
+                    max_memory=max_memory,
+                    groups1=q_camids,
+                    groups2=g_camids
+                )
+                indices = [ranking[ranking >= 0] for ranking in topk_indices]
+        elif action_blocked_dist:
+            print(
+                'Computing distance matrix with metric={} within each action ...'.
+                format(dist_metric)
+            )
+            if rerank:
+                print('Applying person re-ranking within each action ...')
+                distmat = re_ranking_per_group(
+                    qf,
+                    gf,
+                    q_camids,
+                    g_camids,
+                    dist_metric,
+                    num_workers=rerank_workers,
+                    method=rerank_method
+                )
+            else:
+                distmat = metrics.compute_blocked_distance_matrix(
+                    qf, gf, q_camids, g_camids, dist_metric
+                )
+            print(
+                'Done, obtained {} blocks with {} distances in total'.format(
+                    len(distmat), distmat.size
+                )
+            )
+        elif rerank and rerank_method == 'gnn':
+            # the re-ranked distances are computed from the features, without the
+            # initial distance matrix
+            print('Applying GNN re-ranking ...')
+            distmat = gnn_re_ranking(qf, gf)
+        else:
+            print(
+                'Computing distance matrix with metric={} ...'.
+                format(dist_metric)
+            )
+            if dist_max_memory > 0:
+                max_memory = int(dist_max_memory * 1024**2)
+                out = None
+                if qf.size(0) * gf.size(0) * 4 > max_memory:
+                    # the distance matrix does not fit in the budget, keep it on disk
+                    out = np.memmap(
+                        tempfile.TemporaryFile(dir=save_dir or None),
+                        dtype=np.float32,
+                        mode='w+',
+                        shape=(qf.size(0), gf.size(0))
+                    )
+                distmat = metrics.compute_distance_matrix_chunked(
+                    qf, gf, dist_metric, max_memory=max_memory, out=out
+                )
+            else:
+                distmat = metrics.compute_distance_matrix(qf, gf, dist_metric)
+                distmat = distmat.numpy()
 
-        if rerank:
+        if rerank and not action_blocked_dist and rerank_method != 'gnn':
             print('Applying person re-ranking ...')
-            distmat_qq = metrics.compute_distance_matrix(qf, qf, dist_metric)
-            distmat_gg = metrics.compute_distance_matrix(gf, gf, dist_metric)
-            distmat = re_ranking(distmat, distmat_qq, distmat_gg)
+            if rerank_method == 'k_reciprocal':
+                distmat_qq = metrics.compute_distance_matrix(
+                    qf, qf, dist_metric
+                )
+                distmat_gg = metrics.compute_distance_matrix(
+                    gf, gf, dist_metric
+                )
+                distmat = re_ranking(distmat, distmat_qq, distmat_gg)
+            else:
+                raise ValueError(
+                    'Unknown re-ranking method: {}'.format(rerank_method)
+                )
 
         if export_ranking_results:
-            self.export_ranking_results_for_ext_eval(distmat, q_pids, q_camids, g_pids, g_camids, save_dir, dataset_name)
+            if indices is None:
+                indices = metrics.rank_gallery(
+                    distmat, q_groups=q_camids, g_groups=g_camids
+                )
+            self.export_ranking_results_for_ext_eval(distmat, q_pids, q_camids, g_pids, g_camids, save_dir, dataset_name, indices=indices)
 
         if visrank:
             visualize_ranked_results(
@@ -422,18 +802,32 @@ class Engine(object):
                 save_dir=osp.join(save_dir, 'visrank_' + dataset_name),
                 topk=visrank_topk,
                 display_border=not query_loader.dataset.hidden_labels,
+                indices=indices
             )
 
         if not query_loader.dataset.hidden_labels:
             print('Computing CMC and mAP ...')
-            cmc, mAP = metrics.evaluate_rank(
-                distmat,
-                q_pids,
-                g_pids,
-                q_camids,
-                g_camids,
-                eval_metric=eval_metric
-            )
+            if distmat is None:
+                cmc, mAP = metrics.evaluate_rank_streaming(
+                    qf,
+                    gf,
+                    q_pids,
+                    g_pids,
+                    q_camids,
+                    g_camids,
+                    eval_metric=eval_metric,
+                    metric=dist_metric,
+                    max_memory=max_memory
+                )
+            else:
+                cmc, mAP = metrics.evaluate_rank(
+                    distmat,
+                    q_pids,
+                    g_pids,
+                    q_camids,
+                    g_camids,
+                    eval_metric=eval_metric
+                )
             print('** Results **')
             print('mAP: {:.1%}'.format(mAP))
             print('CMC curve')
@@ -451,13 +845,87 @@ class Engine(object):
             loss = criterion(outputs, targets)
         return loss
 
+    def autocast(self):
+        """Returns the autocast context of the forward pass and the losses, which
+        is a no-op unless amp is enabled."""
+        return torch.autocast(
+            device_type='cuda' if self.use_gpu else 'cpu',
+            dtype=self.amp_dtype,
+            enabled=self.amp
+        )
+
+    def micro_batches(self, *tensors):
+        """Splits a training batch into ``self.accumulation_steps`` micro-batches.
+
+        Args:
+            tensors (torch.Tensor): tensors of the batch, split along their
+                first dimension.
+
+        Returns:
+            list: tuples of micro-batch tensors.
+        """
+        batch_size = tensors[0].size(0)
+        size = int(math.ceil(batch_size / self.accumulation_steps))
+        return list(zip(*[t.split(size) for t in tensors]))
+
+    def sync_gradients(self, enabled=True):
+        """Returns a context in which the gradients of a ``DistributedDataParallel``
+        model are only all-reduced if ``enabled``, e.g. for the last micro-batch
+        of a batch whose gradients are accumulated. The forward pass and the
+        backward pass must both run in this context."""
+        if not enabled and isinstance(self.model, DistributedDataParallel):
+            return self.model.no_sync()
+        return contextlib.nullcontext()
+
+    def eval_model(self):
+        """Returns the model used to extract features. A ``DistributedDataParallel``
+        model is unwrapped, as its forward pass may sync buffers with the other
+        processes, whose shards of a test set can have fewer batches or none."""
+        if isinstance(self.model, DistributedDataParallel):
+            return self.model.module
+        return self.model
+
+    def backward(self, loss):
+        """Back-propagates ``loss``, scaled by the gradient scaler in amp mode.
+        Gradients are accumulated until ``optimizer_step``."""
+        self.scaler.scale(loss).backward()
+
+    def optimizer_step(self, optimizer=None):
+        """Updates the parameters with the accumulated gradients.
+
+        Args:
+            optimizer (Optimizer, optional): optimizer, ``self.optimizer`` if
+                not given.
+        """
+        if optimizer is None:
+            optimizer = self.optimizer
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def to_memory_format(self, imgs):
+        if isinstance(imgs, (tuple, list)):
+            return [self.to_memory_format(x) for x in imgs]
+        if imgs.dim() != 4:
+            return imgs
+        return imgs.contiguous(memory_format=self.memory_format)
+
     def extract_features(self, input):
-        return self.model(input)
+        return self.eval_model()(self.to_memory_format(input))
 
     def parse_data_for_train(self, data):
         imgs = data['img']
         pids = data['pid']
-        return imgs, pids
+        if self.batch_transform is not None:
+            # augmentations are applied to the whole batch on the training device
+            imgs = self.apply_batch_transform(imgs)
+        return self.to_memory_format(imgs), pids
+
+    def apply_batch_transform(self, imgs):
+        if isinstance(imgs, (tuple, list)):
+            return [self.apply_batch_transform(x) for x in imgs]
+        if self.use_gpu:
+            imgs = imgs.cuda(non_blocking=True)
+        return self.batch_transform(imgs)
 
     def parse_data_for_eval(self, data):
         imgs = data['img']
@@ -489,28 +957,25 @@ class Engine(object):
         else:
             open_all_layers(model)
 
-    def export_ranking_results_for_ext_eval(self, distmat, q_pids, q_action_indices, g_pids, g_action_indices, save_dir, dataset_name):
+    def export_ranking_results_for_ext_eval(self, distmat, q_pids, q_action_indices, g_pids, g_action_indices, save_dir, dataset_name, indices=None):
 
         date = datetime.datetime.now().strftime('%Y-%m-%d_%H_%M_%S_%f')[:-3]
         ranking_results_filename = osp.join(save_dir, "ranking_results_" + dataset_name + "_" + date + ".json")
         print("Exporting ranking results to '{}' for external evaluation...".format(ranking_results_filename))
 
-        num_q, num_g = distmat.shape
-        indices = np.argsort(distmat, axis=1)
+        num_q = len(q_pids)
+        if indices is None:
+            # only rank gallery samples from the same action as the query
+            indices = metrics.rank_gallery(
+                distmat, q_groups=q_action_indices, g_groups=g_action_indices
+            )
         num_valid_q = 0
         ranking_results = {}
         for q_idx in range(num_q):
             # get query pid and action_idx
             # q_pid = q_pids[q_idx]
             q_action_idx = q_action_indices[q_idx]
-
-            # remove gallery samples from different action than the query
-            order = indices[q_idx]
-            remove = (g_action_indices[order] != q_action_idx)
-            keep = np.invert(remove)
-            g_ranking = order[keep]
-            # g_ranking_pids = g_pids[g_ranking]
-            # gallery_distances = distmat[q_idx][keep]
+            g_ranking = indices[q_idx]
 
             if g_ranking.size == 0:
                 print("Does not appear in gallery: q_idx {} - q_pid {} - q_action_idx {}".format(q_idx, q_pids[q_idx], q_action_idx))
@@ -17,6 +17,9 @@ class ImageSoftmaxEngine(Engine):
         scheduler (LRScheduler, optional): if None, no learning rate decay will be performed.
         use_gpu (bool, optional): use gpu. Default is True.
         label_smooth (bool, optional): use label smoothing regularizer. Default is True.
+        amp (bool, optional): train with automatic mixed precision. Default is False.
+        channels_last (bool, optional): use the channels_last memory format.
+            Default is False.
 
     Examples::
         
@@ -60,9 +63,16 @@ class ImageSoftmaxEngine(Engine):
         optimizer,
         scheduler=None,
         use_gpu=True,
-        label_smooth=True
+        label_smooth=True,
+        amp=False,
+        channels_last=False
     ):
-        super(ImageSoftmaxEngine, self).__init__(datamanager, use_gpu)
+        super(ImageSoftmaxEngine, self).__init__(
+            datamanager,
+            use_gpu=use_gpu,
+            amp=amp,
+            channels_last=channels_last
+        )
 
         self.model = model
         self.optimizer = optimizer
@@ -82,16 +92,23 @@ class ImageSoftmaxEngine(Engine):
             imgs = imgs.cuda()
             pids = pids.cuda()
 
-        outputs = self.model(imgs)
-        loss = self.compute_loss(self.criterion, outputs, pids)
-
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        loss_summary = {'loss': 0., 'acc': 0.}
+        micro_batches = self.micro_batches(imgs, pids)
+        for i, (imgs_i, pids_i) in enumerate(micro_batches):
+            # the loss is a mean over samples, micro-batches are weighted by size
+            weight = imgs_i.size(0) / imgs.size(0)
+            # distributed gradients are all-reduced with the last micro-batch
+            with self.sync_gradients(i == len(micro_batches) - 1):
+                with self.autocast():
+                    outputs = self.model(imgs_i)
+                    loss = self.compute_loss(self.criterion, outputs, pids_i)
+                self.backward(loss * weight)
 
-        loss_summary = {
-            'loss': loss.item(),
-            'acc': metrics.accuracy(outputs, pids)[0].item()
-        }
+            # detached tensors, synchronized with the host by the metric meter
+            loss_summary['loss'] += loss.detach() * weight
+            loss_summary['acc'] += metrics.accuracy(outputs,
+                                                    pids_i)[0] * weight
+        self.optimizer_step()
 
         return loss_summary
@@ -1,4 +1,5 @@
 from __future__ import division, print_function, absolute_import
+import torch
 
 from torchreid import metrics
 from torchreid.losses import TripletLoss, CrossEntropyLoss
@@ -15,11 +16,16 @@ class ImageTripletEngine(Engine):
         model (nn.Module): model instance.
         optimizer (Optimizer): an Optimizer.
         margin (float, optional): margin for triplet loss. Default is 0.3.
+        mining (str, optional): triplet mining, "batch_hard" or "batch_all". Default is "batch_hard".
+        soft_margin (bool, optional): use soft-margin triplet loss. Default is False.
         weight_t (float, optional): weight for triplet loss. Default is 1.
         weight_x (float, optional): weight for softmax loss. Default is 1.
         scheduler (LRScheduler, optional): if None, no learning rate decay will be performed.
         use_gpu (bool, optional): use gpu. Default is True.
         label_smooth (bool, optional): use label smoothing regularizer. Default is True.
+        amp (bool, optional): train with automatic mixed precision. Default is False.
+        channels_last (bool, optional): use the channels_last memory format.
+            Default is False.
 
     Examples::
         
@@ -65,13 +71,22 @@ class ImageTripletEngine(Engine):
         model,
         optimizer,
         margin=0.3,
+        mining='batch_hard',
+        soft_margin=False,
         weight_t=1,
         weight_x=1,
         scheduler=None,
         use_gpu=True,
-        label_smooth=True
+        label_smooth=True,
+        amp=False,
+        channels_last=False
     ):
-        super(ImageTripletEngine, self).__init__(datamanager, use_gpu)
+        super(ImageTripletEngine, self).__init__(
+            datamanager,
+            use_gpu=use_gpu,
+            amp=amp,
+            channels_last=channels_last
+        )
 
         self.model = model
         self.optimizer = optimizer
@@ -83,7 +98,9 @@ class ImageTripletEngine(Engine):
         self.weight_t = weight_t
         self.weight_x = weight_x
 
-        self.criterion_t = TripletLoss(margin=margin)
+        self.criterion_t = TripletLoss(
+            margin=margin, mining=mining, soft_margin=soft_margin
+        )
         self.criterion_x = CrossEntropyLoss(
             num_classes=self.datamanager.num_train_pids,
             use_gpu=self.use_gpu,
@@ -97,26 +114,131 @@ class ImageTripletEngine(Engine):
             imgs = imgs.cuda()
             pids = pids.cuda()
 
-        outputs, features = self.model(imgs)
+        self.optimizer.zero_grad()
+        micro_batches = self.micro_batches(imgs, pids)
+        if len(micro_batches) == 1:
+            loss_summary = self._forward_backward_batch(imgs, pids)
+        else:
+            loss_summary = self._forward_backward_accumulated(
+                micro_batches, pids
+            )
+        self.optimizer_step()
+
+        return loss_summary
+
+    def _forward_backward_batch(self, imgs, pids):
+        with self.autocast():
+            outputs, features = self.model(imgs)
+
+            loss = 0
+            loss_summary = {}
+
+            if self.weight_t > 0:
+                loss_t = self.compute_loss(self.criterion_t, features, pids)
+                loss += self.weight_t * loss_t
+                loss_summary['loss_t'] = loss_t.detach()
+
+            if self.weight_x > 0:
+                loss_x = self.compute_loss(self.criterion_x, outputs, pids)
+                loss += self.weight_x * loss_x
+                loss_summary['loss_x'] = loss_x.detach()
+                loss_summary['acc'] = metrics.accuracy(outputs, pids)[0]
+
+        assert loss_summary
 
-        loss = 0
+        self.backward(loss)
+
+        return loss_summary
+
+    def _forward_backward_accumulated(self, micro_batches, pids):
+        """Accumulates the gradients of micro-batches while mining the triplets
+        over the whole batch, in two passes.
+
+        The first pass computes the embeddings of the whole batch without
+        keeping activations, and the triplet loss over the batch gives the
+        gradients of the embeddings. The second pass forwards the micro-batches
+        again, with the same random state, and back-propagates these gradients
+        along with the cross entropy loss of each micro-batch.
+        """
+        batch_size = pids.size(0)
         loss_summary = {}
 
+        feature_grads = None
         if self.weight_t > 0:
-            loss_t = self.compute_loss(self.criterion_t, features, pids)
-            loss += self.weight_t * loss_t
-            loss_summary['loss_t'] = loss_t.item()
+            # the running statistics of batch norm layers are only updated by the
+            # second pass
+            buffers = [buf.clone() for buf in self.model.buffers()]
+            rng_states = []
+            features = []
+            with torch.no_grad():
+                for imgs_i, _ in micro_batches:
+                    rng_states.append(self._get_rng_state())
+                    with self.autocast():
+                        features.append(_as_tuple(self.model(imgs_i)[1]))
+            for buf, saved in zip(self.model.buffers(), buffers):
+                buf.copy_(saved)
+
+            features = [
+                torch.cat(f).float().requires_grad_() for f in zip(*features)
+            ]
+            loss_t = self.compute_loss(
+                self.criterion_t,
+                features if len(features) > 1 else features[0], pids
+            )
+            loss_t.backward()
+            loss_summary['loss_t'] = loss_t.detach()
+
+            sizes = [imgs_i.size(0) for imgs_i, _ in micro_batches]
+            feature_grads = list(
+                zip(*[(self.weight_t * f.grad).split(sizes) for f in features])
+            )
+
+        loss_x_sum, acc_sum = 0., 0.
+        for i, (imgs_i, pids_i) in enumerate(micro_batches):
+            weight = imgs_i.size(0) / batch_size
+            if feature_grads is not None:
+                self._set_rng_state(rng_states[i])
+            with self.sync_gradients(i == len(micro_batches) - 1):
+                with self.autocast():
+                    outputs, features_i = self.model(imgs_i)
+
+                    loss = 0
+                    if feature_grads is not None:
+                        # its gradient w.r.t. the embeddings is that of the
+                        # triplet loss
+                        for f, grad in zip(
+                            _as_tuple(features_i), feature_grads[i]
+                        ):
+                            loss += (f.float() * grad).sum()
+
+                    if self.weight_x > 0:
+                        loss_x = self.compute_loss(
+                            self.criterion_x, outputs, pids_i
+                        )
+                        loss += self.weight_x * weight * loss_x
+
+                self.backward(loss)
+
+            if self.weight_x > 0:
+                loss_x_sum += loss_x.detach() * weight
+                acc_sum += metrics.accuracy(outputs, pids_i)[0] * weight
 
         if self.weight_x > 0:
-            loss_x = self.compute_loss(self.criterion_x, outputs, pids)
-            loss += self.weight_x * loss_x
-            loss_summary['loss_x'] = loss_x.item()
-            loss_summary['acc'] = metrics.accuracy(outputs, pids)[0].item()
+            loss_summary['loss_x'] = loss_x_sum
+            loss_summary['acc'] = acc_sum
 
-        assert loss_summary
+        return loss_summary
 
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+    def _get_rng_state(self):
+        if self.use_gpu:
+            return torch.get_rng_state(), torch.cuda.get_rng_state_all()
+        return torch.get_rng_state(), None
 
-        return loss_summary
+    def _set_rng_state(self, state):
+        torch.set_rng_state(state[0])
+        if state[1] is not None:
+            torch.cuda.set_rng_state_all(state[1])
+
+
+def _as_tuple(x):
+    return tuple(x) if isinstance(x, (tuple, list)) else (x, )
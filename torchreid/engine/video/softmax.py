@@ -17,6 +17,9 @@ class VideoSoftmaxEngine(ImageSoftmaxEngine):
         label_smooth (bool, optional): use label smoothing regularizer. Default is True.
         pooling_method (str, optional): how to pool features for a tracklet.
             Default is "avg" (average). Choices are ["avg", "max"].
+        amp (bool, optional): train with automatic mixed precision. Default is False.
+        channels_last (bool, optional): use the channels_last memory format.
+            Default is False.
 
     Examples::
         
@@ -65,7 +68,9 @@ class VideoSoftmaxEngine(ImageSoftmaxEngine):
         scheduler=None,
         use_gpu=True,
         label_smooth=True,
-        pooling_method='avg'
+        pooling_method='avg',
+        amp=False,
+        channels_last=False
     ):
         super(VideoSoftmaxEngine, self).__init__(
             datamanager,
@@ -73,7 +78,9 @@ class VideoSoftmaxEngine(ImageSoftmaxEngine):
             optimizer,
             scheduler=scheduler,
             use_gpu=use_gpu,
-            label_smooth=label_smooth
+            label_smooth=label_smooth,
+            amp=amp,
+            channels_last=channels_last
         )
         self.pooling_method = pooling_method
 
@@ -90,7 +97,7 @@ class VideoSoftmaxEngine(ImageSoftmaxEngine):
             imgs = imgs.view(b * s, c, h, w)
             pids = pids.view(b, 1).expand(b, s)
             pids = pids.contiguous().view(b * s)
-        return imgs, pids
+        return self.to_memory_format(imgs), pids
 
     def extract_features(self, input):
         # b: batch size
@@ -100,7 +107,7 @@ class VideoSoftmaxEngine(ImageSoftmaxEngine):
         # w: width
         b, s, c, h, w = input.size()
         input = input.view(b * s, c, h, w)
-        features = self.model(input)
+        features = self.eval_model()(self.to_memory_format(input))
         features = features.view(b, s, -1)
         if self.pooling_method == 'avg':
             features = torch.mean(features, 1)
@@ -13,6 +13,8 @@ class VideoTripletEngine(ImageTripletEngine):
         model (nn.Module): model instance.
         optimizer (Optimizer): an Optimizer.
         margin (float, optional): margin for triplet loss. Default is 0.3.
+        mining (str, optional): triplet mining, "batch_hard" or "batch_all". Default is "batch_hard".
+        soft_margin (bool, optional): use soft-margin triplet loss. Default is False.
         weight_t (float, optional): weight for triplet loss. Default is 1.
         weight_x (float, optional): weight for softmax loss. Default is 1.
         scheduler (LRScheduler, optional): if None, no learning rate decay will be performed.
@@ -20,6 +22,9 @@ class VideoTripletEngine(ImageTripletEngine):
         label_smooth (bool, optional): use label smoothing regularizer. Default is True.
         pooling_method (str, optional): how to pool features for a tracklet.
             Default is "avg" (average). Choices are ["avg", "max"].
+        amp (bool, optional): train with automatic mixed precision. Default is False.
+        channels_last (bool, optional): use the channels_last memory format.
+            Default is False.
 
     Examples::
 
@@ -70,23 +75,31 @@ class VideoTripletEngine(ImageTripletEngine):
         model,
         optimizer,
         margin=0.3,
+        mining='batch_hard',
+        soft_margin=False,
         weight_t=1,
         weight_x=1,
         scheduler=None,
         use_gpu=True,
         label_smooth=True,
-        pooling_method='avg'
+        pooling_method='avg',
+        amp=False,
+        channels_last=False
     ):
         super(VideoTripletEngine, self).__init__(
             datamanager,
             model,
             optimizer,
             margin=margin,
+            mining=mining,
+            soft_margin=soft_margin,
             weight_t=weight_t,
             weight_x=weight_x,
             scheduler=scheduler,
             use_gpu=use_gpu,
-            label_smooth=label_smooth
+            label_smooth=label_smooth,
+            amp=amp,
+            channels_last=channels_last
         )
         self.pooling_method = pooling_method
 
@@ -103,7 +116,7 @@ class VideoTripletEngine(ImageTripletEngine):
             imgs = imgs.view(b * s, c, h, w)
             pids = pids.view(b, 1).expand(b, s)
             pids = pids.contiguous().view(b * s)
-        return imgs, pids
+        return self.to_memory_format(imgs), pids
 
     def extract_features(self, input):
         # b: batch size
@@ -113,7 +126,7 @@ class VideoTripletEngine(ImageTripletEngine):
         # w: width
         b, s, c, h, w = input.size()
         input = input.view(b * s, c, h, w)
-        features = self.model(input)
+        features = self.eval_model()(self.to_memory_format(input))
         features = features.view(b, s, -1)
         if self.pooling_method == 'avg':
             features = torch.mean(features, 1)
@@ -1,5 +1,4 @@
 from __future__ import division, absolute_import
-import torch
 import torch.nn as nn
 
 
@@ -22,7 +21,8 @@ class CrossEntropyLoss(nn.Module):
     Args:
         num_classes (int): number of classes.
         eps (float, optional): weight. Default is 0.1.
-        use_gpu (bool, optional): whether to use gpu devices. Default is True.
+        use_gpu (bool, optional): whether to use gpu devices. Default is True. Not used
+            anymore, the loss is computed on the device of the inputs.
         label_smooth (bool, optional): whether to apply label smoothing. Default is True.
     """
 
@@ -42,9 +42,10 @@ class CrossEntropyLoss(nn.Module):
                 Each position contains the label index.
         """
         log_probs = self.logsoftmax(inputs)
-        zeros = torch.zeros(log_probs.size())
-        targets = zeros.scatter_(1, targets.unsqueeze(1).data.cpu(), 1)
-        if self.use_gpu:
-            targets = targets.cuda()
-        targets = (1 - self.eps) * targets + self.eps / self.num_classes
-        return (-targets * log_probs).mean(0).sum()
+        # the smoothed one-hot labels are never materialized: the loss is split into
+        # the target log-probability and the sum of all log-probabilities
+        targets = targets.to(log_probs.device).unsqueeze(1)
+        loss = -(1 - self.eps) * log_probs.gather(1, targets).squeeze(1)
+        if self.eps > 0:
+            loss = loss - self.eps / self.num_classes * log_probs.sum(1)
+        return loss.mean(0)
@@ -1,23 +1,37 @@
 from __future__ import division, absolute_import
 import torch
 import torch.nn as nn
+from torch.nn import functional as F
 
 
 class TripletLoss(nn.Module):
     """Triplet loss with hard positive/negative mining.
-    
+
     Reference:
         Hermans et al. In Defense of the Triplet Loss for Person Re-Identification. arXiv:1703.07737.
-    
+
     Imported from `<https://github.com/Cysu/open-reid/blob/master/reid/loss/triplet.py>`_.
-    
+
     Args:
         margin (float, optional): margin for triplet. Default is 0.3.
+        mining (str, optional): "batch_hard" uses the hardest positive and negative
+            of each anchor, "batch_all" uses all the valid triplets of the batch and
+            averages the loss over the active (non-zero) ones. Default is "batch_hard".
+        soft_margin (bool, optional): replaces the hinge by the soft-margin
+            formulation log(1 + exp(d_ap - d_an)), in which case ``margin`` is not used.
+            Default is False.
     """
 
-    def __init__(self, margin=0.3):
+    def __init__(self, margin=0.3, mining='batch_hard', soft_margin=False):
         super(TripletLoss, self).__init__()
+        if mining not in ['batch_hard', 'batch_all']:
+            raise ValueError(
+                'Unknown triplet mining: {}. '
+                'Please choose either "batch_hard" or "batch_all"'.format(mining)
+            )
         self.margin = margin
+        self.mining = mining
+        self.soft_margin = soft_margin
         self.ranking_loss = nn.MarginRankingLoss(margin=margin)
 
     def forward(self, inputs, targets):
@@ -27,6 +41,9 @@ class TripletLoss(nn.Module):
             targets (torch.LongTensor): ground truth labels with shape (num_classes).
         """
         n = inputs.size(0)
+        # distances are computed in float32 under autocast as well, the margin is
+        # below the resolution of float16 at typical distances
+        inputs = inputs.float()
 
         # Compute pairwise distance, replace by the official when merged
         dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
@@ -34,15 +51,32 @@ class TripletLoss(nn.Module):
         dist.addmm_(inputs, inputs.t(), beta=1, alpha=-2)
         dist = dist.clamp(min=1e-12).sqrt() # for numerical stability
 
-        # For each anchor, find the hardest positive and negative
         mask = targets.expand(n, n).eq(targets.expand(n, n).t())
-        dist_ap, dist_an = [], []
-        for i in range(n):
-            dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
-            dist_an.append(dist[i][mask[i] == 0].min().unsqueeze(0))
-        dist_ap = torch.cat(dist_ap)
-        dist_an = torch.cat(dist_an)
+
+        if self.mining == 'batch_all':
+            return self._batch_all(dist, mask)
+
+        # For each anchor, find the hardest positive and negative
+        dist_ap = dist.masked_fill(~mask, float('-inf')).max(dim=1)[0]
+        dist_an = dist.masked_fill(mask, float('inf')).min(dim=1)[0]
+
+        if self.soft_margin:
+            return F.softplus(dist_ap - dist_an).mean()
 
         # Compute ranking hinge loss
         y = torch.ones_like(dist_an)
         return self.ranking_loss(dist_an, dist_ap, y)
+
+    def _batch_all(self, dist, mask):
+        # valid[a, p, n]: p is a positive of anchor a (other than a) and n a negative
+        eye = torch.eye(dist.size(0), dtype=torch.bool, device=dist.device)
+        valid = (mask & ~eye).unsqueeze(2) & (~mask).unsqueeze(1)
+        diff = dist.unsqueeze(2) - dist.unsqueeze(1)
+
+        if self.soft_margin:
+            losses = F.softplus(diff[valid])
+            return losses.sum() / max(losses.numel(), 1)
+
+        losses = F.relu(diff[valid] + self.margin)
+        num_active = (losses > 0).sum().clamp(min=1)
+        return losses.sum() / num_active
@@ -1,5 +1,9 @@
 from __future__ import absolute_import
 
-from .rank import evaluate_rank
+from .rank import evaluate_rank, evaluate_rank_streaming, rank_gallery
 from .accuracy import accuracy
-from .distance import compute_distance_matrix
+from .distance import (
+    BlockDistanceMatrix, compute_distance_matrix, compute_blocked_distance_matrix,
+    compute_distance_matrix_chunked
+)
+from .retrieval import topk_retrieval
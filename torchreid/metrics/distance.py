@@ -1,4 +1,5 @@
 from __future__ import division, print_function, absolute_import
+import numpy as np
 import torch
 from torch.nn import functional as F
 
@@ -56,11 +57,11 @@ def euclidean_squared_distance(input1, input2):
     Returns:
         torch.Tensor: distance matrix.
     """
-    m, n = input1.size(0), input2.size(0)
-    mat1 = torch.pow(input1, 2).sum(dim=1, keepdim=True).expand(m, n)
-    mat2 = torch.pow(input2, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-    distmat = mat1 + mat2
-    distmat.addmm_(input1, input2.t(), beta=1, alpha=-2)
+    mat1 = torch.pow(input1, 2).sum(dim=1, keepdim=True)
+    mat2 = torch.pow(input2, 2).sum(dim=1, keepdim=True).t()
+    # the squared norms are broadcast, so that the result is the only m-by-n allocation
+    distmat = torch.addmm(mat1, input1, input2.t(), beta=1, alpha=-2)
+    distmat.add_(mat2)
     return distmat
 
 
@@ -78,3 +79,241 @@ def cosine_distance(input1, input2):
     input2_normed = F.normalize(input2, p=2, dim=1)
     distmat = 1 - torch.mm(input1_normed, input2_normed.t())
     return distmat
+
+
+def compute_distance_matrix_chunked(
+    input1,
+    input2,
+    metric='euclidean',
+    max_memory=256 * 1024**2,
+    out=None,
+    consumer=None
+):
+    """Computes distance matrix block by block with a bounded memory footprint.
+
+    ``input1`` rows are streamed against ``input2`` rows by blocks whose
+    distances take at most ``max_memory`` bytes. Each block is written to
+    ``out`` (e.g. a ``numpy.memmap`` so that the full matrix lives on disk)
+    and/or handed over to ``consumer``, so that peak memory no longer depends
+    on the number of gallery samples.
+
+    Args:
+        input1 (torch.Tensor): 2-D feature matrix.
+        input2 (torch.Tensor): 2-D feature matrix.
+        metric (str, optional): "euclidean" or "cosine".
+            Default is "euclidean".
+        max_memory (int, optional): maximum number of bytes of a block of
+            distances. Default is 256MB.
+        out (numpy.ndarray, optional): float32 output array of shape (m, n).
+            If None and ``consumer`` is None, it is allocated in memory.
+        consumer (callable, optional): called as ``consumer(distmat, row, col)``
+            for each block ``distmat`` (numpy.ndarray) starting at position
+            (row, col) of the full distance matrix.
+
+    Returns:
+        numpy.ndarray: ``out``, or None if only ``consumer`` is given.
+
+    Examples::
+       >>> from torchreid import metrics
+       >>> input1 = torch.rand(10, 2048)
+       >>> input2 = torch.rand(100000, 2048)
+       >>> out = np.memmap(
+       >>>     'distmat.dat', dtype=np.float32, mode='w+', shape=(10, 100000)
+       >>> )
+       >>> distmat = metrics.compute_distance_matrix_chunked(
+       >>>     input1, input2, max_memory=64 * 1024**2, out=out
+       >>> )
+    """
+    m, n = input1.size(0), input2.size(0)
+    if out is None and consumer is None:
+        out = np.empty((m, n), dtype=np.float32)
+    if out is not None:
+        assert out.shape == (m, n)
+
+    # one block of float32 distances holds at most max_memory bytes
+    max_numel = max(1, max_memory // 4)
+    col_step = max(1, min(n, max_numel))
+    row_step = max(1, min(m, max_numel // col_step))
+
+    if metric == 'cosine':
+        # normalize once instead of for every block
+        input1 = F.normalize(input1, p=2, dim=1)
+        input2 = F.normalize(input2, p=2, dim=1)
+
+    for row in range(0, m, row_step):
+        block1 = input1[row:row + row_step]
+        for col in range(0, n, col_step):
+            block2 = input2[col:col + col_step]
+            if metric == 'cosine':
+                distmat = 1 - torch.mm(block1, block2.t())
+            else:
+                distmat = compute_distance_matrix(block1, block2, metric)
+            distmat = distmat.cpu().numpy()
+            if out is not None:
+                out[row:row + row_step, col:col + col_step] = distmat
+            if consumer is not None:
+                consumer(distmat, row, col)
+
+    return out
+
+
+class BlockDistanceMatrix(object):
+    """Distance matrix restricted to query/gallery pairs sharing the same group.
+
+    Only the diagonal blocks of the (num_query, num_gallery) distance matrix
+    are stored, i.e. one dense block per group label. For SoccerNet, the
+    group label is the action index stored in the camid slot.
+
+    Args:
+        blocks (list): contains tuples of (q_indices, g_indices, distmat),
+            where ``distmat`` is a numpy.ndarray of shape
+            (len(q_indices), len(g_indices)).
+        num_query (int): total number of query instances.
+        num_gallery (int): total number of gallery instances.
+    """
+
+    def __init__(self, blocks, num_query, num_gallery):
+        self.blocks = blocks
+        self.num_query = num_query
+        self.num_gallery = num_gallery
+
+    @property
+    def shape(self):
+        return self.num_query, self.num_gallery
+
+    @property
+    def size(self):
+        """Returns the number of stored distances."""
+        return sum(distmat.size for _, _, distmat in self.blocks)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @classmethod
+    def from_dense(cls, distmat, groups1, groups2):
+        """Extracts the per-group blocks of a dense distance matrix.
+
+        Args:
+            distmat (numpy.ndarray): distance matrix of shape (m, n).
+            groups1 (numpy.ndarray): 1-D array of m group labels.
+            groups2 (numpy.ndarray): 1-D array of n group labels.
+        """
+        num_query, num_gallery = distmat.shape
+        g_groups = group_indices(groups2)
+        blocks = []
+        for label, q_indices in group_indices(groups1).items():
+            g_indices = g_groups.get(label, np.empty(0, dtype=np.int64))
+            blocks.append(
+                (q_indices, g_indices, distmat[np.ix_(q_indices, g_indices)])
+            )
+        return cls(blocks, num_query, num_gallery)
+
+    def argsort(self, topk=None):
+        """Sorts gallery instances by increasing distance for each query.
+
+        Args:
+            topk (int, optional): only sorts the ``topk`` closest gallery
+                instances of each query. Default is None (sorts all).
+
+        Returns:
+            list: ``num_query`` 1-D arrays of gallery indices, each containing
+            only the gallery instances from the same group as the query.
+        """
+        indices = [np.empty(0, dtype=np.int64)] * self.num_query
+        for q_indices, g_indices, distmat in self.blocks:
+            order = g_indices[partial_argsort(distmat, topk)]
+            for q_idx, g_ranking in zip(q_indices, order):
+                indices[q_idx] = g_ranking
+        return indices
+
+
+def partial_argsort(distmat, topk=None):
+    """Sorts each row of a distance matrix by increasing distance.
+
+    When ``topk`` is smaller than the number of columns, only the ``topk``
+    smallest distances of each row are selected with ``np.argpartition``
+    and then sorted, i.e. O(n + k*log(k)) per row instead of O(n*log(n)).
+
+    Args:
+        distmat (numpy.ndarray): distance matrix of shape (m, n).
+        topk (int, optional): number of sorted positions to return for each
+            row. Default is None (full sort).
+
+    Returns:
+        numpy.ndarray: column indices of shape (m, min(topk, n)).
+    """
+    num_cols = distmat.shape[1]
+    if topk is None or topk >= num_cols:
+        return np.argsort(distmat, axis=1)
+    if topk <= 0:
+        return np.empty((distmat.shape[0], 0), dtype=np.int64)
+    indices = np.argpartition(distmat, topk - 1, axis=1)[:, :topk]
+    order = np.argsort(np.take_along_axis(distmat, indices, axis=1), axis=1)
+    return np.take_along_axis(indices, order, axis=1)
+
+
+def group_indices(groups):
+    """Groups instance indices by label.
+
+    Args:
+        groups (numpy.ndarray): 1-D array of group labels.
+
+    Returns:
+        dict: group label to 1-D array of (sorted) instance indices.
+    """
+    groups = np.asarray(groups)
+    order = np.argsort(groups, kind='stable')
+    labels, starts = np.unique(groups[order], return_index=True)
+    return {
+        label: idxs
+        for label, idxs in zip(labels.tolist(), np.split(order, starts[1:]))
+    }
+
+
+def compute_blocked_distance_matrix(
+    input1, input2, groups1, groups2, metric='euclidean'
+):
+    """Computes distances only between instances sharing the same group.
+
+    Compared to :func:`compute_distance_matrix`, cost and memory go down from
+    O(m*n) to the sum of the per-group block sizes.
+
+    Args:
+        input1 (torch.Tensor): 2-D feature matrix.
+        input2 (torch.Tensor): 2-D feature matrix.
+        groups1 (numpy.ndarray): 1-D array of group labels for ``input1``.
+        groups2 (numpy.ndarray): 1-D array of group labels for ``input2``.
+        metric (str, optional): "euclidean" or "cosine".
+            Default is "euclidean".
+
+    Returns:
+        BlockDistanceMatrix: per-group distance blocks.
+
+    Examples::
+       >>> from torchreid import metrics
+       >>> input1 = torch.rand(10, 2048)
+       >>> input2 = torch.rand(100, 2048)
+       >>> groups1 = np.random.randint(0, 3, 10)
+       >>> groups2 = np.random.randint(0, 3, 100)
+       >>> distmat = metrics.compute_blocked_distance_matrix(
+       >>>     input1, input2, groups1, groups2
+       >>> )
+       >>> distmat.shape # (10, 100)
+    """
+    assert len(groups1) == input1.size(0)
+    assert len(groups2) == input2.size(0)
+
+    g_groups = group_indices(groups2)
+    blocks = []
+    for label, q_indices in group_indices(groups1).items():
+        g_indices = g_groups.get(label, np.empty(0, dtype=np.int64))
+        distmat = compute_distance_matrix(
+            input1[torch.from_numpy(q_indices)],
+            input2[torch.from_numpy(g_indices)], metric
+        )
+        blocks.append((q_indices, g_indices, distmat.numpy()))
+
+    return BlockDistanceMatrix(blocks, input1.size(0), input2.size(0))
@@ -3,6 +3,9 @@ import numpy as np
 import warnings
 from collections import defaultdict
 
+from .distance import BlockDistanceMatrix, partial_argsort
+from .retrieval import rank_matches_streaming
+
 try:
     from torchreid.metrics.rank_cylib.rank_cy import evaluate_cy
     IS_CYTHON_AVAI = True
@@ -15,8 +18,23 @@ except ImportError:
 
 
 def eval_soccernetv3(distmat, q_pids, g_pids, q_action_indices, g_action_indices, max_rank):
-    """Evaluation with market1501 metric
-    Key: for each query identity, its gallery images from the same camera view are discarded.
+    """Evaluation with soccernetv3 metric
+    Key: for each query, only gallery samples from the same action are ranked.
+    The dense distance matrix is split into per-action blocks, which are ranked
+    and scored with batched numpy operations by ``eval_soccernetv3_blocked``.
+    """
+    distmat = BlockDistanceMatrix.from_dense(
+        distmat, q_action_indices, g_action_indices
+    )
+    return eval_soccernetv3_blocked(
+        distmat, q_pids, g_pids, q_action_indices, g_action_indices, max_rank
+    )
+
+
+def eval_soccernetv3_blocked(distmat, q_pids, g_pids, q_action_indices, g_action_indices, max_rank):
+    """Evaluation with soccernetv3 metric on a :class:`BlockDistanceMatrix`.
+    Key: each action block is ranked and scored at once with batched numpy operations,
+    only gallery samples from the same action as the query are ranked.
     """
     num_q, num_g = distmat.shape
 
@@ -27,59 +45,58 @@ def eval_soccernetv3(distmat, q_pids, g_pids, q_action_indices, g_action_indices
             format(num_g)
         )
 
-    indices = np.argsort(distmat, axis=1)
-    matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
-
-    # compute cmc curve for each query
     all_cmc = []
     all_AP = []
-    num_valid_q = 0. # number of valid query
     smallest_ranking_size = max_rank
 
-    for q_idx in range(num_q):
-        # get query pid and action_idx
-        q_pid = q_pids[q_idx]
-        q_action_idx = q_action_indices[q_idx]
-
-        # remove gallery samples from different action than the query
-        order = indices[q_idx]
-        remove = (g_action_indices[order] != q_action_idx)
-        keep = np.invert(remove)
-
-        # compute cmc curve
-        raw_cmc = matches[q_idx][
-            keep] # binary vector, positions with value 1 are correct matches
-        if not np.any(raw_cmc):
-            print("Does not appear in gallery: q_idx {} - q_pid {} - q_action_idx {}".format(q_idx, q_pid, q_action_idx))
-            # this condition is true when query identity does not appear in gallery
+    for q_indices, g_indices, block in distmat:
+        # binary matrix, positions with value 1 are correct matches
+        order = np.argsort(block, axis=1)
+        raw_cmc = (
+            g_pids[g_indices][order] == q_pids[q_indices][:, np.newaxis]
+        ).astype(np.int32)
+
+        valid = raw_cmc.any(axis=1)
+        for q_idx in q_indices[~valid]:
+            print("Does not appear in gallery: q_idx {} - q_pid {} - q_action_idx {}".format(q_idx, q_pids[q_idx], q_action_indices[q_idx]))
+        raw_cmc = raw_cmc[valid]
+        if raw_cmc.shape[0] == 0:
             continue
 
-        cmc = raw_cmc.cumsum()
+        cmc = raw_cmc.cumsum(axis=1)
         cmc[cmc > 1] = 1
-        cmc = cmc[:max_rank]
-        if smallest_ranking_size > cmc.size:
-            smallest_ranking_size = cmc.size
-
+        cmc = cmc[:, :max_rank]
+        smallest_ranking_size = min(smallest_ranking_size, cmc.shape[1])
         all_cmc.append(cmc)
-        num_valid_q += 1.
 
         # compute average precision
-        # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
-        num_rel = raw_cmc.sum()
-        tmp_cmc = raw_cmc.cumsum()
-        tmp_cmc = [x / (i+1.) for i, x in enumerate(tmp_cmc)]
-        tmp_cmc = np.asarray(tmp_cmc) * raw_cmc
-        AP = tmp_cmc.sum() / num_rel
+        num_rel = raw_cmc.sum(axis=1)
+        tmp_cmc = raw_cmc.cumsum(axis=1) / np.arange(1., raw_cmc.shape[1] + 1)
+        AP = (tmp_cmc * raw_cmc).sum(axis=1) / num_rel
         all_AP.append(AP)
 
-    all_cmc = [np.concatenate((np.array(cmc[:smallest_ranking_size]), np.zeros(max_rank-smallest_ranking_size, dtype=np.int64)))
-               for cmc in all_cmc] # np.cat(cmc[:smallest_ranking_size], np.zeros(max_rank-smallest_ranking_size))
-    all_cmc = np.asarray(all_cmc).astype(np.float32)
-    all_cmc = all_cmc.sum(0) / num_valid_q  # size = 174
-    mAP = np.mean(all_AP)
+    num_valid_q = float(sum(cmc.shape[0] for cmc in all_cmc))
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+
+    all_cmc = [
+        np.concatenate(
+            (
+                cmc[:, :smallest_ranking_size],
+                np.zeros(
+                    (cmc.shape[0], max_rank - smallest_ranking_size),
+                    dtype=cmc.dtype
+                )
+            ),
+            axis=1
+        ) for cmc in all_cmc
+    ]
+    all_cmc = np.concatenate(all_cmc).astype(np.float32)
+    all_cmc = all_cmc.sum(0) / num_valid_q
+    mAP = np.mean(np.concatenate(all_AP))
 
     return all_cmc, mAP
 
+
 def eval_cuhk03(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
     """Evaluation with cuhk03 metric
     Key: one image for each gallery identity is randomly sampled for each query identity.
@@ -157,9 +174,41 @@ def eval_cuhk03(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
     return all_cmc, mAP
 
 
+def rank_matches(dist, keep, matches):
+    """Computes the ranks of the correct matches without sorting the gallery.
+
+    The rank of a correct match is given by the number of kept gallery samples
+    that are closer to the query. Those counts are obtained with a single
+    O(G*log(P)) pass, where P is the number of correct matches, instead of the
+    O(G*log(G)) full sort. Correct matches at equal distance from the query are
+    ranked one after the other.
+
+    Args:
+        dist (numpy.ndarray): 1-D array of query to gallery distances.
+        keep (numpy.ndarray): 1-D boolean array, gallery samples to be ranked.
+        matches (numpy.ndarray): 1-D boolean array, correct matches (subset of ``keep``).
+
+    Returns:
+        numpy.ndarray: sorted 1-based ranks of the correct matches.
+    """
+    match_dist = np.sort(dist[matches])
+    num_matches = match_dist.size
+    # a kept sample is closer than the i-th match iff at most i matches are not farther than it
+    num_closer = np.bincount(
+        np.searchsorted(match_dist, dist[keep], side='right'),
+        minlength=num_matches + 1
+    ).cumsum()[:num_matches]
+    num_tied = np.arange(num_matches) - np.searchsorted(
+        match_dist, match_dist, side='left'
+    )
+    return num_closer + num_tied + 1
+
+
 def eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
     """Evaluation with market1501 metric
     Key: for each query identity, its gallery images from the same camera view are discarded.
+    Both cmc and AP are computed from the ranks of the correct matches, so that the
+    gallery never needs to be sorted.
     """
     num_q, num_g = distmat.shape
 
@@ -170,9 +219,6 @@ def eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
             format(num_g)
         )
 
-    indices = np.argsort(distmat, axis=1)
-    matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
-
     # compute cmc curve for each query
     all_cmc = []
     all_AP = []
@@ -184,30 +230,25 @@ def eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
         q_camid = q_camids[q_idx]
 
         # remove gallery samples that have the same pid and camid with query
-        order = indices[q_idx]
-        remove = (g_pids[order] == q_pid) & (g_camids[order] == q_camid)
-        keep = np.invert(remove)
-
-        # compute cmc curve
-        raw_cmc = matches[q_idx][
-            keep] # binary vector, positions with value 1 are correct matches
-        if not np.any(raw_cmc):
+        same_pid = (g_pids == q_pid)
+        keep = np.invert(same_pid & (g_camids == q_camid))
+        matches = same_pid & keep
+        if not np.any(matches):
             # this condition is true when query identity does not appear in gallery
             continue
 
-        cmc = raw_cmc.cumsum()
-        cmc[cmc > 1] = 1
+        ranks = rank_matches(distmat[q_idx], keep, matches)
+
+        # compute cmc curve
+        cmc = np.zeros(max_rank, dtype=np.int32)
+        cmc[ranks[0] - 1:] = 1
 
-        all_cmc.append(cmc[:max_rank])
+        all_cmc.append(cmc)
         num_valid_q += 1.
 
         # compute average precision
         # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
-        num_rel = raw_cmc.sum()
-        tmp_cmc = raw_cmc.cumsum()
-        tmp_cmc = [x / (i+1.) for i, x in enumerate(tmp_cmc)]
-        tmp_cmc = np.asarray(tmp_cmc) * raw_cmc
-        AP = tmp_cmc.sum() / num_rel
+        AP = np.mean(np.arange(1., ranks.size + 1) / ranks)
         all_AP.append(AP)
 
     assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
@@ -232,6 +273,112 @@ def evaluate_py(
         raise ValueError("Incorrect eval_metric value '{}'".format(eval_metric))
 
 
+def rank_gallery(distmat, topk=None, q_groups=None, g_groups=None):
+    """Sorts gallery samples by increasing distance for each query.
+
+    This is meant to be computed once per evaluation and shared by the
+    consumers of the ranking, e.g. ranking results export and visualization.
+
+    Args:
+        distmat (numpy.ndarray or BlockDistanceMatrix): distance matrix of shape
+            (num_query, num_gallery).
+        topk (int, optional): only the ``topk`` closest gallery samples are sorted
+            for each query (partial sort based on ``np.argpartition``). Default is
+            None (full sort).
+        q_groups (numpy.ndarray, optional): 1-D array of query group labels, e.g.
+            SoccerNet action indices. If given with ``g_groups``, only gallery
+            samples from the same group as the query are ranked.
+        g_groups (numpy.ndarray, optional): 1-D array of gallery group labels.
+
+    Returns:
+        numpy.ndarray of shape (num_query, k) or, when groups are involved, a list of
+        ``num_query`` 1-D arrays of gallery indices.
+    """
+    if isinstance(distmat, BlockDistanceMatrix):
+        return distmat.argsort(topk)
+    if q_groups is not None and g_groups is not None:
+        distmat = BlockDistanceMatrix.from_dense(distmat, q_groups, g_groups)
+        return distmat.argsort(topk)
+    return partial_argsort(distmat, topk)
+
+
+def evaluate_rank_streaming(
+    qf,
+    gf,
+    q_pids,
+    g_pids,
+    q_camids,
+    g_camids,
+    max_rank=50,
+    eval_metric='default',
+    metric='euclidean',
+    max_memory=256 * 1024**2
+):
+    """Evaluates CMC rank from features, without materializing the distance matrix.
+
+    The gallery is streamed by chunks to compute the ranks of the correct matches
+    of each query (see :func:`torchreid.metrics.retrieval.rank_matches_streaming`),
+    from which both cmc and AP are computed exactly, i.e. results are the same as
+    :func:`evaluate_rank` on the full distance matrix.
+
+    Args:
+        qf (torch.Tensor): 2-D query feature matrix.
+        gf (torch.Tensor): 2-D gallery feature matrix.
+        q_pids (numpy.ndarray): 1-D array containing person identities
+            of each query instance.
+        g_pids (numpy.ndarray): 1-D array containing person identities
+            of each gallery instance.
+        q_camids (numpy.ndarray): 1-D array containing camera views under
+            which each query instance is captured.
+        g_camids (numpy.ndarray): 1-D array containing camera views under
+            which each gallery instance is captured.
+        max_rank (int, optional): maximum CMC rank to be computed. Default is 50.
+        eval_metric (str, optional): multi-gallery-shot setting with 'default' or
+            action-to-replay setting with 'soccernetv3'. Default is 'default'.
+        metric (str, optional): "euclidean" or "cosine". Default is "euclidean".
+        max_memory (int, optional): maximum number of bytes of a chunk of
+            distances. Default is 256MB.
+    """
+    num_g = gf.size(0)
+    if num_g < max_rank:
+        max_rank = num_g
+        print(
+            'Note: number of gallery samples is quite small, got {}'.
+            format(num_g)
+        )
+
+    all_ranks = rank_matches_streaming(
+        qf, gf, q_pids, g_pids, q_camids, g_camids, eval_metric, metric,
+        max_memory
+    )
+    valid = np.array([ranks.size > 0 for ranks in all_ranks], dtype=bool)
+    if eval_metric == 'soccernetv3':
+        for q_idx in np.flatnonzero(~valid):
+            print("Does not appear in gallery: q_idx {} - q_pid {} - q_action_idx {}".format(q_idx, q_pids[q_idx], q_camids[q_idx]))
+
+    num_valid_q = float(valid.sum())
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+    all_ranks = [ranks for ranks, v in zip(all_ranks, valid) if v]
+
+    # compute cmc curve for each query from the rank of its first correct match
+    first_ranks = np.array([ranks[0] for ranks in all_ranks])
+    all_cmc = (first_ranks[:, np.newaxis] <= np.arange(1, max_rank + 1))
+    all_cmc = all_cmc.astype(np.float32)
+    if eval_metric == 'soccernetv3':
+        # cmc is cut to the size of the smallest ranking, i.e. action gallery
+        labels, counts = np.unique(g_camids, return_counts=True)
+        q_counts = counts[np.searchsorted(labels, np.asarray(q_camids)[valid])]
+        all_cmc[:, min(max_rank, q_counts.min()):] = 0
+    all_cmc = all_cmc.sum(0) / num_valid_q
+
+    # compute average precision
+    mAP = np.mean(
+        [np.mean(np.arange(1., ranks.size + 1) / ranks) for ranks in all_ranks]
+    )
+
+    return all_cmc, mAP
+
+
 def evaluate_rank(
     distmat,
     q_pids,
@@ -245,7 +392,9 @@ def evaluate_rank(
     """Evaluates CMC rank.
 
     Args:
-        distmat (numpy.ndarray): distance matrix of shape (num_query, num_gallery).
+        distmat (numpy.ndarray or BlockDistanceMatrix): distance matrix of shape
+            (num_query, num_gallery). A ``BlockDistanceMatrix`` holding per-action
+            blocks is only supported with ``eval_metric='soccernetv3'``.
         q_pids (numpy.ndarray): 1-D array containing person identities
             of each query instance.
         g_pids (numpy.ndarray): 1-D array containing person identities
@@ -262,8 +411,18 @@ def evaluate_rank(
             This is highly recommended as the cython code can speed up the cmc computation
             by more than 10x. This requires Cython to be installed.
     """
-    if use_cython and IS_CYTHON_AVAI and eval_metric != 'soccernetv3':
-        return evaluate_py(
+    if isinstance(distmat, BlockDistanceMatrix):
+        if eval_metric != 'soccernetv3':
+            raise ValueError(
+                "A BlockDistanceMatrix can only be evaluated with "
+                "eval_metric='soccernetv3', got '{}'".format(eval_metric)
+            )
+        return eval_soccernetv3_blocked(
+            distmat, q_pids, g_pids, q_camids, g_camids, max_rank
+        )
+
+    if use_cython and IS_CYTHON_AVAI:
+        return evaluate_cy(
             distmat, q_pids, g_pids, q_camids, g_camids, max_rank,
             eval_metric
         )
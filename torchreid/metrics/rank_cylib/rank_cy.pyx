@@ -34,12 +34,109 @@ cpdef evaluate_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, eval_me
     elif eval_metric == 'cuhk03':
         return eval_cuhk03_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
     elif eval_metric == 'soccernetv3':
-        raise NotImplementedError
-        # return eval_soccernetv3_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
+        return eval_soccernetv3_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
     else:
         raise ValueError("Incorrect eval_metric value '{}'".format(eval_metric))
 
 
+cpdef eval_soccernetv3_cy(float[:,:] distmat, int64_t[:] q_pids, int64_t[:]g_pids,
+                          int64_t[:]q_action_indices, int64_t[:]g_action_indices, int64_t max_rank):
+
+    cdef int64_t num_q = distmat.shape[0]
+    cdef int64_t num_g = distmat.shape[1]
+
+    if num_g < max_rank:
+        max_rank = num_g
+        print('Note: number of gallery samples is quite small, got {}'.format(num_g))
+
+    cdef:
+        # query and gallery indices sorted by action, each action forms a block
+        int64_t[:] q_order = np.argsort(q_action_indices, kind='stable')
+        int64_t[:] g_order = np.argsort(g_action_indices, kind='stable')
+        int64_t[:] block_q, block_g
+        int64_t[:,:] indices
+
+        float[:,:] all_cmc = np.zeros((num_q, max_rank), dtype=np.float32)
+        float[:] all_AP = np.zeros(num_q, dtype=np.float32)
+        float num_valid_q = 0. # number of valid query
+        int64_t smallest_ranking_size = max_rank
+
+        int64_t q_start = 0
+        int64_t g_start = 0
+        int64_t q_end, g_end, num_g_real
+        int64_t action_idx, q_idx, q_pid, block_q_idx, rank_idx, first_match
+
+        float num_rel
+        float tmp_cmc_sum
+
+    while q_start < num_q:
+        # find the query and gallery samples of the current action
+        action_idx = q_action_indices[q_order[q_start]]
+        q_end = q_start + 1
+        while q_end < num_q and q_action_indices[q_order[q_end]] == action_idx:
+            q_end += 1
+        while g_start < num_g and g_action_indices[g_order[g_start]] < action_idx:
+            g_start += 1
+        g_end = g_start
+        while g_end < num_g and g_action_indices[g_order[g_end]] == action_idx:
+            g_end += 1
+
+        # only rank gallery samples from the same action as the query
+        num_g_real = g_end - g_start
+        block_q = q_order[q_start:q_end]
+        block_g = g_order[g_start:g_end]
+        indices = np.argsort(
+            np.asarray(distmat)[np.ix_(np.asarray(block_q), np.asarray(block_g))], axis=1
+        )
+
+        for block_q_idx in range(q_end - q_start):
+            q_idx = block_q[block_q_idx]
+            q_pid = q_pids[q_idx]
+
+            # compute cmc and average precision in a single pass
+            # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
+            num_rel = 0
+            tmp_cmc_sum = 0
+            first_match = -1
+            for rank_idx in range(num_g_real):
+                if g_pids[block_g[indices[block_q_idx, rank_idx]]] == q_pid:
+                    num_rel += 1
+                    tmp_cmc_sum += num_rel / (rank_idx + 1.)
+                    if first_match < 0:
+                        first_match = rank_idx
+
+            if first_match < 0:
+                # this condition is true when query identity does not appear in gallery
+                print('Does not appear in gallery: q_idx {} - q_pid {} - q_action_idx {}'.format(q_idx, q_pid, action_idx))
+                continue
+
+            for rank_idx in range(first_match, max_rank):
+                all_cmc[q_idx, rank_idx] = 1
+            if num_g_real < smallest_ranking_size:
+                smallest_ranking_size = num_g_real
+            all_AP[q_idx] = tmp_cmc_sum / num_rel
+            num_valid_q += 1.
+
+        q_start = q_end
+        g_start = g_end
+
+    assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
+
+    # compute averaged cmc, ranks beyond the smallest ranking list are left to zero
+    cdef float[:] avg_cmc = np.zeros(max_rank, dtype=np.float32)
+    for rank_idx in range(smallest_ranking_size):
+        for q_idx in range(num_q):
+            avg_cmc[rank_idx] += all_cmc[q_idx, rank_idx]
+        avg_cmc[rank_idx] /= num_valid_q
+
+    cdef float mAP = 0
+    for q_idx in range(num_q):
+        mAP += all_AP[q_idx]
+    mAP /= num_valid_q
+
+    return np.asarray(avg_cmc).astype(np.float32), mAP
+
+
 cpdef eval_cuhk03_cy(float[:,:] distmat, int64_t[:] q_pids, int64_t[:]g_pids,
                      int64_t[:]q_camids, int64_t[:]g_camids, int64_t max_rank):
 
@@ -170,24 +267,18 @@ cpdef eval_market1501_cy(float[:,:] distmat, int64_t[:] q_pids, int64_t[:]g_pids
         print('Note: number of gallery samples is quite small, got {}'.format(num_g))
 
     cdef:
-        int64_t[:,:] indices = np.argsort(distmat, axis=1)
-        int64_t[:,:] matches = (np.asarray(g_pids)[np.asarray(indices)] == np.asarray(q_pids)[:, np.newaxis]).astype(np.int64)
-
         float[:,:] all_cmc = np.zeros((num_q, max_rank), dtype=np.float32)
         float[:] all_AP = np.zeros(num_q, dtype=np.float32)
         float num_valid_q = 0. # number of valid query
 
-        int64_t q_idx, q_pid, q_camid, g_idx
-        int64_t[:] order = np.zeros(num_g, dtype=np.int64)
-        int64_t keep
+        int64_t q_idx, q_pid, q_camid, g_idx, rank_idx
 
-        float[:] raw_cmc = np.zeros(num_g, dtype=np.float32) # binary vector, positions with value 1 are correct matches
-        float[:] cmc = np.zeros(num_g, dtype=np.float32)
-        int64_t num_g_real, rank_idx
-        uint64_t meet_condition
+        # the gallery is not sorted, correct matches are ranked by counting
+        # the kept gallery samples that are closer to the query
+        float[:] match_dist = np.zeros(num_g, dtype=np.float32)
+        int64_t[:] num_closer = np.zeros(num_g + 1, dtype=np.int64)
+        int64_t num_matches, match_idx, first_tied, rank
 
-        float num_rel
-        float[:] tmp_cmc = np.zeros(num_g, dtype=np.float32)
         float tmp_cmc_sum
 
     for q_idx in range(num_q):
@@ -195,42 +286,43 @@ cpdef eval_market1501_cy(float[:,:] distmat, int64_t[:] q_pids, int64_t[:]g_pids
         q_pid = q_pids[q_idx]
         q_camid = q_camids[q_idx]
 
-        # remove gallery samples that have the same pid and camid with query
-        for g_idx in range(num_g):
-            order[g_idx] = indices[q_idx, g_idx]
-        num_g_real = 0
-        meet_condition = 0
-
+        # collect distances of correct matches, i.e. same pid but different camid
+        num_matches = 0
         for g_idx in range(num_g):
-            if (g_pids[order[g_idx]] != q_pid) or (g_camids[order[g_idx]] != q_camid):
-                raw_cmc[num_g_real] = matches[q_idx][g_idx]
-                num_g_real += 1
-                if matches[q_idx][g_idx] > 1e-31:
-                    meet_condition = 1
+            if g_pids[g_idx] == q_pid and g_camids[g_idx] != q_camid:
+                match_dist[num_matches] = distmat[q_idx, g_idx]
+                num_matches += 1
 
-        if not meet_condition:
+        if num_matches == 0:
             # this condition is true when query identity does not appear in gallery
             continue
 
-        # compute cmc
-        function_cumsum(raw_cmc, cmc, num_g_real)
-        for g_idx in range(num_g_real):
-            if cmc[g_idx] > 1:
-                cmc[g_idx] = 1
+        np.asarray(match_dist[:num_matches]).sort()
 
-        for rank_idx in range(max_rank):
-            all_cmc[q_idx, rank_idx] = cmc[rank_idx]
-        num_valid_q += 1.
+        # remove gallery samples that have the same pid and camid with query
+        for match_idx in range(num_matches + 1):
+            num_closer[match_idx] = 0
+        for g_idx in range(num_g):
+            if (g_pids[g_idx] != q_pid) or (g_camids[g_idx] != q_camid):
+                num_closer[function_upper_bound(match_dist, num_matches, distmat[q_idx, g_idx])] += 1
 
-        # compute average precision
+        # compute cmc and average precision
         # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
-        function_cumsum(raw_cmc, tmp_cmc, num_g_real)
-        num_rel = 0
         tmp_cmc_sum = 0
-        for g_idx in range(num_g_real):
-            tmp_cmc_sum += (tmp_cmc[g_idx] / (g_idx + 1.)) * raw_cmc[g_idx]
-            num_rel += raw_cmc[g_idx]
-        all_AP[q_idx] = tmp_cmc_sum / num_rel
+        first_tied = 0
+        for match_idx in range(num_matches):
+            if match_idx > 0:
+                num_closer[match_idx] += num_closer[match_idx - 1]
+            if match_dist[match_idx] != match_dist[first_tied]:
+                first_tied = match_idx
+            rank = num_closer[match_idx] + (match_idx - first_tied) + 1
+            tmp_cmc_sum += (match_idx + 1.) / rank
+            if match_idx == 0:
+                for rank_idx in range(rank - 1, max_rank):
+                    all_cmc[q_idx, rank_idx] = 1
+
+        all_AP[q_idx] = tmp_cmc_sum / num_matches
+        num_valid_q += 1.
 
     assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
 
@@ -249,6 +341,20 @@ cpdef eval_market1501_cy(float[:,:] distmat, int64_t[:] q_pids, int64_t[:]g_pids
     return np.asarray(avg_cmc).astype(np.float32), mAP
 
 
+# Compute the number of values in the sorted array src[:n] that are not greater than value
+cdef int64_t function_upper_bound(float[:] src, int64_t n, float value):
+    cdef int64_t lo = 0
+    cdef int64_t hi = n
+    cdef int64_t mid
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if src[mid] <= value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
 # Compute the cumulative sum
 cdef void function_cumsum(cython.numeric[:] src, cython.numeric[:] dst, int64_t n):
     cdef int64_t i
@@ -64,6 +64,21 @@ cytime = timeit.timeit(
 print('Python time: {} s'.format(pytime))
 print('Cython time: {} s'.format(cytime))
 print('Cython is {} times faster than python\n'.format(pytime / cytime))
+
+print('=> Using soccernetv3\'s metric')
+pytime = timeit.timeit(
+    'metrics.evaluate_rank(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, eval_metric="soccernetv3", use_cython=False)',
+    setup=setup,
+    number=20
+)
+cytime = timeit.timeit(
+    'metrics.evaluate_rank(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, eval_metric="soccernetv3", use_cython=True)',
+    setup=setup,
+    number=20
+)
+print('Python time: {} s'.format(pytime))
+print('Cython time: {} s'.format(cytime))
+print('Cython is {} times faster than python\n'.format(pytime / cytime))
 """
 print("=> Check precision")
 
@@ -0,0 +1,222 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from .distance import compute_distance_matrix
+
+
+def iter_distance_chunks(
+    input1, input2, metric='euclidean', max_memory=256 * 1024**2, scale=1
+):
+    """Yields the columns of the distance matrix by chunks of gallery samples.
+
+    Args:
+        input1 (torch.Tensor): 2-D feature matrix.
+        input2 (torch.Tensor): 2-D feature matrix.
+        metric (str, optional): "euclidean" or "cosine".
+            Default is "euclidean".
+        max_memory (int, optional): maximum number of bytes of a chunk of
+            distances, multiplied by ``scale``. Default is 256MB.
+        scale (int, optional): number of chunk-sized float32 tensors the
+            consumer allocates per chunk. Default is 1.
+
+    Yields:
+        tuple: (col, distmat) where ``distmat`` is a torch.Tensor of shape
+        (m, c) holding the distances to gallery samples col to col + c.
+    """
+    m, n = input1.size(0), input2.size(0)
+    step = max(1, min(n, max_memory // (4 * scale * max(m, 1))))
+
+    if metric == 'cosine':
+        # normalize once instead of for every chunk
+        input1 = F.normalize(input1, p=2, dim=1)
+        input2 = F.normalize(input2, p=2, dim=1)
+
+    for col in range(0, n, step):
+        chunk = input2[col:col + step]
+        if metric == 'cosine':
+            distmat = 1 - torch.mm(input1, chunk.t())
+        else:
+            distmat = compute_distance_matrix(input1, chunk, metric)
+        yield col, distmat
+
+
+def _as_tensor(x, device):
+    return torch.as_tensor(np.asarray(x)).to(device)
+
+
+def topk_retrieval(
+    input1,
+    input2,
+    k,
+    metric='euclidean',
+    max_memory=256 * 1024**2,
+    groups1=None,
+    groups2=None,
+    same_group=True
+):
+    """Retrieves the k closest gallery samples of each query without
+    materializing the full distance matrix.
+
+    Gallery samples are streamed by chunks and a running top-k of each query is
+    updated by merging it with every chunk through ``torch.topk``, i.e. memory is
+    O(m*k) plus one chunk of distances.
+
+    Args:
+        input1 (torch.Tensor): 2-D query feature matrix.
+        input2 (torch.Tensor): 2-D gallery feature matrix.
+        k (int): number of gallery samples to retrieve for each query.
+        metric (str, optional): "euclidean" or "cosine".
+            Default is "euclidean".
+        max_memory (int, optional): maximum number of bytes of a chunk of
+            distances. Default is 256MB.
+        groups1 (numpy.ndarray, optional): 1-D array of query group labels,
+            e.g. SoccerNet action indices or camera ids.
+        groups2 (numpy.ndarray, optional): 1-D array of gallery group labels.
+        same_group (bool, optional): if True, only gallery samples from the same
+            group as the query are retrieved (same-action setting), otherwise
+            those are discarded (cross-camera setting). Only used when groups are
+            given. Default is True.
+
+    Returns:
+        tuple: (distmat, indices), two numpy.ndarray of shape (m, k) containing the
+        sorted distances and gallery indices. Missing entries, when less than k
+        gallery samples can be retrieved, have an infinite distance and index -1.
+
+    Examples::
+       >>> from torchreid import metrics
+       >>> qf = torch.rand(10, 2048)
+       >>> gf = torch.rand(500000, 2048)
+       >>> distmat, indices = metrics.topk_retrieval(qf, gf, k=10)
+    """
+    m = input1.size(0)
+    device = input1.device
+    best_dist = torch.full((m, k), float('inf'), device=device)
+    best_idx = torch.full((m, k), -1, dtype=torch.long, device=device)
+
+    use_groups = groups1 is not None and groups2 is not None
+    if use_groups:
+        groups1 = _as_tensor(groups1, device)
+        groups2 = _as_tensor(groups2, device)
+
+    # a chunk of distances, its candidate indices and the merged candidates
+    for col, distmat in iter_distance_chunks(
+        input1, input2, metric, max_memory, scale=4
+    ):
+        c = distmat.size(1)
+        if use_groups:
+            same = groups1.unsqueeze(1) == groups2[col:col + c].unsqueeze(0)
+            distmat = distmat.masked_fill(same != same_group, float('inf'))
+        indices = torch.arange(col, col + c, device=device).expand(m, c)
+        cand_dist = torch.cat([best_dist, distmat], dim=1)
+        cand_idx = torch.cat([best_idx, indices], dim=1)
+        best_dist, pos = cand_dist.topk(k, dim=1, largest=False, sorted=True)
+        best_idx = cand_idx.gather(1, pos)
+
+    best_idx[torch.isinf(best_dist)] = -1
+    return best_dist.cpu().numpy(), best_idx.cpu().numpy()
+
+
+def _keep_and_match(q_pids, g_pids, q_camids, g_camids, eval_metric):
+    """Returns the gallery samples to be ranked and the correct matches."""
+    same_pid = q_pids.unsqueeze(1) == g_pids.unsqueeze(0)
+    same_cam = q_camids.unsqueeze(1) == g_camids.unsqueeze(0)
+    if eval_metric == 'default':
+        # remove gallery samples that have the same pid and camid with query
+        keep = ~(same_pid & same_cam)
+    elif eval_metric == 'soccernetv3':
+        # remove gallery samples from different action than the query
+        keep = same_cam
+    else:
+        raise ValueError(
+            "Incorrect eval_metric value '{}' for streaming evaluation, "
+            "choose either 'default' or 'soccernetv3'".format(eval_metric)
+        )
+    return keep, same_pid & keep
+
+
+def rank_matches_streaming(
+    input1,
+    input2,
+    q_pids,
+    g_pids,
+    q_camids,
+    g_camids,
+    eval_metric='default',
+    metric='euclidean',
+    max_memory=256 * 1024**2
+):
+    """Computes the ranks of the correct matches of each query by streaming the
+    gallery twice, without materializing the full distance matrix.
+
+    The first pass collects the distances of the correct matches. The second one
+    counts, for each correct match, the kept gallery samples that are closer to
+    the query (see ``torchreid.metrics.rank.rank_matches``).
+
+    Args:
+        input1 (torch.Tensor): 2-D query feature matrix.
+        input2 (torch.Tensor): 2-D gallery feature matrix.
+        q_pids (numpy.ndarray): 1-D array of query person identities.
+        g_pids (numpy.ndarray): 1-D array of gallery person identities.
+        q_camids (numpy.ndarray): 1-D array of query camids (action indices for SoccerNet).
+        g_camids (numpy.ndarray): 1-D array of gallery camids (action indices for SoccerNet).
+        eval_metric (str, optional): 'default' or 'soccernetv3'. Default is 'default'.
+        metric (str, optional): "euclidean" or "cosine". Default is "euclidean".
+        max_memory (int, optional): maximum number of bytes of a chunk of
+            distances. Default is 256MB.
+
+    Returns:
+        list: ``num_query`` 1-D arrays with the sorted 1-based ranks of the correct
+        matches of each query.
+    """
+    m = input1.size(0)
+    device = input1.device
+    q_pids, g_pids = _as_tensor(q_pids, device), _as_tensor(g_pids, device)
+    q_camids = _as_tensor(q_camids, device)
+    g_camids = _as_tensor(g_camids, device)
+
+    def _chunks(scale):
+        for col, distmat in iter_distance_chunks(
+            input1, input2, metric, max_memory, scale=scale
+        ):
+            c = distmat.size(1)
+            keep, matches = _keep_and_match(
+                q_pids, g_pids[col:col + c], q_camids, g_camids[col:col + c],
+                eval_metric
+            )
+            yield distmat, keep, matches
+
+    # first pass: distances of the correct matches
+    match_q, match_dist = [], []
+    for distmat, _, matches in _chunks(scale=3):
+        q_idx, g_idx = matches.nonzero(as_tuple=True)
+        match_q.append(q_idx)
+        match_dist.append(distmat[q_idx, g_idx])
+    match_q = torch.cat(match_q).cpu().numpy()
+    match_dist = torch.cat(match_dist).cpu().numpy()
+
+    # sorted distances of the correct matches of each query, padded with inf
+    order = np.lexsort((match_dist, match_q))
+    match_q, match_dist = match_q[order], match_dist[order]
+    num_matches = np.bincount(match_q, minlength=m)
+    max_matches = max(int(num_matches.max()) if m > 0 else 0, 1)
+    starts = np.cumsum(num_matches) - num_matches
+    position = np.arange(match_q.size) - starts[match_q]
+    sorted_match_dist = np.full((m, max_matches), np.inf, dtype=np.float32)
+    sorted_match_dist[match_q, position] = match_dist
+    sorted_match_dist = torch.from_numpy(sorted_match_dist).to(device)
+
+    # second pass: a kept sample is closer than the i-th match iff at most i
+    # matches are not farther than it, i.e. histogram of searchsorted positions
+    hist = torch.zeros(m, max_matches + 1, dtype=torch.long, device=device)
+    for distmat, keep, matches in _chunks(scale=4):
+        bins = torch.searchsorted(
+            sorted_match_dist, distmat.contiguous(), right=True
+        )
+        hist.scatter_add_(1, bins, (keep & ~matches).long())
+    num_closer = hist.cumsum(dim=1)[:, :max_matches].cpu().numpy()
+
+    # the i-th match comes after the closer non-matching samples and i matches
+    ranks = num_closer + np.arange(1, max_matches + 1)
+    return [ranks[q_idx, :num_matches[q_idx]] for q_idx in range(m)]
@@ -83,7 +83,9 @@ def build_optimizer(
                 )
             new_layers = [new_layers]
 
-        if isinstance(model, nn.DataParallel):
+        if isinstance(
+            model, (nn.DataParallel, nn.parallel.DistributedDataParallel)
+        ):
             model = model.module
 
         base_params = []
@@ -1,10 +1,12 @@
 from __future__ import absolute_import
 
 from .tools import *
-from .rerank import re_ranking
+from .rerank import re_ranking, gnn_re_ranking, re_ranking_per_group
 from .loggers import *
 from .avgmeter import *
 from .reidtools import *
 from .torchtools import *
+from .distributed import *
 from .model_complexity import compute_model_complexity
 from .feature_extractor import FeatureExtractor
+from .feature_cache import FeatureCache, state_dict_hash
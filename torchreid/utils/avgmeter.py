@@ -1,5 +1,5 @@
 from __future__ import division, absolute_import
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 import torch
 
 __all__ = ['AverageMeter', 'MetricMeter']
@@ -36,6 +36,13 @@ class MetricMeter(object):
 
     Source: https://github.com/KaiyangZhou/Dassl.pytorch
 
+    Args:
+        delimiter (str, optional): delimiter of the metrics in the string
+            representation. Default is "\\t".
+        deferred (bool, optional): if True, tensor values are accumulated on
+            their device and only transferred to the meters, in a single device
+            synchronization, when ``sync`` is called. Default is False.
+
     Examples::
         >>> # 1. Create an instance of MetricMeter
         >>> metric = MetricMeter()
@@ -44,11 +51,17 @@ class MetricMeter(object):
         >>> metric.update(input_dict)
         >>> # 3. Convert to string and print
         >>> print(str(metric))
+        >>> # or, with deferred=True
+        >>> metric.update({'loss_1': loss_1.detach(), 'loss_2': loss_2.detach()})
+        >>> metric.sync()
+        >>> print(str(metric))
     """
 
-    def __init__(self, delimiter='\t'):
+    def __init__(self, delimiter='\t', deferred=False):
         self.meters = defaultdict(AverageMeter)
         self.delimiter = delimiter
+        self.deferred = deferred
+        self._pending = OrderedDict()
 
     def update(self, input_dict):
         if input_dict is None:
@@ -61,9 +74,37 @@ class MetricMeter(object):
 
         for k, v in input_dict.items():
             if isinstance(v, torch.Tensor):
+                if self.deferred:
+                    v = v.detach().float().reshape(())
+                    if k in self._pending:
+                        total, count, _ = self._pending[k]
+                        self._pending[k] = (total + v, count + 1, v)
+                    else:
+                        self._pending[k] = (v, 1, v)
+                    continue
                 v = v.item()
             self.meters[k].update(v)
 
+    def sync(self):
+        """Transfers the values accumulated in deferred mode to the meters."""
+        if not self._pending:
+            return
+        values = torch.stack(
+            [
+                torch.stack([total, last])
+                for total, _, last in self._pending.values()
+            ]
+        ).tolist()
+        for (k, (_, count, _)), (total, last) in zip(
+            self._pending.items(), values
+        ):
+            meter = self.meters[k]
+            meter.sum += total
+            meter.count += count
+            meter.avg = meter.sum / meter.count
+            meter.val = last
+        self._pending.clear()
+
     def __str__(self):
         output_str = []
         for name, meter in self.meters.items():
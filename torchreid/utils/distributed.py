@@ -0,0 +1,116 @@
+from __future__ import division, print_function, absolute_import
+import os
+import torch
+import torch.distributed as dist
+
+__all__ = [
+    'init_distributed', 'is_distributed', 'get_rank', 'get_world_size',
+    'is_main_process', 'barrier', 'all_gather_tensor', 'all_gather_object',
+    'broadcast_object'
+]
+
+
+def init_distributed(backend=''):
+    """Initializes the default process group from the environment variables
+    set by ``torchrun``, i.e. RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and
+    MASTER_PORT.
+
+    Args:
+        backend (str, optional): "nccl" or "gloo". Default is '' ("nccl" if
+            gpus are available, "gloo" otherwise).
+
+    Returns:
+        bool: True if there is more than one process.
+
+    Examples::
+        $ torchrun --nproc_per_node 2 benchmarks/baseline/main.py \\
+            --config-file benchmarks/baseline/configs/baseline_config.yaml
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    if not backend:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl':
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+    dist.init_process_group(backend=backend)
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() \
+        and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def _comm_device():
+    return torch.device('cuda') if dist.get_backend() == 'nccl' \
+        else torch.device('cpu')
+
+
+def all_gather_tensor(tensor):
+    """Gathers the tensors of all the processes, which may differ in their first
+    dimension, and concatenates them in rank order.
+
+    Args:
+        tensor (torch.Tensor): tensor of the current process.
+
+    Returns:
+        torch.Tensor: concatenated tensors, on the device of ``tensor``.
+    """
+    if not is_distributed():
+        return tensor
+    world_size = dist.get_world_size()
+    device = _comm_device()
+    local = tensor.to(device)
+
+    sizes = [
+        torch.zeros(1, dtype=torch.int64, device=device)
+        for _ in range(world_size)
+    ]
+    dist.all_gather(
+        sizes, torch.tensor([local.size(0)], dtype=torch.int64, device=device)
+    )
+    sizes = [int(size.item()) for size in sizes]
+
+    # all_gather requires tensors of the same shape
+    padded = local.new_zeros((max(sizes), ) + local.shape[1:])
+    padded[:local.size(0)] = local
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+    return torch.cat([g[:size] for g, size in zip(gathered, sizes)]
+                     ).to(tensor.device)
+
+
+def all_gather_object(obj):
+    """Returns the list of the (picklable) objects of all the processes, in rank
+    order."""
+    if not is_distributed():
+        return [obj]
+    objs = [None] * dist.get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+
+def broadcast_object(obj, src=0):
+    """Returns the (picklable) object of process ``src`` in all the processes."""
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
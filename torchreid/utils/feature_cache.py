@@ -0,0 +1,126 @@
+from __future__ import division, print_function, absolute_import
+import os
+import json
+import shutil
+import hashlib
+import os.path as osp
+import tempfile
+import numpy as np
+import torch
+
+from .tools import mkdir_if_missing
+
+__all__ = ['FeatureCache', 'state_dict_hash']
+
+
+def state_dict_hash(model):
+    """Computes a hash of the parameters and buffers of a model.
+
+    Args:
+        model (nn.Module): model.
+
+    Returns:
+        str: hexadecimal digest, which changes whenever the weights do.
+    """
+    if isinstance(
+        model,
+        (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)
+    ):
+        model = model.module
+    h = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode('utf-8'))
+        h.update(str(tuple(tensor.shape)).encode('utf-8'))
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+class FeatureCache(object):
+    """Persistent on-disk store of extracted features.
+
+    Each entry holds the features, person ids and camera ids of one split of a
+    dataset, as ``.npy`` files which are memory-mapped when loaded. Entries are
+    keyed by the model weights, the dataset name, the split and the transform
+    config, so that re-running evaluation with different post-processing
+    (distance metric, feature normalization, re-ranking) skips extraction.
+
+    Args:
+        cache_dir (str): directory where entries are stored.
+
+    Examples::
+        >>> cache = FeatureCache('log/feature_cache')
+        >>> key = cache.make_key(state_dict_hash(model), 'market1501', 'query', transform)
+        >>> entry = cache.load(key)
+        >>> if entry is None:
+        >>>     features, pids, camids = extract(query_loader)
+        >>>     cache.save(key, features, pids, camids)
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        mkdir_if_missing(cache_dir)
+
+    @staticmethod
+    def make_key(model_hash, dataset_name, split, transform):
+        """Builds the key of an entry.
+
+        Args:
+            model_hash (str): hash of the model weights (see ``state_dict_hash``).
+            dataset_name (str): dataset name.
+            split (str): e.g. "query" or "gallery".
+            transform (object): transform applied to the images, identified by
+                its ``repr``, e.g. sizes and normalization values.
+        """
+        h = hashlib.sha1()
+        for field in (model_hash, dataset_name, split, repr(transform)):
+            h.update(str(field).encode('utf-8'))
+            h.update(b'\0')
+        return '{}_{}_{}'.format(dataset_name, split, h.hexdigest()[:16])
+
+    def _entry_dir(self, key):
+        return osp.join(self.cache_dir, key)
+
+    def __contains__(self, key):
+        return osp.isfile(osp.join(self._entry_dir(key), 'meta.json'))
+
+    def load(self, key):
+        """Loads an entry.
+
+        Returns:
+            tuple: (features, pids, camids), where features is a torch.Tensor backed
+            by a (copy-on-write) memory-mapped array, or None if the entry is missing.
+        """
+        if key not in self:
+            return None
+        entry_dir = self._entry_dir(key)
+        features = np.load(osp.join(entry_dir, 'features.npy'), mmap_mode='c')
+        pids = np.load(osp.join(entry_dir, 'pids.npy'))
+        camids = np.load(osp.join(entry_dir, 'camids.npy'))
+        return torch.from_numpy(features), pids, camids
+
+    def save(self, key, features, pids, camids):
+        """Saves an entry.
+
+        The entry is written to a temporary directory which is then renamed, so that
+        an interrupted run never leaves a partial entry behind.
+
+        Args:
+            key (str): entry key (see ``make_key``).
+            features (torch.Tensor): 2-D feature matrix.
+            pids (numpy.ndarray): 1-D array of person ids.
+            camids (numpy.ndarray): 1-D array of camera ids.
+        """
+        entry_dir = self._entry_dir(key)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            np.save(osp.join(tmp_dir, 'features.npy'), features.cpu().numpy())
+            np.save(osp.join(tmp_dir, 'pids.npy'), np.asarray(pids))
+            np.save(osp.join(tmp_dir, 'camids.npy'), np.asarray(camids))
+            with open(osp.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump({'shape': list(features.shape)}, f)
+            if osp.isdir(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(tmp_dir, entry_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
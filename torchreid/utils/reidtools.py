@@ -4,6 +4,8 @@ import shutil
 import os.path as osp
 import cv2
 
+from torchreid.metrics.rank import rank_gallery
+
 from .tools import mkdir_if_missing
 
 __all__ = ['visualize_ranked_results']
@@ -16,7 +18,7 @@ RED = (0, 0, 255)
 
 
 def visualize_ranked_results(
-    distmat, dataset, data_type, width=128, height=256, save_dir='', topk=10, display_border=True
+    distmat, dataset, data_type, width=128, height=256, save_dir='', topk=10, display_border=True, indices=None
 ):
     """Visualizes ranked results.
 
@@ -26,7 +28,8 @@ def visualize_ranked_results(
     saved in folders each containing a tracklet.
 
     Args:
-        distmat (numpy.ndarray): distance matrix of shape (num_query, num_gallery).
+        distmat (numpy.ndarray or BlockDistanceMatrix): distance matrix of shape
+            (num_query, num_gallery). Can be None if ``indices`` is given.
         dataset (tuple): a 2-tuple containing (query, gallery), each of which contains
             tuples of (img_path(s), pid, camid, dsetid).
         data_type (str): "image" or "video".
@@ -36,18 +39,31 @@ def visualize_ranked_results(
         topk (int, optional): denoting top-k images in the rank list to be visualized.
             Default is 10.
         display_border (bool, optional): use green/red border around each image to indicate correct/incorrect match
+        indices (list, optional): precomputed gallery ranking of each query, restricted to gallery samples with the
+            same camid as the query (see ``torchreid.metrics.rank_gallery``). Default is None (only the top-k gallery
+            samples of each query are sorted).
     """
-    num_q, num_g = distmat.shape
+    query, gallery = dataset
+    if distmat is None:
+        assert indices is not None, 'indices must be given when distmat is None'
+        num_q, num_g = len(query), len(gallery)
+    else:
+        num_q, num_g = distmat.shape
     mkdir_if_missing(save_dir)
 
     print('# query: {}\n# gallery {}'.format(num_q, num_g))
     print('Visualizing top-{} ranks ...'.format(topk))
 
-    query, gallery = dataset
     assert num_q == len(query)
     assert num_g == len(gallery)
 
-    indices = np.argsort(distmat, axis=1)
+    if indices is None:
+        # for Soccernet, camid contains action_idx. Only samples within the same action should be compared
+        q_camids = np.asarray([items[2] for items in query])
+        g_camids = np.asarray([items[2] for items in gallery])
+        indices = rank_gallery(
+            distmat, topk=topk, q_groups=q_camids, g_groups=g_camids
+        )
 
     def _cp_img_to(src, dst, rank, prefix, matched=False):
         """
@@ -107,7 +123,7 @@ def visualize_ranked_results(
             _cp_img_to(qimg_path, qdir, rank=0, prefix='query')
 
         rank_idx = 1
-        for g_idx in indices[q_idx, :]:
+        for g_idx in indices[q_idx]:
             gimg_path, gpid, gcamid = gallery[g_idx][:3]
             # for Soccernet, camid contains action_idx. Only samples within the same action should be compared
             invalid = (qcamid != gcamid)
@@ -9,6 +9,13 @@ Modified by Houjing Huang, 2017-12-22.
 - This version accepts distance matrix instead of raw features.
 - The difference of `/` division between python 2 and 3 is handled.
 - numpy.float16 is replaced by numpy.float32 for numerical precision.
+Modified to be sparse and vectorized.
+- Rows of the (Q+G) x (Q+G) distance matrix are only built by blocks, and only their
+  top-(k1+1) neighbours are sorted (np.argpartition).
+- V is a CSR sparse matrix, with at most ~1.5*k1 non-zeros per row before query expansion.
+- k-reciprocal sets, their expansion and the Jaccard distance are computed with batched
+  numpy and sparse operations instead of per-sample Python loops.
+- Memory is linear in (Q+G)*k1, besides the input and output distance matrices.
 
 CVPR2017 paper:Zhong Z, Zheng L, Cao D, et al. Re-ranking Person Re-identification with k-reciprocal Encoding[J]. 2017.
 url:http://openaccess.thecvf.com/content_cvpr_2017/papers/Zhong_Re-Ranking_Person_Re-Identification_CVPR_2017_paper.pdf
@@ -24,8 +31,67 @@ Returns:
 """
 from __future__ import division, print_function, absolute_import
 import numpy as np
+import torch
+from multiprocessing import Pool
+from scipy import sparse
 
-__all__ = ['re_ranking']
+from torch.nn import functional as F
+
+from torchreid.metrics.distance import (
+    BlockDistanceMatrix, group_indices, compute_distance_matrix
+)
+
+__all__ = ['re_ranking', 'gnn_re_ranking', 're_ranking_per_group']
+
+# maximum number of float32 values of a block of distance rows
+BLOCK_NUMEL = 16 * 1024**2
+# maximum number of (query, sample) pairs processed at once for the Jaccard distance
+PAIR_BLOCK_SIZE = 8 * 1024**2
+
+
+def _row_blocks(num_rows, num_cols, numel=BLOCK_NUMEL):
+    step = max(1, min(1024, numel // max(num_cols, 1)))
+    for start in range(0, num_rows, step):
+        yield start, min(start + step, num_rows)
+
+
+def _normalized_rows(q_g_dist, q_q_dist, g_g_dist, start, stop):
+    """Returns rows start:stop of the normalized squared distance matrix.
+
+    As in the original implementation, row i is column i of the squared (Q+G) x (Q+G)
+    distance matrix divided by its maximum.
+    """
+    query_num = q_g_dist.shape[0]
+    parts = []
+    if start < query_num:
+        s, e = start, min(stop, query_num)
+        parts.append(np.concatenate([q_q_dist[:, s:e].T, q_g_dist[s:e]], axis=1))
+    if stop > query_num:
+        s, e = max(start, query_num) - query_num, stop - query_num
+        parts.append(
+            np.concatenate([q_g_dist[:, s:e].T, g_g_dist[:, s:e].T], axis=1)
+        )
+    rows = np.power(np.concatenate(parts, axis=0), 2).astype(np.float32)
+    return rows / np.max(rows, axis=1, keepdims=True)
+
+
+def _reciprocal(initial_rank, rows, k):
+    """Returns the k-reciprocal neighbours of the given samples, padded with -1.
+
+    j is a k-reciprocal neighbour of i if j is in the top-k of i and i in the top-k of j.
+    """
+    forward = initial_rank[rows, :k]
+    backward = initial_rank[forward, :k]
+    mask = (backward == rows[:, np.newaxis, np.newaxis]).any(axis=2)
+    return np.where(mask, forward, -1)
+
+
+def _sort_topk(rows, k):
+    if k >= rows.shape[1]:
+        return np.argsort(rows, axis=1)
+    indices = np.argpartition(rows, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(rows, indices, axis=1), axis=1)
+    return np.take_along_axis(indices, order, axis=1)
 
 
 def re_ranking(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3):
@@ -33,81 +99,306 @@ def re_ranking(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3):
     # The following naming, e.g. gallery_num, is different from outer scope.
     # Don't care about it.
 
-    original_dist = np.concatenate(
-        [
-            np.concatenate([q_q_dist, q_g_dist], axis=1),
-            np.concatenate([q_g_dist.T, g_g_dist], axis=1)
-        ],
-        axis=0
-    )
-    original_dist = np.power(original_dist, 2).astype(np.float32)
-    original_dist = np.transpose(
-        1. * original_dist / np.max(original_dist, axis=0)
-    )
-    V = np.zeros_like(original_dist).astype(np.float32)
-    initial_rank = np.argsort(original_dist).astype(np.int32)
+    q_g_dist = np.asarray(q_g_dist)
+    q_q_dist = np.asarray(q_q_dist)
+    g_g_dist = np.asarray(g_g_dist)
 
     query_num = q_g_dist.shape[0]
     gallery_num = q_g_dist.shape[0] + q_g_dist.shape[1]
     all_num = gallery_num
 
-    for i in range(all_num):
+    k = min(k1 + 1, all_num)
+    k_half = min(int(np.around(k1 / 2.)) + 1, all_num)
+    k_qe = min(k2, all_num)
+
+    # top-k neighbours of every sample
+    initial_rank = np.empty((all_num, max(k, k_qe)), dtype=np.int32)
+    for start, stop in _row_blocks(all_num, all_num):
+        rows = _normalized_rows(q_g_dist, q_q_dist, g_g_dist, start, stop)
+        initial_rank[start:stop] = _sort_topk(rows, initial_rank.shape[1])
+
+    # k/2-reciprocal neighbours of every sample, used to expand the k-reciprocal sets
+    half_reciprocal = np.empty((all_num, k_half), dtype=np.int32)
+    for start, stop in _row_blocks(all_num, k_half * k_half):
+        half_reciprocal[start:stop] = _reciprocal(
+            initial_rank, np.arange(start, stop), k_half
+        )
+
+    V_rows, V_cols, V_data = [], [], []
+    for start, stop in _row_blocks(all_num, all_num):
+        samples = np.arange(start, stop)
         # k-reciprocal neighbors
-        forward_k_neigh_index = initial_rank[i, :k1 + 1]
-        backward_k_neigh_index = initial_rank[forward_k_neigh_index, :k1 + 1]
-        fi = np.where(backward_k_neigh_index == i)[0]
-        k_reciprocal_index = forward_k_neigh_index[fi]
-        k_reciprocal_expansion_index = k_reciprocal_index
-        for j in range(len(k_reciprocal_index)):
-            candidate = k_reciprocal_index[j]
-            candidate_forward_k_neigh_index = initial_rank[
-                candidate, :int(np.around(k1 / 2.)) + 1]
-            candidate_backward_k_neigh_index = initial_rank[
-                candidate_forward_k_neigh_index, :int(np.around(k1 / 2.)) + 1]
-            fi_candidate = np.where(
-                candidate_backward_k_neigh_index == candidate
-            )[0]
-            candidate_k_reciprocal_index = candidate_forward_k_neigh_index[
-                fi_candidate]
-            if len(
-                np.
-                intersect1d(candidate_k_reciprocal_index, k_reciprocal_index)
-            ) > 2. / 3 * len(candidate_k_reciprocal_index):
-                k_reciprocal_expansion_index = np.append(
-                    k_reciprocal_expansion_index, candidate_k_reciprocal_index
+        k_reciprocal_index = _reciprocal(initial_rank, samples, k)
+
+        # a candidate's k/2-reciprocal set is added if it mostly overlaps with the k-reciprocal set
+        candidates = half_reciprocal[np.maximum(k_reciprocal_index, 0)]
+        valid = candidates >= 0
+        overlap = (
+            candidates[..., np.newaxis] ==
+            k_reciprocal_index[:, np.newaxis, np.newaxis, :]
+        ).any(axis=3) & valid
+        expand = (k_reciprocal_index >= 0) & (
+            overlap.sum(axis=2) > 2. / 3 * valid.sum(axis=2)
+        )
+        expansion = np.where(expand[..., np.newaxis], candidates, -1)
+        expansion = np.concatenate(
+            [k_reciprocal_index,
+             expansion.reshape(len(samples), -1)], axis=1
+        )
+
+        # unique indices of each row
+        expansion.sort(axis=1)
+        keep = expansion >= 0
+        keep[:, 1:] &= expansion[:, 1:] != expansion[:, :-1]
+        local_rows, pos = np.nonzero(keep)
+        cols = expansion[local_rows, pos]
+
+        rows = _normalized_rows(q_g_dist, q_q_dist, g_g_dist, start, stop)
+        weight = np.exp(-rows[local_rows, cols])
+        weight_sum = np.bincount(
+            local_rows, weights=weight, minlength=len(samples)
+        )
+        V_rows.append(local_rows + start)
+        V_cols.append(cols)
+        V_data.append((weight / weight_sum[local_rows]).astype(np.float32))
+
+    V = sparse.csr_matrix(
+        (
+            np.concatenate(V_data),
+            (np.concatenate(V_rows), np.concatenate(V_cols))
+        ),
+        shape=(all_num, all_num),
+        dtype=np.float32
+    )
+    if k2 != 1:
+        # V_qe[i] is the mean of V over the top-k2 neighbours of i
+        qe = sparse.csr_matrix(
+            (
+                np.full(all_num * k_qe, 1. / k_qe, dtype=np.float32),
+                (
+                    np.repeat(np.arange(all_num), k_qe),
+                    initial_rank[:, :k_qe].ravel()
                 )
+            ),
+            shape=(all_num, all_num)
+        )
+        V = qe.dot(V).tocsr()
+    del initial_rank, half_reciprocal
+
+    # Jaccard distance between queries and gallery samples:
+    # sum over l of min(V[i, l], V[j, l]) for the pairs sharing a non-zero l
+    V_query = V[:query_num]
+    V_gallery = V[query_num:].tocsc()
+    col_nnz = np.diff(V_gallery.indptr)
+    pair_counts = np.asarray(
+        sparse.csr_matrix(
+            (col_nnz[V_query.indices], V_query.indices, V_query.indptr),
+            shape=V_query.shape
+        ).sum(axis=1)
+    ).ravel()
+
+    num_gallery = all_num - query_num
+    final_dist = np.empty((query_num, num_gallery), dtype=np.float32)
+    start = 0
+    while start < query_num:
+        stop = start + 1
+        num_pairs = pair_counts[start]
+        while stop < query_num and num_pairs + pair_counts[stop] <= PAIR_BLOCK_SIZE:
+            num_pairs += pair_counts[stop]
+            stop += 1
+
+        block = V_query[start:stop]
+        local_rows = np.repeat(np.arange(stop - start), np.diff(block.indptr))
+        counts = col_nnz[block.indices]
+        offsets = np.repeat(
+            V_gallery.indptr[block.indices] - (np.cumsum(counts) - counts),
+            counts
+        )
+        entries = offsets + np.arange(counts.sum())
+        temp_min = np.bincount(
+            np.repeat(local_rows, counts) * num_gallery +
+            V_gallery.indices[entries],
+            weights=np.minimum(
+                np.repeat(block.data, counts), V_gallery.data[entries]
+            ),
+            minlength=(stop - start) * num_gallery
+        ).reshape(stop - start, num_gallery)
+        jaccard_dist = 1 - temp_min / (2.-temp_min)
 
-        k_reciprocal_expansion_index = np.unique(k_reciprocal_expansion_index)
-        weight = np.exp(-original_dist[i, k_reciprocal_expansion_index])
-        V[i, k_reciprocal_expansion_index] = 1. * weight / np.sum(weight)
-    original_dist = original_dist[:query_num, ]
+        original_dist = _normalized_rows(
+            q_g_dist, q_q_dist, g_g_dist, start, stop
+        )[:, query_num:]
+        final_dist[start:stop] = jaccard_dist * (
+            1-lambda_value
+        ) + original_dist*lambda_value
+        start = stop
+
+    return final_dist
+
+
+def _sparse_rows_to_tensor(matrix, device):
+    return torch.from_numpy(matrix.toarray()).to(device)
+
+
+def gnn_re_ranking(qf, gf, k1=26, k2=7):
+    """Re-ranking as graph neural network message passing.
+
+    Port of ``GPU-Re-Ranking/gnn_reranking.py`` which does not need the custom CUDA
+    extensions: the adjacency matrix is a sparse matrix built from the top-k1 lists
+    (computed by blocks of rows), and the propagation over the top-k2 neighbours is a
+    sparse matrix product, so that memory is linear in (Q+G) instead of (Q+G)^2. The
+    final query-gallery similarity is computed by blocks with dense matrix products
+    on the device of the features.
+
+    Reference:
+        Zhang et al. Understanding Image Retrieval Re-Ranking: A Graph Neural Network
+        Perspective. arXiv:2012.07620.
+
+    Args:
+        qf (torch.Tensor): 2-D query feature matrix.
+        gf (torch.Tensor): 2-D gallery feature matrix.
+        k1 (int, optional): number of neighbours of the initial graph. Default is 26.
+        k2 (int, optional): number of neighbours used for propagation. Default is 7.
+
+    Returns:
+        numpy.ndarray: re-ranked distance matrix of shape (num_query, num_gallery),
+        i.e. 1 - cosine similarity of the propagated adjacency vectors.
+    """
+    query_num = qf.size(0)
+    device = qf.device
+    X_u = F.normalize(torch.cat((qf, gf), dim=0).float(), p=2, dim=1)
+    all_num = X_u.size(0)
+    k1 = min(k1, all_num)
+    k2 = min(k2, k1)
+
+    # initial ranking list
+    S = torch.empty(all_num, k1, device=device)
+    initial_rank = torch.empty(all_num, k1, dtype=torch.long, device=device)
+    for start, stop in _row_blocks(all_num, all_num):
+        original_score = torch.mm(X_u[start:stop], X_u.t())
+        S[start:stop], initial_rank[start:stop] = original_score.topk(
+            k=k1, dim=-1, largest=True, sorted=True
+        )
+    del X_u, original_score
+    S = (S * S).cpu().numpy()
+    initial_rank = initial_rank.cpu().numpy()
+
+    # stage 1: A[i, j] = 1 if j is among the top-k1 of i
+    A = sparse.csr_matrix(
+        (
+            np.ones(all_num * k1, dtype=np.float32),
+            (np.repeat(np.arange(all_num), k1), initial_rank.ravel())
+        ),
+        shape=(all_num, all_num)
+    )
+
+    # stage 2: A_qe[i] = sum over the top-k2 neighbours j of i of S[i, j] * A[j]
     if k2 != 1:
-        V_qe = np.zeros_like(V, dtype=np.float32)
-        for i in range(all_num):
-            V_qe[i, :] = np.mean(V[initial_rank[i, :k2], :], axis=0)
-        V = V_qe
-        del V_qe
-    del initial_rank
-    invIndex = []
-    for i in range(gallery_num):
-        invIndex.append(np.where(V[:, i] != 0)[0])
-
-    jaccard_dist = np.zeros_like(original_dist, dtype=np.float32)
-
-    for i in range(query_num):
-        temp_min = np.zeros(shape=[1, gallery_num], dtype=np.float32)
-        indNonZero = np.where(V[i, :] != 0)[0]
-        indImages = []
-        indImages = [invIndex[ind] for ind in indNonZero]
-        for j in range(len(indNonZero)):
-            temp_min[0, indImages[j]] = temp_min[0, indImages[j]] + np.minimum(
-                V[i, indNonZero[j]], V[indImages[j], indNonZero[j]]
-            )
-        jaccard_dist[i] = 1 - temp_min / (2.-temp_min)
+        propagation = sparse.csr_matrix(
+            (
+                S[:, :k2].ravel(),
+                (np.repeat(np.arange(all_num), k2), initial_rank[:, :k2].ravel())
+            ),
+            shape=(all_num, all_num)
+        )
+        for i in range(2):
+            A = (A + A.T).tocsr()
+            A = propagation.dot(A).tocsr()
+            A_norm = np.sqrt(np.asarray(A.multiply(A).sum(axis=1)).ravel())
+            A = sparse.diags(1. / A_norm).dot(A).tocsr()
 
-    final_dist = jaccard_dist * (1-lambda_value) + original_dist*lambda_value
-    del original_dist
-    del V
-    del jaccard_dist
-    final_dist = final_dist[:query_num, query_num:]
+    A_query, A_gallery = A[:query_num], A[query_num:]
+    final_dist = np.empty((query_num, all_num - query_num), dtype=np.float32)
+    for q_start, q_stop in _row_blocks(query_num, all_num):
+        A_q = _sparse_rows_to_tensor(A_query[q_start:q_stop], device)
+        for g_start, g_stop in _row_blocks(all_num - query_num, all_num):
+            A_g = _sparse_rows_to_tensor(A_gallery[g_start:g_stop], device)
+            cosine_similarity = torch.mm(A_q, A_g.t())
+            final_dist[q_start:q_stop, g_start:g_stop] = (
+                1 - cosine_similarity
+            ).cpu().numpy()
     return final_dist
+
+
+def _re_ranking_block(args):
+    method, input1, input2, input3, kwargs = args
+    if method == 'gnn':
+        if input1.size(0) == 0 or input2.size(0) == 0:
+            return np.zeros((input1.size(0), input2.size(0)), dtype=np.float32)
+        return gnn_re_ranking(input1, input2, **kwargs)
+    if input1.size == 0:
+        return input1
+    return re_ranking(input1, input2, input3, **kwargs)
+
+
+def re_ranking_per_group(
+    qf,
+    gf,
+    q_groups,
+    g_groups,
+    metric='euclidean',
+    k1=20,
+    k2=6,
+    lambda_value=0.3,
+    num_workers=0,
+    method='k_reciprocal'
+):
+    """Applies re-ranking independently within each group, e.g. SoccerNet actions.
+
+    Only query and gallery samples sharing the same group are compared, so that cost
+    scales with the sum of the squared group sizes instead of the square of the total.
+
+    Args:
+        qf (torch.Tensor): 2-D query feature matrix.
+        gf (torch.Tensor): 2-D gallery feature matrix.
+        q_groups (numpy.ndarray): 1-D array of query group labels.
+        g_groups (numpy.ndarray): 1-D array of gallery group labels.
+        metric (str, optional): "euclidean" or "cosine". Default is "euclidean".
+        k1, k2, lambda_value: re-ranking parameters, see ``re_ranking``. Only used
+            with the "k_reciprocal" method.
+        num_workers (int, optional): if positive, groups are re-ranked in a pool
+            of ``num_workers`` processes. Default is 0.
+        method (str, optional): "k_reciprocal" (``re_ranking``) or "gnn"
+            (``gnn_re_ranking``, with its default parameters). Default is "k_reciprocal".
+
+    Returns:
+        torchreid.metrics.BlockDistanceMatrix: re-ranked distances of each group.
+    """
+    if method not in ['k_reciprocal', 'gnn']:
+        raise ValueError(
+            'Unknown re-ranking method: {}. '
+            'Please choose either "k_reciprocal" or "gnn"'.format(method)
+        )
+
+    def _distances(input1, input2):
+        return compute_distance_matrix(input1, input2, metric).numpy()
+
+    g_indices_of = group_indices(g_groups)
+    indices, tasks = [], []
+    for label, q_indices in group_indices(q_groups).items():
+        g_indices = g_indices_of.get(label, np.empty(0, dtype=np.int64))
+        q_feats = qf[torch.from_numpy(q_indices)]
+        g_feats = gf[torch.from_numpy(g_indices)]
+        indices.append((q_indices, g_indices))
+        if method == 'gnn':
+            tasks.append((method, q_feats, g_feats, None, {}))
+        else:
+            tasks.append(
+                (
+                    method, _distances(q_feats, g_feats),
+                    _distances(q_feats, q_feats), _distances(g_feats, g_feats),
+                    dict(k1=k1, k2=k2, lambda_value=lambda_value)
+                )
+            )
+
+    if num_workers > 0:
+        with Pool(num_workers) as pool:
+            distmats = pool.map(_re_ranking_block, tasks)
+    else:
+        distmats = [_re_ranking_block(task) for task in tasks]
+
+    blocks = [
+        (q_indices, g_indices, distmat)
+        for (q_indices, g_indices), distmat in zip(indices, distmats)
+    ]
+    return BlockDistanceMatrix(blocks, qf.size(0), gf.size(0))
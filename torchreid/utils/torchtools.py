@@ -1,34 +1,51 @@
 from __future__ import division, print_function, absolute_import
+import os
+import re
+import glob
+import time
+import queue
 import pickle
 import shutil
 import os.path as osp
 import warnings
+import threading
 from functools import partial
 from collections import OrderedDict
 import torch
 import torch.nn as nn
 
 from .tools import mkdir_if_missing
+from .avgmeter import AverageMeter
 
 __all__ = [
-    'save_checkpoint', 'load_checkpoint', 'resume_from_checkpoint',
-    'open_all_layers', 'open_specified_layers', 'count_num_param',
-    'load_pretrained_weights'
+    'save_checkpoint', 'CheckpointWriter', 'load_checkpoint',
+    'resume_from_checkpoint', 'open_all_layers', 'open_specified_layers',
+    'count_num_param', 'load_pretrained_weights'
 ]
 
 
 def save_checkpoint(
-    state, save_dir, is_best=False, remove_module_from_keys=False
+    state, save_dir, is_best=False, remove_module_from_keys=False, max_keep=0
 ):
     r"""Saves checkpoint.
 
+    The checkpoint is written to a temporary file which is then renamed, so that
+    an interrupted run never leaves a truncated checkpoint behind.
+
     Args:
         state (dict): dictionary.
         save_dir (str): directory to save checkpoint.
-        is_best (bool, optional): if True, this checkpoint will be copied and named
+        is_best (bool, optional): if True, this checkpoint will be hard-linked (or
+            copied if the file system does not support it) to
             ``model-best.pth.tar``. Default is False.
         remove_module_from_keys (bool, optional): whether to remove "module."
             from layer names. Default is False.
+        max_keep (int, optional): number of the most recent checkpoints kept in
+            ``save_dir``, older ones being deleted (``model-best.pth.tar`` is
+            always kept). Default is 0 (all the checkpoints are kept).
+
+    Returns:
+        str: path of the checkpoint.
 
     Examples::
         >>> state = {
@@ -52,10 +69,157 @@ def save_checkpoint(
     # save
     epoch = state['epoch']
     fpath = osp.join(save_dir, 'model.pth.tar-' + str(epoch))
-    torch.save(state, fpath)
+    tmp_fpath = fpath + '.tmp'
+    torch.save(state, tmp_fpath)
+    os.replace(tmp_fpath, fpath)
     print('Checkpoint saved to "{}"'.format(fpath))
     if is_best:
-        shutil.copy(fpath, osp.join(osp.dirname(fpath), 'model-best.pth.tar'))
+        best_fpath = osp.join(save_dir, 'model-best.pth.tar')
+        tmp_fpath = best_fpath + '.tmp'
+        if osp.lexists(tmp_fpath):
+            os.remove(tmp_fpath)
+        try:
+            os.link(fpath, tmp_fpath)
+        except OSError:
+            shutil.copy(fpath, tmp_fpath)
+        os.replace(tmp_fpath, best_fpath)
+    if max_keep > 0:
+        _remove_old_checkpoints(save_dir, max_keep)
+    return fpath
+
+
+def _remove_old_checkpoints(save_dir, max_keep):
+    epochs = []
+    for fpath in glob.glob(osp.join(save_dir, 'model.pth.tar-*')):
+        match = re.match(r'model\.pth\.tar-(\d+)$', osp.basename(fpath))
+        if match:
+            epochs.append((int(match.group(1)), fpath))
+    for _, fpath in sorted(epochs)[:-max_keep]:
+        os.remove(fpath)
+
+
+def _snapshot(obj):
+    """Returns a copy of ``obj`` whose tensors are copied to cpu."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        copy = obj.__class__((k, _snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            # versions of the modules, used by nn.Module.load_state_dict
+            copy._metadata = obj._metadata
+        return copy
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_snapshot(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter(object):
+    """Saves checkpoints (see ``save_checkpoint``) on a background thread.
+
+    ``save`` only copies the tensors of the state to cpu, which is the part
+    that must be synchronous since training then updates them, and the
+    serialization and writing are done by the thread, so that large models do
+    not stall training. The snapshot and write times are reported.
+
+    Args:
+        max_keep (int, optional): number of the most recent checkpoints kept in
+            each directory. Default is 0 (all the checkpoints are kept).
+        background (bool, optional): if False, checkpoints are written in
+            ``save``. Default is True.
+
+    Examples::
+        >>> writer = CheckpointWriter(max_keep=3)
+        >>> writer.save(state, 'log/my_model', is_best=True)
+        >>> # training goes on while the checkpoint is written
+        >>> writer.close()
+    """
+
+    def __init__(self, max_keep=0, background=True):
+        self.max_keep = max_keep
+        self.background = background
+        self.snapshot_time = AverageMeter()
+        self.write_time = AverageMeter()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._error = None
+
+    def save(
+        self, state, save_dir, is_best=False, remove_module_from_keys=False
+    ):
+        """Saves a checkpoint, see ``save_checkpoint``."""
+        self._raise_error()
+        start = time.time()
+        state = _snapshot(state)
+        snapshot_time = time.time() - start
+        self.snapshot_time.update(snapshot_time)
+        args = (
+            state, save_dir, is_best, remove_module_from_keys, snapshot_time
+        )
+        if not self.background:
+            self._write(*args)
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put(args)
+
+    def _write(
+        self, state, save_dir, is_best, remove_module_from_keys, snapshot_time
+    ):
+        start = time.time()
+        save_checkpoint(
+            state,
+            save_dir,
+            is_best=is_best,
+            remove_module_from_keys=remove_module_from_keys,
+            max_keep=self.max_keep
+        )
+        self.write_time.update(time.time() - start)
+        print(
+            'Checkpoint written in {:.2f}s (snapshot {:.2f}s)'.format(
+                self.write_time.val, snapshot_time
+            )
+        )
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            try:
+                if args is None:
+                    return
+                if self._error is None:
+                    self._write(*args)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Failed to write checkpoint') from error
+
+    def wait(self):
+        """Waits for the pending checkpoints to be written."""
+        if self._thread is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Writes the pending checkpoints and stops the thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self.write_time.count > 0:
+            print(
+                'Checkpoints: {} written in {:.2f}s on average, training '
+                'blocked {:.2f}s on average'.format(
+                    self.write_time.count, self.write_time.avg,
+                    self.snapshot_time.avg
+                )
+            )
+        self._raise_error()
 
 
 def load_checkpoint(fpath):
@@ -95,7 +259,9 @@ def load_checkpoint(fpath):
     return checkpoint
 
 
-def resume_from_checkpoint(fpath, model, optimizer=None, scheduler=None):
+def resume_from_checkpoint(
+    fpath, model, optimizer=None, scheduler=None, scaler=None
+):
     r"""Resumes training from a checkpoint.
 
     This will load (1) model weights and (2) ``state_dict``
@@ -106,6 +272,8 @@ def resume_from_checkpoint(fpath, model, optimizer=None, scheduler=None):
         model (nn.Module): model.
         optimizer (Optimizer, optional): an Optimizer.
         scheduler (LRScheduler, optional): an LRScheduler.
+        scaler (GradScaler, optional): gradient scaler of mixed precision
+            training, e.g. ``engine.scaler``.
 
     Returns:
         int: start_epoch.
@@ -127,6 +295,9 @@ def resume_from_checkpoint(fpath, model, optimizer=None, scheduler=None):
     if scheduler is not None and 'scheduler' in checkpoint.keys():
         scheduler.load_state_dict(checkpoint['scheduler'])
         print('Loaded scheduler')
+    if scaler is not None and 'scaler' in checkpoint.keys():
+        scaler.load_state_dict(checkpoint['scaler'])
+        print('Loaded gradient scaler')
     start_epoch = checkpoint['epoch']
     print('Last epoch = {}'.format(start_epoch))
     if 'rank1' in checkpoint.keys():
@@ -198,7 +369,9 @@ def open_specified_layers(model, open_layers):
         >>> open_layers = ['fc', 'classifier']
         >>> open_specified_layers(model, open_layers)
     """
-    if isinstance(model, nn.DataParallel):
+    if isinstance(
+        model, (nn.DataParallel, nn.parallel.DistributedDataParallel)
+    ):
         model = model.module
 
     if isinstance(open_layers, str):
@@ -243,7 +416,9 @@ def count_num_param(model):
 
     num_param = sum(p.numel() for p in model.parameters())
 
-    if isinstance(model, nn.DataParallel):
+    if isinstance(
+        model, (nn.DataParallel, nn.parallel.DistributedDataParallel)
+    ):
         model = model.module
 
     if hasattr(model,